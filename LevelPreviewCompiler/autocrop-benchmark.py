@@ -0,0 +1,109 @@
+# Newer DS Autocrop Benchmark
+# Compares imagebridge.findAutocropSize against the original per-pixel
+# version on the text boards rendered for the levels in config.json.
+
+import argparse
+import collections
+import importlib.util
+import json
+import tempfile
+import time
+
+from PyQt5 import QtGui
+
+import imagebridge
+import textcache
+
+
+def findAutocropSizeReference(img):
+    """
+    The original findAutocropSize(), which checks one pixel at a time
+    """
+    if not isinstance(img, QtGui.QImage):
+        img = img.toImage()
+    minX, minY, maxX, maxY = 0, 0, img.width() - 1, img.height() - 1
+    alphaAt = lambda x, y: img.pixel(x, y) >> 24
+    rowClear = lambda y: all(alphaAt(x, y) == 0 for x in range(img.width()))
+    colClear = lambda x: all(alphaAt(x, y) == 0 for y in range(img.height()))
+    while colClear(minX): minX += 1
+    while rowClear(minY): minY += 1
+    while colClear(maxX): maxX -= 1
+    while rowClear(maxY): maxY -= 1
+    return minX, minY, maxX - minX, maxY - minY
+
+
+def collectTextBoards(limit):
+    """
+    Render the top-screen images for the first few levels, and return
+    every image that gets autocropped along the way.
+    """
+    spec = importlib.util.spec_from_file_location('graphics_compiler', 'graphics-compiler.py')
+    compiler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(compiler)
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f, object_pairs_hook=collections.OrderedDict)
+
+    boards = []
+    findAutocropSize = imagebridge.findAutocropSize
+    def recordingFindAutocropSize(img):
+        boards.append(QtGui.QImage(img.toImage() if isinstance(img, QtGui.QPixmap) else img))
+        return findAutocropSize(img)
+    imagebridge.findAutocropSize = recordingFindAutocropSize
+
+    # Use an empty text cache, so that everything really gets rendered
+    with tempfile.TemporaryDirectory() as cacheDir:
+        textcache.CACHE_DIR = cacheDir
+
+        resources = compiler.loadResources()
+        for levelConfig in list(config['levels'].values())[:limit]:
+            theme = config['themes'][levelConfig['theme']]
+            compiler.makeTopScreenIntroGraphics(
+                resources = resources,
+                title = levelConfig.get('title'),
+                name = levelConfig.get('name'),
+                background1 = compiler.hex2QColor(theme['background1']),
+                background2 = compiler.hex2QColor(theme['background2']),
+                banner1 = compiler.hex2QColor(theme['banner1']),
+                banner2 = compiler.hex2QColor(theme['banner2']),
+                preview = QtGui.QPixmap('previews/' + levelConfig['preview']),
+                )
+
+    imagebridge.findAutocropSize = findAutocropSize
+    return boards
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark imagebridge.findAutocropSize against the original version.')
+    parser.add_argument('--limit', type=int, default=5,
+        help='number of levels to render text boards for (default: 5)')
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication([])
+
+    boards = collectTextBoards(args.limit)
+
+    totalNew = totalRef = 0
+    for i, board in enumerate(boards):
+        start = time.perf_counter()
+        new = imagebridge.findAutocropSize(board)
+        timeNew = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ref = findAutocropSizeReference(board)
+        timeRef = time.perf_counter() - start
+
+        if new != ref:
+            raise ValueError(f'Output mismatch for image {i}: {new} != {ref}')
+
+        print(f'{board.width()}x{board.height()} -> {new}:'
+              f' {timeRef * 1000:.1f}ms -> {timeNew * 1000:.2f}ms ({timeRef / timeNew:.0f}x)')
+        totalNew += timeNew
+        totalRef += timeRef
+
+    print(f'Total ({len(boards)} images):'
+          f' {totalRef:.2f}s -> {totalNew:.3f}s ({totalRef / totalNew:.0f}x)')
+
+
+main()
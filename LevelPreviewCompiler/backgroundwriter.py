@@ -0,0 +1,69 @@
+# Newer DS background writer for the level preview compiler
+
+# Once an image pair's ENPGs are compressed, everything else that's
+# done with it is writing files: the debug PNGs and ENPGs, and its build
+# cache entry. None of that is needed to insert the pair into the ROM,
+# so it's handed to a background thread while the next pair is rendered.
+# The queue is bounded, so if the disk can't keep up, rendering waits
+# instead of piling up images in memory.
+
+import queue
+import threading
+
+
+class BackgroundWriter:
+    """
+    Runs functions on a background thread, in the order they were
+    submitted.
+    """
+    def __init__(self, maxPending=4):
+        self.queue = queue.Queue(maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    func, args = job
+                    func(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        """
+        Re-raise the first error a job ran into, if any. The error stays
+        set, so every later call raises it again, and the jobs after it
+        are skipped until the writer is closed.
+        """
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args):
+        """
+        Queue func(*args), waiting for room in the queue if it's full.
+        """
+        self.check()
+        self.queue.put((func, args))
+
+    def flush(self):
+        """
+        Wait for everything submitted so far to be done.
+        """
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        """
+        Finish everything submitted so far, and stop the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
@@ -0,0 +1,353 @@
+# Newer DS Benchmark Suite
+# Times the hot functions of the compilers on their own, and then runs
+# graphics-compiler.py on synthetic configs of different sizes (see
+# make-synthetic-config.py) and compile-ts-graphics.py, measuring how
+# long they take and how much memory they use. The results are saved as
+# JSON, and can be compared against the results from another commit.
+
+import argparse
+import collections
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import ndspy.lz10
+import PIL.Image
+from PyQt5 import QtGui
+
+import enpg
+import imagebridge
+import instrument
+import lz77
+import quantize
+import textcache
+
+
+ROM_FN = 'Newer Super Mario Bros. DS Orig.nds'
+
+# Benchmarks that get this much slower (or use this much more memory)
+# than the results they're compared against are reported as regressions
+REGRESSION_THRESHOLD = 1.10
+
+# Things not to copy from the level preview compiler's folder for the
+# end-to-end runs, which each get a fresh one
+COPY_IGNORE = shutil.ignore_patterns(
+    '.cache', '__pycache__', 'out-*', 'previews', 'config.json', '*.nds')
+OUTPUT_DIRS = ['out-png', 'out-enpg', 'out-enpg-lz', 'out-enpg-png']
+
+# Runs a command and saves how long it took and its peak memory use
+# (which includes the worker processes of graphics-compiler.py)
+MEASURE_SCRIPT = '''
+import json, resource, subprocess, sys, time
+start = time.perf_counter()
+returncode = subprocess.call(sys.argv[2:])
+seconds = time.perf_counter() - start
+with open(sys.argv[1], 'w') as f:
+    json.dump({'returncode': returncode, 'seconds': seconds,
+               'maxrss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}, f)
+'''
+
+
+def loadScript(fn, name):
+    spec = importlib.util.spec_from_file_location(name, fn)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timeCall(func, repeat):
+    """
+    Time func() like timeit does. Return the per-call times in seconds:
+    the best, median and mean of repeat runs.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {'calls': number * repeat, 'min': min(times),
+            'median': statistics.median(times), 'mean': statistics.mean(times)}
+
+
+def microBenchmarks(compiler, repeat):
+    """
+    Time each hot function on one level's images. Return
+    {name: timeCall() results}.
+    """
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f, object_pairs_hook=collections.OrderedDict)
+    levelConfig = next(iter(config['levels'].values()))
+    theme = config['themes'][levelConfig['theme']]
+    colors = {part: compiler.hex2QColor(theme[part])
+              for part in ['background1', 'background2', 'banner1', 'banner2']}
+    resources = compiler.loadResources()
+    preview = resources['Pixmap']('previews/' + levelConfig['preview'])
+
+    def renderTop():
+        return compiler.makeTopScreenIntroGraphics(
+            resources=resources, title=levelConfig.get('title'), name=levelConfig.get('name'),
+            preview=preview, **colors)
+
+    def renderBottom():
+        return compiler.makeBottomScreenIntroGraphics(
+            resources=resources, icon=resources['Pixmap']('bottoms/' + levelConfig['bottom']),
+            **colors)
+
+    # Skip the text cache, so that the text really gets rendered, and
+    # keep the text boards that get autocropped along the way
+    boards = []
+    findAutocropSize = imagebridge.findAutocropSize
+    def recordingFindAutocropSize(img):
+        boards.append(imagebridge.toQImage(img))
+        return findAutocropSize(img)
+    cachedRender = textcache.cachedRender
+    textcache.cachedRender = lambda key, render: imagebridge.toQImage(render())
+    imagebridge.findAutocropSize = recordingFindAutocropSize
+    try:
+        main, aux = renderTop()
+        imagebridge.findAutocropSize = findAutocropSize
+
+        results = {}
+        results['makeTopScreenIntroGraphics'] = timeCall(renderTop, repeat)
+        results['makeBottomScreenIntroGraphics'] = timeCall(renderBottom, repeat)
+
+        # renderText() is local to makeTopScreenIntroGraphics(), so it's
+        # timed through its instrumentation stage instead
+        instrument.configure(True)
+        times = []
+        for _ in range(repeat):
+            renderTop()
+            calls, seconds, _ = instrument.takeStats()['stages']['text']
+            times.append(seconds / calls)
+        instrument.configure(False)
+        results['renderText'] = {'calls': repeat * calls, 'min': min(times),
+                                 'median': statistics.median(times), 'mean': statistics.mean(times)}
+    finally:
+        imagebridge.findAutocropSize = findAutocropSize
+        textcache.cachedRender = cachedRender
+
+    board = max(boards, key=lambda b: b.width() * b.height())
+    results['imagebridge.findAutocropSize'] = timeCall(lambda: imagebridge.findAutocropSize(board), repeat)
+
+    color1, color2 = colors['background1'], colors['banner1']
+    results['averageColor'] = timeCall(lambda: compiler.averageColor(color1, color2), repeat)
+
+    # The rest works on the pair's ENPGs, made the same way as in
+    # saveImagePair()
+    comb = PIL.Image.new('RGBA', (512, 256), (0, 0, 0, 0))
+    comb.paste(imagebridge.qImageToPilImage(imagebridge.toQImage(main)), (0, 0))
+    comb.paste(imagebridge.qImageToPilImage(imagebridge.toQImage(aux)), (256, 0))
+    for backend in quantize.QUANTIZERS:
+        results[f'quantize.quantize ({backend})'] = timeCall(
+            lambda: quantize.quantize(comb, backend, 255), repeat)
+    combQ = quantize.quantize(comb, compiler.QUANTIZER, 255)
+    results['enpg.enpgsFromQuantized'] = timeCall(lambda: enpg.enpgsFromQuantized(comb, combQ), repeat)
+
+    enpgData = bytes(enpg.enpgsFromQuantized(comb, combQ)[0])
+    results['enpg.enpgToImage'] = timeCall(lambda: enpg.enpgToImage(enpgData), repeat)
+
+    compressed = ndspy.lz10.compress(enpgData)
+    results['ndspy.lz10.compress'] = timeCall(lambda: ndspy.lz10.compress(enpgData), repeat)
+    results['lz77.LZ77_Compress'] = timeCall(lambda: lz77.LZ77_Compress(enpgData), repeat)
+    results['lz77.LZ77_Decompress'] = timeCall(lambda: lz77.LZ77_Decompress(compressed), repeat)
+
+    return results
+
+
+def measure(cmd, cwd):
+    """
+    Run a command, without its output. Return how long it took, and its
+    peak memory use in MB (or None, where that can't be measured).
+    """
+    try:
+        import resource
+    except ImportError:
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        return time.perf_counter() - start, None
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        resultFn = os.path.join(tempDir, 'measure.json')
+        subprocess.run([sys.executable, '-c', MEASURE_SCRIPT, resultFn] + cmd, cwd=cwd,
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(resultFn, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+    if result['returncode']:
+        raise subprocess.CalledProcessError(result['returncode'], cmd)
+
+    # ru_maxrss is in KB, except on macOS, where it's in bytes
+    maxrss = result['maxrss'] / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return result['seconds'], maxrss
+
+
+def runCompiler(workDir, script, args):
+    """
+    Run one of the compilers in workDir, with a report. Return what
+    measure() measured, along with the report's stage times and
+    counters.
+    """
+    reportFn = os.path.join(workDir, 'benchmark-report.json')
+    seconds, peakRss = measure([sys.executable, script, '--report', reportFn] + args, workDir)
+    with open(reportFn, 'r', encoding='utf-8') as f:
+        report = json.load(f)
+    return {
+        'seconds': seconds,
+        'peakRssMB': peakRss,
+        'stages': {name: stage['self'] for name, stage in report['stages'].items()},
+        'counters': report['counters'],
+        }
+
+
+def endToEndBenchmarks(makeSyntheticConfig, levelCounts, themes, jobs):
+    """
+    Run graphics-compiler.py from scratch on a synthetic config with each
+    number of levels, and then compile-ts-graphics.py on the last ROM
+    that made. Return {name: runCompiler() results}.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    tsDir = os.path.join(os.path.dirname(here), 'TitleScreenCompiler')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tempDir:
+        for levels in levelCounts:
+            # A fresh copy each time, so that no caches carry over
+            workDir = os.path.join(tempDir, 'LevelPreviewCompiler')
+            shutil.rmtree(workDir, ignore_errors=True)
+            shutil.copytree(here, workDir, ignore=COPY_IGNORE)
+            for folder in OUTPUT_DIRS:
+                os.mkdir(os.path.join(workDir, folder))
+            shutil.copyfile(ROM_FN, os.path.join(workDir, ROM_FN))
+            makeSyntheticConfig.makeConfig(levels, themes, workDir)
+
+            name = f'graphics-compiler.py ({levels} levels, {themes} themes, {jobs} jobs)'
+            print(f'Running {name}...')
+            results[name] = runCompiler(workDir, 'graphics-compiler.py', ['--jobs', str(jobs)])
+
+        # The title screen compiler uses modules from the level preview
+        # compiler's folder, so it goes next to the last copy of that
+        tsWorkDir = os.path.join(tempDir, 'TitleScreenCompiler')
+        shutil.copytree(tsDir, tsWorkDir, ignore=COPY_IGNORE)
+        for folder in OUTPUT_DIRS[1:]:
+            os.makedirs(os.path.join(tsWorkDir, folder), exist_ok=True)
+        shutil.copyfile(os.path.join(workDir, 'Newer Super Mario Bros. DS.nds'),
+                        os.path.join(tsWorkDir, 'Newer Super Mario Bros. DS.nds'))
+
+        name = 'compile-ts-graphics.py'
+        print(f'Running {name}...')
+        results[name] = runCompiler(tsWorkDir, 'compile-ts-graphics.py', [])
+
+    return results
+
+
+def gitCommit():
+    """
+    Return the current commit's hash (or None, outside of git).
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(old, new):
+    """
+    Print how each benchmark changed since the old results, and return
+    the number of regressions. Micro benchmarks are compared by their
+    best times, which vary the least from run to run.
+    """
+    print(f'Compared to {old.get("commit") or "unknown commit"}:')
+    regressions = 0
+
+    def compare(name, oldValue, newValue, unit):
+        nonlocal regressions
+        if not oldValue or newValue is None:
+            return
+        ratio = newValue / oldValue
+        flag = ''
+        if ratio > REGRESSION_THRESHOLD:
+            flag = '  <-- REGRESSION'
+            regressions += 1
+        print(f'    {name:<64}{oldValue:>10.4g}{unit} -> {newValue:.4g}{unit} ({ratio:.2f}x){flag}')
+
+    for name, result in new['micro'].items():
+        if name in old.get('micro', {}):
+            compare(name, old['micro'][name]['min'], result['min'], 's')
+    for name, result in new['endToEnd'].items():
+        if name in old.get('endToEnd', {}):
+            compare(name, old['endToEnd'][name]['seconds'], result['seconds'], 's')
+            compare(name + ' peak RSS', old['endToEnd'][name]['peakRssMB'], result['peakRssMB'], 'MB')
+
+    print(f'{regressions} regressions (more than {REGRESSION_THRESHOLD:.2f}x)')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the level preview and title screen compilers.')
+    parser.add_argument('--out', metavar='FILE',
+        help='file to save the results to (default: benchmark-<commit>.json)')
+    parser.add_argument('--compare', metavar='FILE',
+        help='results from another run to compare against')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of times to repeat each micro benchmark (default: 5)')
+    parser.add_argument('--levels', default='10,40',
+        help='comma-separated numbers of levels for the end-to-end runs (default: 10,40)')
+    parser.add_argument('--themes', type=int, default=4,
+        help='number of themes in the synthetic configs (default: 4)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='--jobs for graphics-compiler.py in the end-to-end runs (default: 1)')
+    parser.add_argument('--skip-micro', action='store_true',
+        help="don't run the micro benchmarks")
+    parser.add_argument('--skip-end-to-end', action='store_true',
+        help="don't run the compilers")
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication([])
+
+    commit = gitCommit()
+    results = {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'micro': {},
+        'endToEnd': {},
+        }
+
+    if not args.skip_micro:
+        compiler = loadScript('graphics-compiler.py', 'graphics_compiler')
+        results['micro'] = microBenchmarks(compiler, args.repeat)
+        for name, result in results['micro'].items():
+            print(f'{name:<40}{result["median"] * 1000:>10.3f}ms (best {result["min"] * 1000:.3f}ms)')
+
+    if not args.skip_end_to_end:
+        if not os.path.isfile(ROM_FN):
+            print(f'Skipping the end-to-end runs: "{ROM_FN}" is missing')
+        else:
+            makeSyntheticConfig = loadScript('make-synthetic-config.py', 'make_synthetic_config')
+            levelCounts = [int(n) for n in args.levels.split(',')]
+            results['endToEnd'] = endToEndBenchmarks(makeSyntheticConfig, levelCounts, args.themes, args.jobs)
+            for name, result in results['endToEnd'].items():
+                peakRss = 'unknown' if result['peakRssMB'] is None else f'{result["peakRssMB"]:.0f} MB'
+                print(f'{name}: {result["seconds"]:.2f}s, peak RSS {peakRss}')
+
+    outFn = args.out or f'benchmark-{commit[:8] if commit else "results"}.json'
+    with open(outFn, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    print(f'Saved the results to "{outFn}"')
+
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compareResults(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Newer DS build cache for the level preview compiler
+
+# Every image pair (a main and aux image, for either screen) is keyed by
+# a hash of everything that goes into it. After a pair is made, all of
+# its output files are copied into a cache entry for that key, so the
+# next run can copy them back out instead of rendering the pair again.
+# The manifest records which entries the last build used; the rest are
+# deleted.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from PyQt5 import QtGui
+
+from textcache import fileHash, makeKey
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'build')
+MANIFEST_FN = os.path.join(CACHE_DIR, 'manifest.json')
+
+TEMP_PREFIX = '.tmp'
+
+# Output folder -> file extension, for every file made for each image
+OUTPUT_DIRS = {
+    'out-png': '.png',
+    'out-enpg': '.enpg',
+    'out-enpg-lz': '.enpg',
+    'out-enpg-png': '.png',
+    }
+COMPRESSED_DIR = 'out-enpg-lz'
+
+
+def dirHash(path):
+    """
+    Return a hash of the names and contents of all files in a folder.
+    """
+    return makeKey(files={fn: fileHash(os.path.join(path, fn))
+                          for fn in sorted(os.listdir(path))
+                          if os.path.isfile(os.path.join(path, fn))})
+
+
+def fontHash(font):
+    """
+    Return a hash identifying the font file Qt actually uses for a QFont
+    (which may not be the one asked for, if it isn't installed).
+    A QGuiApplication has to exist already.
+    """
+    raw = QtGui.QRawFont.fromFont(font)
+    # The "head" table has a checksum of the whole font file in it
+    head = bytes(raw.fontTable('head'))
+    return makeKey(
+        family=raw.familyName(),
+        style=raw.styleName(),
+        head=hashlib.sha256(head).hexdigest(),
+        )
+
+
+def load(key, fns):
+    """
+    If there's a cache entry for this key, copy its files into the
+    output folders under the given names (one per image) and return the
+    compressed ENPGs. Otherwise, return None.
+    """
+    entry = os.path.join(CACHE_DIR, key)
+    if not os.path.isdir(entry):
+        return None
+
+    for folder, ext in OUTPUT_DIRS.items():
+        for i, fn in enumerate(fns):
+            shutil.copyfile(os.path.join(entry, f'{i}{folder}{ext}'),
+                            os.path.join(folder, fn + ext))
+
+    compressed = []
+    for fn in fns:
+        with open(os.path.join(COMPRESSED_DIR, fn + OUTPUT_DIRS[COMPRESSED_DIR]), 'rb') as f:
+            compressed.append(f.read())
+    return compressed
+
+
+def save(key, fns):
+    """
+    Copy the output files with the given names (one per image) into the
+    cache entry for this key.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # Fill a temp folder first so that nothing ever sees a partial entry
+    tempDir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=CACHE_DIR)
+    for folder, ext in OUTPUT_DIRS.items():
+        for i, fn in enumerate(fns):
+            shutil.copyfile(os.path.join(folder, fn + ext),
+                            os.path.join(tempDir, f'{i}{folder}{ext}'))
+
+    try:
+        os.rename(tempDir, os.path.join(CACHE_DIR, key))
+    except OSError:
+        # Another entry for the same key got there first; they're the same
+        shutil.rmtree(tempDir)
+
+
+def saveManifest(manifest):
+    """
+    Save the manifest (a dict of output filename -> cache key) for this
+    build, and delete every cache entry it doesn't use.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(MANIFEST_FN, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+    keys = set(manifest.values())
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_dir() and entry.name not in keys:
+            shutil.rmtree(entry.path, ignore_errors=True)
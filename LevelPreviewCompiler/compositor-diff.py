@@ -0,0 +1,76 @@
+# Newer DS Compositor Comparison
+# Makes the intro graphics for some levels with both the Qt and array
+# compositors, and checks that they're pixel-for-pixel the same.
+
+import argparse
+import collections
+import importlib.util
+import json
+import time
+
+import numpy
+from PyQt5 import QtGui
+
+import imagebridge
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the array compositor against Qt.')
+    parser.add_argument('--limit', type=int, default=None,
+        help='only use the first N levels in config.json')
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication([])
+
+    spec = importlib.util.spec_from_file_location('graphics_compiler', 'graphics-compiler.py')
+    compiler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(compiler)
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f, object_pairs_hook=collections.OrderedDict)
+    levels = list(config['levels'].items())[:args.limit]
+
+    resources = {name: compiler.loadResources(name) for name in ['qt', 'array']}
+    times = {name: 0 for name in resources}
+
+    def compare(description, make):
+        # Render once first, so that any text is in the text cache and
+        # doesn't count towards either time
+        make(resources['array'])
+
+        images = {}
+        for name, res in resources.items():
+            start = time.perf_counter()
+            images[name] = make(res)
+            times[name] += time.perf_counter() - start
+
+        for which, qtImg, arrayImg in zip(['main', 'aux'], images['qt'], images['array']):
+            diff = imagebridge.argbArray(qtImg) != imagebridge.argbArray(arrayImg)
+            status = 'OK' if not diff.any() else f'{numpy.count_nonzero(diff)} pixels differ'
+            print(f'{description} ({which}): {status}')
+
+    bottoms = []
+    for levelName, levelConfig in levels:
+        theme = config['themes'][levelConfig['theme']]
+        colors = {key: compiler.hex2QColor(theme[key])
+                  for key in ['background1', 'background2', 'banner1', 'banner2']}
+        compare(levelName, lambda res: compiler.makeTopScreenIntroGraphics(
+            resources = res,
+            title = levelConfig.get('title'),
+            name = levelConfig.get('name'),
+            preview = res['Pixmap']('previews/' + levelConfig['preview']),
+            **colors))
+
+        if (levelConfig['theme'], levelConfig['bottom']) not in bottoms:
+            bottoms.append((levelConfig['theme'], levelConfig['bottom']))
+            compare(f'{levelConfig["bottom"]} with the "{levelConfig["theme"]}" theme',
+                lambda res: compiler.makeBottomScreenIntroGraphics(
+                    resources = res,
+                    icon = res['Pixmap']('bottoms/' + levelConfig['bottom']),
+                    **colors))
+
+    print(f'Total time: Qt {times["qt"]:.2f}s, array {times["array"]:.2f}s')
+
+
+main()
@@ -0,0 +1,221 @@
+# Newer DS array compositor for the level preview compiler
+
+# A stand-in for the small part of QPixmap and QPainter that the intro
+# graphics are made with, working on NumPy arrays instead. It doesn't
+# need a QGuiApplication (or a display), so only text rendering still
+# does. The arithmetic is the same as Qt's raster paint engine, down to
+# the rounding, so the results are identical (see compositor-diff.py).
+
+# Pixels are premultiplied ARGB, one uint32 each, exactly like
+# QImage.Format_ARGB32_Premultiplied.
+
+import numpy
+from PyQt5 import QtCore, QtGui; Qt = QtCore.Qt
+
+import imagebridge
+
+
+def byteMul(x, a):
+    """
+    Multiply each channel of some premultiplied ARGB pixels by a / 255,
+    the way Qt does it (BYTE_MUL()).
+    """
+    a = numpy.asarray(a, numpy.uint32)
+    t = (x & 0xFF00FF) * a
+    t = ((t + ((t >> 8) & 0xFF00FF) + 0x800080) >> 8) & 0xFF00FF
+    x = ((x >> 8) & 0xFF00FF) * a
+    x = (x + ((x >> 8) & 0xFF00FF) + 0x800080) & 0xFF00FF00
+    return x | t
+
+
+def div255(x):
+    """
+    Divide by 255, rounding like Qt does (qt_div_255()).
+    """
+    return (x + (x >> 8) + 0x80) >> 8
+
+
+def premultiply(argb):
+    """
+    Premultiply a non-premultiplied ARGB color (qPremultiply()).
+    """
+    a = argb >> 24
+    return int(byteMul(numpy.uint32(argb & 0xFFFFFF), a)) | (a << 24)
+
+
+def compositeSourceOver(dest, src):
+    return numpy.where(src >= 0xFF000000, src, src + byteMul(dest, 255 - (src >> 24)))
+
+
+def compositeSource(dest, src):
+    return src
+
+
+def compositeDestinationIn(dest, src):
+    return byteMul(dest, src >> 24)
+
+
+def compositeDestinationOut(dest, src):
+    return byteMul(dest, 255 - (src >> 24))
+
+
+def compositeHardLight(dest, src):
+    da = (dest >> 24).astype(numpy.int32)
+    sa = (src >> 24).astype(numpy.int32)
+
+    result = (255 - div255((255 - sa) * (255 - da))).astype(numpy.uint32) << 24
+    for shift in [16, 8, 0]:
+        d = ((dest >> shift) & 0xFF).astype(numpy.int32)
+        s = ((src >> shift) & 0xFF).astype(numpy.int32)
+        temp = s * (255 - da) + d * (255 - sa)
+        c = numpy.where(2 * s < sa,
+            div255(2 * s * d + temp),
+            div255(sa * da - 2 * (da - d) * (sa - s) + temp))
+        result |= c.astype(numpy.uint32) << shift
+    return result
+
+
+COMPOSITION_MODES = {
+    QtGui.QPainter.CompositionMode_SourceOver: compositeSourceOver,
+    QtGui.QPainter.CompositionMode_Source: compositeSource,
+    QtGui.QPainter.CompositionMode_DestinationIn: compositeDestinationIn,
+    QtGui.QPainter.CompositionMode_DestinationOut: compositeDestinationOut,
+    QtGui.QPainter.CompositionMode_HardLight: compositeHardLight,
+    }
+
+
+class Pixmap:
+    """
+    An image that can be painted on with a Painter: Pixmap(w, h),
+    Pixmap(filename) or Pixmap(otherPixmap).
+    """
+    def __init__(self, *args):
+        if len(args) == 2:
+            w, h = args
+            self.pixels = numpy.zeros((h, w), numpy.uint32)
+        elif isinstance(args[0], str):
+            self.pixels = Pixmap.fromImage(QtGui.QImage(args[0])).pixels
+        else:
+            self.pixels = args[0].pixels.copy()
+
+    @staticmethod
+    def fromImage(img):
+        """
+        Convert a QImage (or QPixmap) to a Pixmap.
+        """
+        img = imagebridge.toQImage(img).convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+        pix = Pixmap(0, 0)
+        pix.pixels = imagebridge.qImageBits(img).view(numpy.uint32)[:, :img.width()].copy()
+        return pix
+
+    def toImage(self):
+        """
+        Convert the Pixmap to a QImage.
+        """
+        h, w = self.pixels.shape
+        img = QtGui.QImage(self.pixels.tobytes(), w, h, 4 * w, QtGui.QImage.Format_ARGB32_Premultiplied)
+        # QImage doesn't keep the buffer alive, so detach it
+        return img.copy()
+
+    def width(self):
+        return self.pixels.shape[1]
+
+    def height(self):
+        return self.pixels.shape[0]
+
+    def fill(self, color):
+        self.pixels[:] = premultiply(QtGui.QColor(color).rgba())
+
+    def copy(self, x=0, y=0, w=None, h=None):
+        """
+        Return a copy of part of the Pixmap (or all of it). Like
+        QPixmap.copy(), the part is cut down to fit inside the Pixmap.
+        """
+        if w is None: w = self.width() - x
+        if h is None: h = self.height() - y
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + w, self.width()), min(y + h, self.height())
+        pix = Pixmap(0, 0)
+        pix.pixels = self.pixels[y1:max(y1, y2), x1:max(x1, x2)].copy()
+        return pix
+
+    def save(self, fn):
+        return self.toImage().save(fn)
+
+
+def asPixmap(img):
+    """
+    Return img as a Pixmap, if it's a QImage or QPixmap.
+    """
+    if isinstance(img, Pixmap):
+        return img
+    return Pixmap.fromImage(img)
+
+
+class Painter:
+    """
+    Paints on a Pixmap, like a QPainter. Only solid brushes (and no
+    pens) are supported.
+    """
+    CompositionMode_SourceOver = QtGui.QPainter.CompositionMode_SourceOver
+    CompositionMode_Source = QtGui.QPainter.CompositionMode_Source
+    CompositionMode_DestinationIn = QtGui.QPainter.CompositionMode_DestinationIn
+    CompositionMode_DestinationOut = QtGui.QPainter.CompositionMode_DestinationOut
+    CompositionMode_HardLight = QtGui.QPainter.CompositionMode_HardLight
+
+    def __init__(self, pixmap):
+        self.pixmap = pixmap
+        self.brush = None
+        self.mode = self.CompositionMode_SourceOver
+        self.savedModes = []
+
+    def setPen(self, pen):
+        if pen != Qt.NoPen:
+            raise ValueError('Only Qt.NoPen is supported')
+
+    def setBrush(self, color):
+        self.brush = premultiply(QtGui.QColor(color).rgba())
+
+    def setCompositionMode(self, mode):
+        if mode not in COMPOSITION_MODES:
+            raise ValueError(f'Unsupported composition mode: {mode}')
+        self.mode = mode
+
+    def save(self):
+        self.savedModes.append(self.mode)
+
+    def restore(self):
+        self.mode = self.savedModes.pop()
+
+    def composite(self, x, y, src):
+        """
+        Composite a 2D array of pixels onto the Pixmap at (x, y), clipped
+        to its edges.
+        """
+        dest = self.pixmap.pixels
+        h, w = src.shape
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + w, dest.shape[1]), min(y + h, dest.shape[0])
+        if x1 >= x2 or y1 >= y2:
+            return
+
+        src = src[y1 - y:y2 - y, x1 - x:x2 - x]
+        region = dest[y1:y2, x1:x2]
+        region[:] = COMPOSITION_MODES[self.mode](region, src)
+
+    def drawRect(self, x, y, w, h):
+        self.composite(x, y, numpy.full((h, w), self.brush, numpy.uint32))
+
+    def drawPixmap(self, x, y, pixmap, sx=0, sy=0, sw=-1, sh=-1):
+        pixels = asPixmap(pixmap).pixels
+        if sw < 0: sw = pixels.shape[1] - sx
+        if sh < 0: sh = pixels.shape[0] - sy
+        self.composite(x, y, pixels[sy:sy + sh, sx:sx + sw])
+
+    drawImage = drawPixmap
+
+    def drawTiledPixmap(self, x, y, w, h, pixmap, sx=0, sy=0):
+        pixels = asPixmap(pixmap).pixels
+        rows = (sy + numpy.arange(h)) % pixels.shape[0]
+        cols = (sx + numpy.arange(w)) % pixels.shape[1]
+        self.composite(x, y, pixels[rows[:, None], cols])
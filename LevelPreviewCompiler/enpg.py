@@ -0,0 +1,75 @@
+# Newer DS ENPG encoding, shared by the level preview and title screen
+# compilers
+
+# ENPGs are 256x256 images: 256 * 256 palette indices, followed by a
+# 256-color RGB555 palette. Color 0 is always transparent.
+
+import struct
+
+import PIL.Image
+
+
+ENPG_SIZE = 256
+ENPG_LEN = ENPG_SIZE * ENPG_SIZE + 256 * 2
+
+
+def packPalette(pal888):
+    """
+    Convert a flat RGB888 palette (as returned by getpalette()) to the
+    RGB555 ENPG palette, with the transparent color in front.
+    """
+    shrink = lambda c: min((c + 4) >> 3, 0x1F) & 0x1F
+    colors = [0x8000]
+    for i in range(0, len(pal888) - 2, 3):
+        r, g, b = pal888[i:i + 3]
+        colors.append(shrink(b) << 10 | shrink(g) << 5 | shrink(r))
+    colors.extend([0] * (256 - len(colors)))
+    return struct.pack('<256H', *colors)
+
+
+def enpgsFromQuantized(comb, combQ):
+    """
+    Split a horizontal strip of 256x256 images into ENPGs. comb is the
+    original RGBA strip, and combQ is its quantized version, with at
+    most 255 colors.
+    Pixels that aren't fully opaque in comb become transparent.
+    """
+    # Shift all the color indices up by one to make room for the
+    # transparent color, and then put that wherever comb isn't opaque
+    indices = PIL.Image.frombytes('L', combQ.size, combQ.tobytes())
+    indices = indices.point(lambda i: i + 1)
+    opaque = comb.getchannel('A').point(lambda a: 255 if a == 255 else 0)
+    indices = PIL.Image.composite(indices, PIL.Image.new('L', comb.size, 0), opaque)
+
+    palette = packPalette(combQ.getpalette()[:255 * 3])
+
+    enpgs = []
+    for x in range(0, comb.width, ENPG_SIZE):
+        plane = indices.crop((x, 0, x + ENPG_SIZE, ENPG_SIZE)).tobytes()
+        enpgs.append(bytearray(plane + palette))
+    return enpgs
+
+
+# 5-bit to 8-bit color channel values
+EXPAND_5_BIT = [min(int(c * 0xFF / 0x1F), 255) for c in range(0x20)]
+
+
+def enpgToImage(data):
+    """
+    Render an ENPG as an RGBA PIL Image. data can be anything that
+    supports the buffer protocol, such as a memoryview into a larger
+    buffer; it isn't copied.
+    """
+    data = memoryview(data).cast('B')
+    colors = struct.unpack_from('<256H', data, ENPG_SIZE * ENPG_SIZE)
+
+    # One lookup table per channel, indexed by palette index
+    luts = [[], [], [], []]
+    for rgb555 in colors:
+        luts[0].append(EXPAND_5_BIT[rgb555 & 0x1F])
+        luts[1].append(EXPAND_5_BIT[(rgb555 >> 5) & 0x1F])
+        luts[2].append(EXPAND_5_BIT[(rgb555 >> 10) & 0x1F])
+        luts[3].append(0 if rgb555 >> 15 else 255)
+
+    indices = PIL.Image.frombytes('L', (ENPG_SIZE, ENPG_SIZE), data[:ENPG_SIZE * ENPG_SIZE])
+    return PIL.Image.merge('RGBA', [indices.point(lut) for lut in luts])
@@ -0,0 +1,109 @@
+# Newer DS Glyph Atlas Comparison
+# Makes the top-screen intro graphics for some levels with text drawn
+# from the glyph atlas and with QStaticText, and checks that they're
+# pixel-for-pixel the same. With --font, another installed font is
+# used instead of the real one, and its atlas is only kept in memory, so
+# the atlas can be checked on machines without the real font.
+
+import argparse
+import collections
+import importlib.util
+import json
+import tempfile
+import time
+
+import numpy
+from PyQt5 import QtGui
+
+import glyphatlas
+import imagebridge
+import instrument
+import textcache
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare text drawn from the glyph atlas against Qt.')
+    parser.add_argument('--limit', type=int, default=None,
+        help='only use the first N levels in config.json')
+    parser.add_argument('--font', metavar='FAMILY',
+        help="use this installed font (at the real font's size) instead of the real one, and don't save its atlas")
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication([])
+
+    spec = importlib.util.spec_from_file_location('graphics_compiler', 'graphics-compiler.py')
+    compiler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(compiler)
+
+    with open('config.json', 'r', encoding='utf-8') as f:
+        config = json.load(f, object_pairs_hook=collections.OrderedDict)
+    levels = list(config['levels'].items())[:args.limit]
+
+    chars = ''.join((levelConfig.get('title') or '') + (levelConfig.get('name') or '')
+                    for _, levelConfig in levels)
+    if args.font is None:
+        atlas = glyphatlas.updateAtlas(QtGui.QFont(*compiler.FONT_NAME), chars)
+    else:
+        compiler.FONT_NAME = (args.font,) + tuple(compiler.FONT_NAME[1:])
+        font = QtGui.QFont(*compiler.FONT_NAME)
+        if not glyphatlas.fontIsInstalled(font):
+            print(f'"{args.font}" isn\'t installed')
+            return
+        atlas = glyphatlas.GlyphAtlas.build(font, chars)
+
+    if atlas is None:
+        print("There's no glyph atlas, and the font isn't installed to make one")
+        return
+
+    resources = {name: compiler.loadResources() for name in ['qt', 'atlas']}
+    resources['qt']['glyphAtlas'] = None
+    resources['atlas']['glyphAtlas'] = atlas
+    times = {name: 0 for name in resources}
+    outlineTimes = {name: 0 for name in resources}
+    outlined = fromGlyphs = 0
+    differing = 0
+
+    # Time the outline stage too, which the atlas mostly skips
+    instrument.configure(True)
+
+    # Use an empty text cache, so that everything really gets rendered
+    with tempfile.TemporaryDirectory() as cacheDir:
+        textcache.CACHE_DIR = cacheDir
+
+        for levelName, levelConfig in levels:
+            theme = config['themes'][levelConfig['theme']]
+
+            images = {}
+            for name, res in resources.items():
+                start = time.perf_counter()
+                images[name] = compiler.makeTopScreenIntroGraphics(
+                    resources = res,
+                    title = levelConfig.get('title'),
+                    name = levelConfig.get('name'),
+                    background1 = compiler.hex2QColor(theme['background1']),
+                    background2 = compiler.hex2QColor(theme['background2']),
+                    banner1 = compiler.hex2QColor(theme['banner1']),
+                    banner2 = compiler.hex2QColor(theme['banner2']),
+                    preview = res['Pixmap']('previews/' + levelConfig['preview']),
+                    )
+                times[name] += time.perf_counter() - start
+                stats = instrument.takeStats()
+                outlineTimes[name] += stats['stages'].get('outline', (0, 0, 0))[1]
+                if name == 'atlas':
+                    outlined += stats['stages'].get('outline', (0, 0, 0))[0]
+                    fromGlyphs += stats['counters'].get('outlines made from glyphs', 0)
+
+            for which, qtImg, atlasImg in zip(['main', 'aux'], images['qt'], images['atlas']):
+                diff = imagebridge.argbArray(qtImg) != imagebridge.argbArray(atlasImg)
+                status = 'OK' if not diff.any() else f'{numpy.count_nonzero(diff)} pixels differ'
+                differing += bool(diff.any())
+                print(f'{levelName} ({which}): {status}')
+
+    print(f'{2 * len(levels) - differing} of {2 * len(levels)} images match')
+    print(f'Total time: Qt {times["qt"]:.2f}s, atlas {times["atlas"]:.2f}s')
+    print(f'Outline time: Qt {outlineTimes["qt"]:.2f}s, atlas {outlineTimes["atlas"]:.2f}s'
+          f' ({fromGlyphs} of {outlined} texts outlined one glyph at a time)')
+
+
+main()
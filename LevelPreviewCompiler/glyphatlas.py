@@ -0,0 +1,413 @@
+# Newer DS glyph atlas for the level preview compiler
+
+# Level names are drawn with a big, non-antialiased font, which Qt fills
+# as one path per run of text (it's too big for its glyph cache). The
+# atlas keeps each glyph's outline along with the metrics Qt lays text
+# out with (advances, right bearings and kerning), so text can be laid
+# out and filled exactly like QStaticText does it, without the font
+# installed or a QGuiApplication.
+
+# Glyphs can't simply be kept as bitmaps: Qt places them at 1/64-pixel
+# positions, and FreeType's quadratic curves are turned into cubic ones
+# *after* moving them into place, which rounds differently depending on
+# where exactly a glyph ends up. So the atlas keeps the quadratic curves
+# and does the same conversion Qt does (QFreetypeFace::addGlyphToPath()).
+
+# Text is outlined by dilating it (see outline.py), which only depends
+# on what's near each pixel, so the outline of a line of text is the
+# union of the outlines of its glyphs. The atlas makes each glyph's fill
+# and outline once per 1/64-pixel position it's drawn at, and then just
+# copies them into place, instead of dilating the whole image for every
+# line of text. Qt occasionally fills a glyph a pixel differently at a
+# different position, so the glyphs are checked against the text Qt
+# really drew, and if they don't match, the whole image is dilated after
+# all. (The shadow can't be split up like that, since it's a blur of
+# everything together.)
+
+# The atlas is made from the installed font the first time it's needed
+# (or when characters it doesn't have show up in config.json), and saved
+# as ATLAS_FN. Only a machine that already has that file can build
+# without the font; none is in the repository.
+
+import json
+import math
+import os
+import string
+
+import numpy
+from PyQt5 import QtCore, QtGui; Qt = QtCore.Qt
+
+from buildcache import fontHash
+from imagebridge import alphaPlane
+import instrument
+import outline
+from textcache import makeKey
+
+
+ATLAS_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glyph-atlas.json')
+
+# Characters that always go into a new atlas, besides the ones asked for
+BASIC_CHARS = string.ascii_letters + string.digits + string.punctuation + ' '
+
+# QStaticText treats these as markup, which the atlas doesn't do
+MARKUP_CHARS = '<&'
+
+
+def outlineFromPath(path):
+    """
+    Convert a glyph path from QRawFont.pathForGlyph() to a list of
+    elements: ['M', x, y], ['L', x, y], ['Q', qx, qy, x, y] (a quadratic
+    curve that Qt converted to a cubic one) or ['C', x1, y1, x2, y2, x, y].
+    """
+    elements = []
+    x0 = y0 = 0
+    i = 0
+    while i < path.elementCount():
+        e = path.elementAt(i)
+        if e.type == QtGui.QPainterPath.MoveToElement:
+            elements.append(['M', e.x, e.y])
+        elif e.type == QtGui.QPainterPath.LineToElement:
+            elements.append(['L', e.x, e.y])
+        else:
+            c1, c2, c3 = e, path.elementAt(i + 1), path.elementAt(i + 2)
+            i += 2
+
+            # FreeType coordinates are in 1/64ths of a pixel, so the
+            # quadratic control point (if there is one) can be recovered
+            # exactly
+            qx = round((3 * c1.x - x0) / 2 * 64) / 64
+            qy = round((3 * c1.y - y0) / 2 * 64) / 64
+            if ((2 * qx + x0) / 3, (2 * qy + y0) / 3) == (c1.x, c1.y) and \
+                    ((2 * qx + c3.x) / 3, (2 * qy + c3.y) / 3) == (c2.x, c2.y):
+                elements.append(['Q', qx, qy, c3.x, c3.y])
+            else:
+                elements.append(['C', c1.x, c1.y, c2.x, c2.y, c3.x, c3.y])
+            e = c3
+
+        x0, y0 = e.x, e.y
+        i += 1
+
+    return elements
+
+
+def addOutlineToPath(path, elements, x, y):
+    """
+    Add a glyph outline from outlineFromPath() to a QPainterPath, with
+    its origin at (x, y).
+    """
+    for e in elements:
+        if e[0] == 'M':
+            x0, y0 = x + e[1], y + e[2]
+            path.moveTo(x0, y0)
+            continue
+        elif e[0] == 'L':
+            x0, y0 = x + e[1], y + e[2]
+            path.lineTo(x0, y0)
+            continue
+        elif e[0] == 'Q':
+            qx, qy = x + e[1], y + e[2]
+            x3, y3 = x + e[3], y + e[4]
+            x1, y1 = (2 * qx + x0) / 3, (2 * qy + y0) / 3
+            x2, y2 = (2 * qx + x3) / 3, (2 * qy + y3) / 3
+        else:
+            x1, y1 = x + e[1], y + e[2]
+            x2, y2 = x + e[3], y + e[4]
+            x3, y3 = x + e[5], y + e[6]
+        path.cubicTo(x1, y1, x2, y2, x3, y3)
+        x0, y0 = x3, y3
+
+
+def fontIsInstalled(font):
+    """
+    Check whether the font family asked for is really installed (Qt
+    silently substitutes another one if it isn't). A QGuiApplication
+    has to exist already.
+    """
+    return font.family() in QtGui.QFontDatabase().families()
+
+
+class GlyphAtlas:
+    """
+    Glyph outlines and metrics for one font.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.hash = makeKey(**data)
+        self.ascent = data['ascent']
+        self.height = data['height']
+        self.glyphs = data['glyphs']
+        self.kerning = data['kerning']
+        self.ligatures = set(data['ligatures'])
+        # {(character, 1/64-pixel phase, outline radius): glyphMasks() result}
+        self.masks = {}
+
+    @staticmethod
+    def build(font, chars):
+        """
+        Make an atlas for a QFont, with (at least) the characters given.
+        A QGuiApplication has to exist already.
+        """
+        font = QtGui.QFont(font)
+        font.setStyleStrategy(font.NoAntialias)
+        raw = QtGui.QRawFont.fromFont(font)
+        metrics = QtGui.QFontMetricsF(font)
+
+        # Characters the font doesn't have would be drawn from a
+        # fallback font, so leave them out
+        chars = sorted(set(chars) | set(BASIC_CHARS))
+        missing = [c for c in chars if not raw.supportsCharacter(c)]
+        chars = [c for c in chars if raw.supportsCharacter(c)]
+
+        glyphs = {}
+        for c in chars:
+            glyphs[c] = {
+                'advance': metrics.horizontalAdvance(c),
+                'rightBearing': metrics.rightBearing(c),
+                'outline': outlineFromPath(raw.pathForGlyph(raw.glyphIndexesForString(c)[0])),
+                }
+
+        kerning = {}
+        ligatures = []
+        for a in chars:
+            for b in chars:
+                pair = a + b
+
+                # The atlas can only draw pairs that are shaped into
+                # the same glyphs as the characters on their own
+                layout = QtGui.QTextLayout(pair, font)
+                layout.beginLayout()
+                layout.createLine()
+                layout.endLayout()
+                shaped = [i for run in layout.glyphRuns() for i in run.glyphIndexes()]
+                if shaped != raw.glyphIndexesForString(pair):
+                    ligatures.append(pair)
+                    continue
+
+                kern = (metrics.horizontalAdvance(pair)
+                        - glyphs[a]['advance'] - glyphs[b]['advance'])
+                if kern:
+                    kerning[pair] = kern
+
+        # Every line QStaticText lays out is this tall, whatever is on it
+        st = QtGui.QStaticText('')
+        st.prepare(QtGui.QTransform(), font)
+
+        return GlyphAtlas({
+            'font': [font.family(), font.pointSize()],
+            'fontHash': fontHash(font),
+            'ascent': metrics.ascent(),
+            'height': st.size().height(),
+            'glyphs': glyphs,
+            'missing': missing,
+            'kerning': kerning,
+            'ligatures': ligatures,
+            })
+
+    @staticmethod
+    def load(fn=ATLAS_FN):
+        """
+        Load an atlas from a file, or return None if there isn't one.
+        """
+        try:
+            with open(fn, 'r', encoding='utf-8') as f:
+                return GlyphAtlas(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def save(self, fn=ATLAS_FN):
+        # Write to a temp file first so that nothing ever sees a partial
+        # atlas
+        tempFn = fn + '.tmp'
+        with open(tempFn, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tempFn, fn)
+
+    def isFor(self, fontName):
+        """
+        Check whether the atlas was made from the font with this
+        (family, point size). Doesn't need Qt.
+        """
+        return self.data['font'] == list(fontName)
+
+    def hasChars(self, chars):
+        """
+        Check whether every character given is either in the atlas, or
+        known not to be in the font.
+        """
+        return set(chars) <= set(self.glyphs) | set(self.data['missing'])
+
+    def canRender(self, runs):
+        """
+        Check whether a line of text can be drawn from the atlas. runs is
+        a list of (text, color), as for layout().
+        """
+        for text, color in runs:
+            for c in text:
+                if c not in self.glyphs or c in MARKUP_CHARS:
+                    return False
+                if c.isspace() and c != ' ':
+                    return False
+            for a, b in zip(text, text[1:]):
+                if a + b in self.ligatures:
+                    return False
+        return True
+
+    def layout(self, runs):
+        """
+        Lay out one line of text the way QStaticText lays out the
+        equivalent rich text. runs is a list of (text, color), one per
+        <span>. Return the laid-out runs as a list of (color, [(character,
+        x), ...]), and the width QStaticText.size() would report.
+        """
+        laidOut = []
+        x = 0
+        last = None
+        for text, color in runs:
+            # Whitespace is collapsed like in HTML
+            chars = []
+            for c in text:
+                if c == ' ' and last in [None, ' ']:
+                    continue
+                chars.append(c)
+                last = c
+
+            # Each span is shaped separately, so there's no kerning
+            # between them
+            glyphs = []
+            for i, c in enumerate(chars):
+                glyphs.append((c, x))
+                x += self.glyphs[c]['advance']
+                if i + 1 < len(chars):
+                    x += self.kerning.get(c + chars[i + 1], 0)
+            laidOut.append((color, glyphs))
+
+        # The line is widened if the last glyph sticks out past its
+        # advance
+        if last is not None:
+            x += max(0, -self.glyphs[last]['rightBearing'])
+
+        return laidOut, x
+
+    def draw(self, painter, x, y, laidOut):
+        """
+        Draw a line of text from layout() with a QPainter, with its
+        top-left corner at (x, y). The result is the same as drawing the
+        line with QStaticText.
+        """
+        painter.save()
+        painter.setPen(Qt.NoPen)
+        for color, glyphs in laidOut:
+            # Like Qt, fill each run as one path
+            path = QtGui.QPainterPath()
+            path.setFillRule(Qt.WindingFill)
+            for c, glyphX in glyphs:
+                addOutlineToPath(path, self.glyphs[c]['outline'], x + glyphX, y + self.ascent)
+            painter.setBrush(QtGui.QColor(color))
+            painter.drawPath(path)
+        painter.restore()
+
+    def glyphMasks(self, c, phase, radius):
+        """
+        Return (x, y, fill, outline) for a glyph drawn with its origin
+        phase / 64 pixels right of a whole pixel, and its line's top at
+        that pixel. fill is the pixels the glyph covers and outline the
+        ones an outline of the given radius around it covers, as 2D
+        boolean arrays with their top-left corners at (x, y) relative to
+        that pixel. Each one is only made once.
+        """
+        key = (c, phase, radius)
+        if key in self.masks:
+            return self.masks[key]
+
+        path = QtGui.QPainterPath()
+        path.setFillRule(Qt.WindingFill)
+        addOutlineToPath(path, self.glyphs[c]['outline'], phase / 64, self.ascent)
+        if path.isEmpty():
+            empty = numpy.zeros((0, 0), bool)
+            self.masks[key] = (0, 0, empty, empty)
+            return self.masks[key]
+
+        # Leave room for the outline on every side
+        rect = path.boundingRect()
+        x = math.floor(rect.left()) - radius - 1
+        y = math.floor(rect.top()) - radius - 1
+        w = math.ceil(rect.right()) + radius + 2 - x
+        h = math.ceil(rect.bottom()) + radius + 2 - y
+
+        # Draw it relative to its own corner (outlineMask() checks that
+        # it's filled the same way as where it really ends up)
+        path = QtGui.QPainterPath()
+        path.setFillRule(Qt.WindingFill)
+        addOutlineToPath(path, self.glyphs[c]['outline'], phase / 64 - x, self.ascent - y)
+        img = QtGui.QImage(w, h, QtGui.QImage.Format_ARGB32_Premultiplied)
+        img.fill(Qt.transparent)
+        painter = QtGui.QPainter(img)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(Qt.white)
+        painter.drawPath(path)
+        del painter
+
+        fill = alphaPlane(img) > 0
+        self.masks[key] = (x, y, fill, outline.dilate(fill, outline.ellipseFootprint(radius)))
+        instrument.count('glyph outlines made')
+        return self.masks[key]
+
+    def outlineMask(self, fill, lines, radius):
+        """
+        Return the outline of lines of text drawn with draw(), as a 2D
+        boolean array like outline.dilate() returns, made from the
+        outlines of the glyphs instead of by dilating the whole image.
+        lines is a list of (x, y, laidOut), and fill is the pixels the
+        text covers in the image. If the glyphs' own pixels don't add up
+        to exactly fill (or some of them are cut off at the edges), this
+        returns None and fill has to be dilated after all.
+        """
+        h, w = fill.shape
+        covered = numpy.zeros((h, w), bool)
+        result = numpy.zeros((h, w), bool)
+
+
+        for x, y, laidOut in lines:
+            for color, glyphs in laidOut:
+                for c, glyphX in glyphs:
+                    # Glyphs are at 1/64-pixel positions
+                    whole = math.floor(glyphX)
+                    phase = round((glyphX - whole) * 64)
+                    whole, phase = whole + phase // 64, phase % 64
+                    maskX, maskY, glyphFill, glyphOutline = self.glyphMasks(c, phase, radius)
+                    if not glyphFill.size:
+                        continue
+
+                    left, top = x + whole + maskX, y + maskY
+                    right, bottom = left + glyphFill.shape[1], top + glyphFill.shape[0]
+                    if left < 0 or top < 0 or right > w or bottom > h:
+                        return None
+                    covered[top:bottom, left:right] |= glyphFill
+                    result[top:bottom, left:right] |= glyphOutline
+
+        if not numpy.array_equal(covered, fill):
+            return None
+        return result
+
+
+def updateAtlas(font, chars, fn=ATLAS_FN):
+    """
+    Make sure the atlas in fn is for this QFont and has all the
+    characters given, remaking it if needed (and possible: the font has
+    to be installed). Return the atlas, or None if there isn't one.
+    A QGuiApplication has to exist already.
+    """
+    atlas = GlyphAtlas.load(fn)
+    if not fontIsInstalled(font):
+        return atlas
+
+    if atlas is not None and atlas.isFor((font.family(), font.pointSize())) and atlas.data['fontHash'] == fontHash(font):
+        if atlas.hasChars(chars):
+            return atlas
+        # Keep the characters it already has
+        chars = set(chars) | set(atlas.glyphs)
+
+    print('Making the glyph atlas...')
+    atlas = GlyphAtlas.build(font, chars)
+    atlas.save(fn)
+    return atlas
@@ -1,82 +1,130 @@
 # 12/14/16, RoadrunnerWMC
 # Newer DS Level Intro Graphics Compiler
 
+import argparse
 import collections
-import io
-import itertools
+import functools
 import json
-import os
+import math
+import multiprocessing
+import re
 import struct
-import subprocess
 import sys
-import tempfile
 
-import libimagequant as liq  # pip install libimagequant
-import libimagequant_integrations.PIL  # pip install libimagequant-integrations
 import ndspy.lz10
-import ndspy.rom
+import numpy
 import PIL.Image
 from PyQt5 import QtCore, QtGui; Qt = QtCore.Qt
 
+import backgroundwriter
+import buildcache
+import compositor
+import enpg
+import glyphatlas
+import imagebridge
+import instrument
 import lz77
+import outline
+import quantize
+import rompatch
+import romreuse
+import shadow
+import textcache
+
+
+# LZ10 compression level for the files inserted into the ROM: 'greedy'
+# is fast, 'optimal' makes the files as small as possible but is much
+# slower.
+LZ_LEVEL = 'greedy'
+
+# How text shadows are made: 'builtin' (in-process, following
+# ImageMagick 6 Q16) or 'imagemagick' (runs ImageMagick's "convert",
+# which has to be installed; the original implementation, kept as a
+# reference; see shadow-diff.py)
+SHADOW_BACKEND = 'builtin'
+
+# How the images are reduced to 255 colors for the ENPGs: 'liq'
+# (libimagequant) or 'rgb555' (median cut on a histogram of the colors
+# the DS can show; see quantize.py)
+QUANTIZER = 'liq'
+
+# Rendered text is cached across runs (see textcache.py); this makes
+# sure that changes to the rendering code invalidate it
+SOURCE_HASH = textcache.sourceHash(
+    __file__, glyphatlas.__file__, imagebridge.__file__, outline.__file__, shadow.__file__)
+
+# Same for finished image pairs (see buildcache.py)
+BUILD_SOURCE_HASH = textcache.sourceHash(
+    __file__, compositor.__file__, enpg.__file__, glyphatlas.__file__, imagebridge.__file__,
+    lz77.__file__, outline.__file__, quantize.__file__, shadow.__file__)
+
+# How the images are put together: 'qt' (QPixmap and QPainter) or
+# 'array' (compositor.py, which gives the same results without needing a
+# display). Text is always rendered with Qt, but only needs a display if
+# it can't be drawn from the glyph atlas (see TEXT_RENDERER).
+COMPOSITOR = 'qt'
+
+# How text is drawn: 'atlas' (from glyph-atlas.json, which is made from
+# the font whenever it's installed and the atlas is out of date; see
+# glyphatlas.py) or 'qt' (QStaticText). Either way, anything the atlas
+# can't draw is drawn with Qt.
+TEXT_RENDERER = 'atlas'
+
+# The file IDs in zc_crsin that image pairs can go in (each pair takes
+# two: main and aux)
+FIRST_PAIR_ID = 2128
+END_PAIR_ID = 2488
+
+if sys.platform == 'win32':
+    # Windows limits font names to 31 characters, apparently
+    FONT_NAME = ('New Super Mario Font (Mario Par', 50)
+else:
+    FONT_NAME = ('New Super Mario Font (Mario Party 9)', 50)
+
+
+def loadResources(compositorName=COMPOSITOR):
+    if compositorName == 'array':
+        Pixmap, Painter = compositor.Pixmap, compositor.Painter
+    else:
+        Pixmap, Painter = QtGui.QPixmap, QtGui.QPainter
 
-
-def grouper(iterable, n, fillvalue=None):
-    """
-    Collect data into fixed-length chunks or blocks
-    https://docs.python.org/3/library/itertools.html#itertools-recipes
-    """
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
-
-
-def findAutocropSize(img):
-    """
-    Return the x, y, w, h of the image if it were autocropped
-    """
-    if not isinstance(img, QtGui.QImage):
-        img = img.toImage()
-    minX, minY, maxX, maxY = 0, 0, img.width() - 1, img.height() - 1
-    alphaAt = lambda x, y: img.pixel(x, y) >> 24
-    rowClear = lambda y: all(alphaAt(x, y) == 0 for x in range(img.width()))
-    colClear = lambda x: all(alphaAt(x, y) == 0 for y in range(img.height()))
-    while colClear(minX): minX += 1
-    while rowClear(minY): minY += 1
-    while colClear(maxX): maxX -= 1
-    while rowClear(maxY): maxY -= 1
-    return minX, minY, maxX - minX, maxY - minY
-
-
-def loadResources():
-    checkerboardCorner = QtGui.QPixmap('static/checkerboard.png')
+    checkerboardCorner = Pixmap('static/checkerboard.png')
     checkerboardCornerImg = checkerboardCorner.toImage()
 
-    fullCheckerboard = QtGui.QPixmap(32, 32)
+    fullCheckerboard = Pixmap(32, 32)
     fullCheckerboard.fill(Qt.transparent)
-    p = QtGui.QPainter(fullCheckerboard)
+    p = Painter(fullCheckerboard)
     p.drawPixmap(0, 0, checkerboardCorner)
     p.drawImage(16, 0, checkerboardCornerImg.mirrored(True, False))
     p.drawImage(0, 16, checkerboardCornerImg.mirrored(False, True))
     p.drawImage(16, 16, checkerboardCornerImg.mirrored(True, True))
     del p
 
-    imgMask = QtGui.QPixmap('static/img-mask.png')
+    imgMask = Pixmap('static/img-mask.png')
 
     # Find the center of imgMask's non-transparent area
-    imgMaskX, imgMaskY, imgMaskW, imgMaskH = findAutocropSize(imgMask)
+    imgMaskX, imgMaskY, imgMaskW, imgMaskH = imagebridge.findAutocropSize(imgMask)
     imgMaskCenter = (imgMaskX + imgMaskW // 2, imgMaskY + imgMaskH // 2)
     imgMaskSize = (imgMaskW, imgMaskH)
 
+    teethLighting = Pixmap('static/teeth-lighting.png')
+    teethLightingMirrored = Pixmap.fromImage(teethLighting.toImage().mirrored(True, False))
+
     return {
+        'Pixmap': Pixmap,
+        'Painter': Painter,
+        'themeTemplates': {}, # see getThemeTemplates()
+        'glyphAtlas': glyphatlas.GlyphAtlas.load() if TEXT_RENDERER == 'atlas' else None,
         'fullCheckerboard': fullCheckerboard,
         'imgMask': imgMask,
         'imgMaskCenter': imgMaskCenter,
         'imgMaskSize': imgMaskSize,
-        'imgOutline': QtGui.QPixmap('static/img-outline.png'),
-        'numberfont': QtGui.QPixmap('static/numberfont.png'),
-        'numberfontMask': QtGui.QPixmap('static/numberfont-mask.png'),
-        'teethLighting': QtGui.QPixmap('static/teeth-lighting.png'),
-        'bannerShadow': QtGui.QPixmap('static/banner-shadow.png'),
+        'imgOutline': Pixmap('static/img-outline.png'),
+        'numberfont': Pixmap('static/numberfont.png'),
+        'numberfontMask': Pixmap('static/numberfont-mask.png'),
+        'teethLighting': teethLighting,
+        'teethLightingMirrored': teethLightingMirrored,
+        'bannerShadow': Pixmap('static/banner-shadow.png'),
         }
 
 
@@ -98,58 +146,246 @@ def averageColor(color1, color2):
     return QtGui.QColor.fromHsv(h, s, v, a)
 
 
-def makePixmapShadow(pix, amount):
-    commands = ['-channel', 'RGB', # Only looking at the RGB channels...
-                '-black-threshold', '101%', # set them all to black
-                '-channel', 'RGBA', # Looking at all the channels again...
-                '-morphology', 'Convolve', f'Blur:0x{amount},90', # http://im.snibgo.com/selblur.htm#blrxy
-                ]
-    return QtGui.QPixmap.fromImage(runImageMagick(pix.toImage(), *commands))
+def makeImageShadow(img, amount):
+    with instrument.stage('shadow'):
+        return shadow.directionalBlurShadow(img, amount, SHADOW_BACKEND).convertToFormat(
+            QtGui.QImage.Format_ARGB32_Premultiplied)
 
 
-def runImageMagick(*command):
+def splitColors(text):
     """
-    Run ImageMagick with the command given. Commands are a list of
-    arguments, not unlike sys.argv. Where filenames are expected, just
-    put a QImage instance. Don't add anything where the output filename
-    would normally go. The resulting QImage will be returned.
+    Split text into (text, color) runs at the "\\w" (white) and "\\r"
+    (red) markers.
     """
+    runs = [['', 'white']]
+    for part in re.split(r'(\\[wr])', text):
+        if part == r'\w':
+            runs.append(['', 'white'])
+        elif part == r'\r':
+            runs.append(['', '#ff2828'])
+        else:
+            runs[-1][0] += part
+    return [tuple(run) for run in runs]
 
-    OUTPUT_FN = 'output.png'
 
-    command = list(command)
+def splitIcons(text):
+    """
+    Split text into [isIcon, text] parts, where "[name]" is the icon
+    characters/name.png.
+    """
+    parts = [[False, '']]
+    for c in text:
+        if c == '[':
+            parts.append([True, ''])
+        elif c == ']':
+            parts.append([False, ''])
+        else:
+            parts[-1][1] += c
+    return parts
 
-    imgs = {}
-    for i, part in enumerate(command):
-        if isinstance(part, QtGui.QImage):
-            fn = f'img{i}.png'
-            imgs[fn] = part
 
-    def fnFor(img):
-        return [fn for fn, img2 in imgs.items() if img2 is img][0]
+def atlasCanDraw(atlas, text):
+    """
+    Check whether all of the (non-icon) text can be drawn from the glyph
+    atlas, so that neither Qt nor the font is needed for it.
+    """
+    return atlas is not None and all(
+        atlas.canRender(splitColors(part)) for isIcon, part in splitIcons(text) if not isIcon)
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        def addDir(fn): return os.path.join(tmpdirname, fn)
 
-        imgs = {addDir(fn): img for fn, img in imgs.items()}
+def makeThemeTemplates(resources, background1, background2, banner1, banner2):
+    """
+    Make the parts of the intro graphics that only depend on the theme
+    colors, so that they can be shared by all of the levels that use it.
+    """
+    Pixmap, Painter = resources['Pixmap'], resources['Painter']
 
-        for fn, img in imgs.items():
-            img.save(fn)
+    # Make the checkerboard background for the main images
+    checkerboard = Pixmap(256, 256)
+    checkerboard.fill(Qt.transparent)
+    checkerboardP = Painter(checkerboard)
+    checkerboardP.setPen(Qt.NoPen)
 
-        command2 = ['convert']
-        for part in command:
-            if isinstance(part, QtGui.QImage):
-                command2.append(fnFor(part))
-            else:
-                command2.append(part)
-        command2.append(addDir(OUTPUT_FN))
+    # Draw the checkerboard background
+    checkerboardP.setBrush(background1)
+    checkerboardP.drawRect(0, 0, 256, 192)
 
-        if sys.platform == 'win32':
-            subprocess.run(command2, shell=True)
-        else:
-            subprocess.run(command2)
+    # Make the checkerboard overlay and draw it
+    cboard = Pixmap(256, 192)
+    cboard.fill(Qt.transparent)
+    cboardP = Painter(cboard)
+    cboardP.setPen(Qt.NoPen)
+    cboardP.setBrush(background2)
+    cboardP.drawRect(0, 0, 256, 192)
+    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
+    cboardP.drawTiledPixmap(0, 0, 256, 192, resources['fullCheckerboard'])
+    del cboardP
+    checkerboardP.drawPixmap(0, 0, cboard)
+
+    del checkerboardP
+
+    # The top screen's main image also has the preview image outline
+    topMain = Pixmap(checkerboard)
+    topMainP = Painter(topMain)
+    topMainP.drawPixmap(0, 0, resources['imgOutline'])
+    del topMainP
+
+    # Make the top screen's aux image, except for the part of the banner
+    # that the main image shows through (see makeTopScreenIntroGraphics())
+    topAux = Pixmap(256, 256)
+    topAux.fill(Qt.transparent)
+    topAuxP = Painter(topAux)
+    topAuxP.setPen(Qt.NoPen)
+
+    # Make the teeth's black background
+    topAuxP.setBrush(Qt.black)
+    topAuxP.drawRect(0, 0, 32, 192)
+    topAuxP.drawRect(224, 0, 32, 160)
+
+    # Make the teeth: for the left edge, right edge and behind the banner
+    # bottom edge
+    # - Checkerboard first layer
+    topAuxP.setBrush(background1)
+    topAuxP.drawRect(16, 0, 16, 192)
+    topAuxP.drawRect(224, 0, 16, 160)
+    topAuxP.drawRect(0, 224, 256, 32)
+    # - Checkerboard second layer
+    cboard = Pixmap(256, 256)
+    cboard.fill(Qt.transparent)
+    cboardP = Painter(cboard)
+    cboardP.setPen(Qt.NoPen)
+    cboardP.setBrush(background2)
+    cboardP.drawRect(0, 0, 32, 192)
+    cboardP.drawRect(224, 64, 32, 96)
+    cboardP.drawRect(0, 224, 256, 32)
+    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
+    cboardP.drawTiledPixmap(0, 0, 32, 192, resources['fullCheckerboard'])
+    cboardP.drawTiledPixmap(224, 0, 32, 160, resources['fullCheckerboard'])
+    cboardP.drawTiledPixmap(0, 224, 256, 32, resources['fullCheckerboard'])
+    del cboardP
+    topAuxP.drawPixmap(0, 0, cboard)
+
+    # Banner shadows
+    topAuxP.drawTiledPixmap(0, 224, 256, 32, resources['bannerShadow'])
+    topAuxP.drawTiledPixmap(224, 32, 32, 32, resources['bannerShadow'])
+
+    # And now remove pixels exactly matching background1 from the bottom
+    # 32px of the image.
+    bottom = imagebridge.argbArray(topAux.toImage().copy(0, 224, 256, 32))
+    knockout = numpy.where(bottom == background1.rgb(), numpy.uint32(0xFF000000), numpy.uint32(0))
+    topAuxP.setCompositionMode(topAuxP.CompositionMode_DestinationOut)
+    topAuxP.drawImage(0, 224, imagebridge.argbArrayToQImage(knockout))
+    topAuxP.setCompositionMode(topAuxP.CompositionMode_SourceOver)
+
+    # Now to make the banner.
+    banner = Pixmap(256, 256)
+    banner.fill(Qt.transparent)
+    bannerP = Painter(banner)
+    bannerP.setPen(Qt.NoPen)
+
+    # Banner checkerboard background
+    # (it's opaque, so drawing the whole banner at once later on is the
+    # same as drawing its layers one at a time)
+    bannerP.setBrush(banner1)
+    bannerP.drawRect(32, 0, 128, 48 - 2)
+    bannerP.drawRect(32, 64, 128, 48 - 2)
+    bannerP.drawRect(32, 160, 224, 32)
+    bannerP.drawRect(0, 192, 256, 64 - 16 - 2)
+    bannerP.drawRect(224, 0, 16, 32 + 16 - 2)
+
+    # Banner checkerboard foreground
+    cboard = Pixmap(256, 256)
+    cboard.fill(Qt.transparent)
+    cboardP = Painter(cboard)
+    cboardP.setPen(Qt.NoPen)
+    cboardP.setBrush(banner2)
+    cboardP.drawRect(32, 0, 128, 64 - 2)
+    cboardP.drawRect(32, 64, 128, 64 - 2)
+    cboardP.drawRect(32, 160, 224, 32)
+    cboardP.drawRect(0, 192, 256, 64 - 2)
+    cboardP.drawRect(224, 0, 32, 64 - 2)
+    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
+    cboardP.drawTiledPixmap(32, 0, 128, 64 - 2, resources['fullCheckerboard'], 0, 2)
+    cboardP.drawTiledPixmap(32, 64, 128, 64 - 2, resources['fullCheckerboard'], 0, 2)
+    cboardP.drawTiledPixmap(32, 160, 224, 32, resources['fullCheckerboard'], 0, 2)
+    cboardP.drawTiledPixmap(0, 192, 256, 64 - 2, resources['fullCheckerboard'], 0, 2)
+    cboardP.drawTiledPixmap(224, 0, 32, 64 - 2, resources['fullCheckerboard'], 0, 2)
+    del cboardP
+    bannerP.drawPixmap(0, 0, cboard)
+
+    del bannerP
+    topAuxP.drawPixmap(0, 0, banner)
 
-        return QtGui.QImage(addDir(OUTPUT_FN))
+    # Hard lighting
+    topAuxP.setCompositionMode(topAuxP.CompositionMode_HardLight)
+    lightingL = resources['teethLighting']
+    lightingR = resources['teethLightingMirrored']
+    topAuxP.drawTiledPixmap(0, 0, 32, 192, lightingL)
+    topAuxP.drawTiledPixmap(224, 0, 32, 64 - 2, lightingR, 0, 2)
+    topAuxP.drawTiledPixmap(224, 64, 32, 96, lightingR)
+    topAuxP.setCompositionMode(topAuxP.CompositionMode_SourceOver)
+
+    del topAuxP
+
+    # Make the bottom screen's aux image
+    bottomAux = Pixmap(256, 256)
+    bottomAux.fill(Qt.transparent)
+    bottomAuxP = Painter(bottomAux)
+    bottomAuxP.setPen(Qt.NoPen)
+
+    # Make the teeth's black background
+    bottomAuxP.setBrush(Qt.black)
+    bottomAuxP.drawRect(0, 0, 32, 192)
+    bottomAuxP.drawRect(224, 0, 32, 192)
+
+    # Make the teeth: for the left edge, right edge and behind the banner
+    # bottom edge
+    # - Checkerboard first layer
+    bottomAuxP.setBrush(background1)
+    bottomAuxP.drawRect(16, 0, 16, 192)
+    bottomAuxP.drawRect(224, 0, 16, 192)
+    # - Checkerboard second layer
+    cboard = Pixmap(256, 256)
+    cboard.fill(Qt.transparent)
+    cboardP = Painter(cboard)
+    cboardP.setPen(Qt.NoPen)
+    cboardP.setBrush(background2)
+    cboardP.drawRect(0, 0, 32, 192)
+    cboardP.drawRect(224, 0, 32, 192)
+    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
+    cboardP.drawTiledPixmap(0, 0, 32, 192, resources['fullCheckerboard'])
+    cboardP.drawTiledPixmap(224, 0, 32, 192, resources['fullCheckerboard'])
+    del cboardP
+    bottomAuxP.drawPixmap(0, 0, cboard)
+
+    # Hard lighting
+    bottomAuxP.setCompositionMode(bottomAuxP.CompositionMode_HardLight)
+    bottomAuxP.drawTiledPixmap(0, 0, 32, 192, lightingL)
+    bottomAuxP.drawTiledPixmap(224, 0, 32, 192, lightingR)
+    bottomAuxP.setCompositionMode(bottomAuxP.CompositionMode_SourceOver)
+
+    del bottomAuxP
+
+    return {
+        'topMain': topMain,
+        'topAux': topAux,
+        'banner': banner,
+        'bottomMain': checkerboard,
+        'bottomAux': bottomAux,
+        }
+
+
+def getThemeTemplates(resources, background1, background2, banner1, banner2):
+    """
+    Return the templates for a theme (see makeThemeTemplates()), making
+    them if this is the first time the theme has been seen.
+    """
+    themeTemplates = resources['themeTemplates']
+    key = tuple(c.rgba() for c in [background1, background2, banner1, banner2])
+    if key not in themeTemplates:
+        themeTemplates[key] = makeThemeTemplates(
+            resources, background1, background2, banner1, banner2)
+    return themeTemplates[key]
 
 
 def makeTopScreenIntroGraphics(
@@ -170,30 +406,15 @@ def makeTopScreenIntroGraphics(
     nameStr = (niceTitle + ' ' + niceName).strip()
     print('Rendering graphics for "' + nameStr + '"')
 
-    # Make the main image
-    img1 = QtGui.QPixmap(256, 256)
-    img1.fill(Qt.transparent)
-    img1P = QtGui.QPainter(img1)
-    img1P.setPen(Qt.NoPen)
-
-    # Draw the checkerboard background
-    img1P.setBrush(background1)
-    img1P.drawRect(0, 0, 256, 192)
-
-    # Make the checkerboard overlay and draw it
-    cboard = QtGui.QPixmap(256, 192)
-    cboard.fill(Qt.transparent)
-    cboardP = QtGui.QPainter(cboard)
-    cboardP.setPen(Qt.NoPen)
-    cboardP.setBrush(background2)
-    cboardP.drawRect(0, 0, 256, 192)
-    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
-    cboardP.drawTiledPixmap(0, 0, 256, 192, resources['fullCheckerboard'])
-    del cboardP
-    img1P.drawPixmap(0, 0, cboard)
+    Pixmap, Painter = resources['Pixmap'], resources['Painter']
+    templates = getThemeTemplates(
+        resources, background1, background2, banner1, banner2)
 
-    # Draw the preview image outline
-    img1P.drawPixmap(0, 0, resources['imgOutline'])
+    # Make the main image, starting with the checkerboard background and
+    # preview image outline
+    img1 = templates['topMain'].copy()
+    img1P = Painter(img1)
+    img1P.setPen(Qt.NoPen)
 
     # And the preview image itself
     if preview.width() < resources['imgMaskSize'][0]:
@@ -204,9 +425,9 @@ def makeTopScreenIntroGraphics(
         resources['imgMaskCenter'][0] - preview.width() // 2,
         resources['imgMaskCenter'][1] - preview.height() // 2,
         )
-    previewOverlay = QtGui.QPixmap(256, 192)
+    previewOverlay = Pixmap(256, 192)
     previewOverlay.fill(Qt.transparent)
-    previewOverlayP = QtGui.QPainter(previewOverlay)
+    previewOverlayP = Painter(previewOverlay)
     previewOverlayP.drawPixmap(*previewPos, preview)
     previewOverlayP.setCompositionMode(previewOverlayP.CompositionMode_DestinationIn)
     previewOverlayP.drawPixmap(0, 0, resources['imgMask'])
@@ -261,194 +482,181 @@ def makeTopScreenIntroGraphics(
 
     del img1P
 
-    # Make the aux image
-    img2 = QtGui.QPixmap(256, 256)
-    img2.fill(Qt.transparent)
-    img2P = QtGui.QPainter(img2)
+    # Make the aux image, starting with the teeth and banner
+    img2 = templates['topAux'].copy()
+    img2P = Painter(img2)
     img2P.setPen(Qt.NoPen)
 
-    # Make the teeth's black background
-    img2P.setBrush(Qt.black)
-    img2P.drawRect(0, 0, 32, 192)
-    img2P.drawRect(224, 0, 32, 160)
-
-    # Make the teeth: for the left edge, right edge and behind the banner
-    # bottom edge
-    # - Checkerboard first layer
-    img2P.setBrush(background1)
-    img2P.drawRect(16, 0, 16, 192)
-    img2P.drawRect(224, 0, 16, 160)
-    img2P.drawRect(0, 224, 256, 32)
-    # - Checkerboard second layer
-    cboard = QtGui.QPixmap(256, 256)
-    cboard.fill(Qt.transparent)
-    cboardP = QtGui.QPainter(cboard)
-    cboardP.setPen(Qt.NoPen)
-    cboardP.setBrush(background2)
-    cboardP.drawRect(0, 0, 32, 192)
-    cboardP.drawRect(224, 64, 32, 96)
-    cboardP.drawRect(0, 224, 256, 32)
-    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
-    cboardP.drawTiledPixmap(0, 0, 32, 192, resources['fullCheckerboard'])
-    cboardP.drawTiledPixmap(224, 0, 32, 160, resources['fullCheckerboard'])
-    cboardP.drawTiledPixmap(0, 224, 256, 32, resources['fullCheckerboard'])
-    del cboardP
-    img2P.drawPixmap(0, 0, cboard)
-
     # Copy the portion of the main image that goes behind the banner
     # Note that it has to be done this way because the preview image
     # border may clip into these regions
-    img2P.drawPixmap(32, 0, img1.copy(0, 0, 128, 64))
-    img2P.drawPixmap(32, 64, img1.copy(128, 0, 128, 64))
+    behindBanner = Pixmap(128, 128)
+    behindBanner.fill(Qt.transparent)
+    behindBannerP = Painter(behindBanner)
+    behindBannerP.drawPixmap(0, 0, img1.copy(0, 0, 128, 64))
+    behindBannerP.drawPixmap(0, 64, img1.copy(128, 0, 128, 64))
 
     # Banner shadows
-    img2P.drawTiledPixmap(32, 32, 128, 32, resources['bannerShadow'])
-    img2P.drawTiledPixmap(32, 96, 128, 32, resources['bannerShadow'])
-    img2P.drawTiledPixmap(0, 224, 256, 32, resources['bannerShadow'])
-    img2P.drawTiledPixmap(224, 32, 32, 32, resources['bannerShadow'])
-
-    # And now remove pixels exactly matching background1 from the bottom
-    # 32px of the image.
-    img2Img = img2.toImage()
-    img2P.setCompositionMode(img2P.CompositionMode_DestinationOut)
-    for x in range(256):
-        for y in range(224, 256):
-            if img2Img.pixel(x, y) == background1.rgb():
-                img2P.drawRect(x, y, 1, 1)
-    img2P.setCompositionMode(img2P.CompositionMode_SourceOver)
+    behindBannerP.drawTiledPixmap(0, 32, 128, 32, resources['bannerShadow'])
+    behindBannerP.drawTiledPixmap(0, 96, 128, 32, resources['bannerShadow'])
 
-    # Now to make the banner.
-    
-    # Banner checkerboard background
-    img2P.setBrush(banner1)
-    img2P.drawRect(32, 0, 128, 48 - 2)
-    img2P.drawRect(32, 64, 128, 48 - 2)
-    img2P.drawRect(32, 160, 224, 32)
-    img2P.drawRect(0, 192, 256, 64 - 16 - 2)
-    img2P.drawRect(224, 0, 16, 32 + 16 - 2)
-
-    # Banner checkerboard foreground
-    cboard = QtGui.QPixmap(256, 256)
-    cboard.fill(Qt.transparent)
-    cboardP = QtGui.QPainter(cboard)
-    cboardP.setPen(Qt.NoPen)
-    cboardP.setBrush(banner2)
-    cboardP.drawRect(32, 0, 128, 64 - 2)
-    cboardP.drawRect(32, 64, 128, 64 - 2)
-    cboardP.drawRect(32, 160, 224, 32)
-    cboardP.drawRect(0, 192, 256, 64 - 2)
-    cboardP.drawRect(224, 0, 32, 64 - 2)
-    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
-    cboardP.drawTiledPixmap(32, 0, 128, 64 - 2, resources['fullCheckerboard'], 0, 2)
-    cboardP.drawTiledPixmap(32, 64, 128, 64 - 2, resources['fullCheckerboard'], 0, 2)
-    cboardP.drawTiledPixmap(32, 160, 224, 32, resources['fullCheckerboard'], 0, 2)
-    cboardP.drawTiledPixmap(0, 192, 256, 64 - 2, resources['fullCheckerboard'], 0, 2)
-    cboardP.drawTiledPixmap(224, 0, 32, 64 - 2, resources['fullCheckerboard'], 0, 2)
-    del cboardP
-    img2P.drawPixmap(0, 0, cboard)
+    # And the banner on top
+    behindBannerP.drawPixmap(0, 0, templates['banner'], 32, 0, 128, 128)
+    del behindBannerP
 
-    # Hard lighting
-    img2P.setCompositionMode(img2P.CompositionMode_HardLight)
-    lightingL = resources['teethLighting']
-    lightingR = QtGui.QPixmap.fromImage(lightingL.toImage().mirrored(True, False))
-    img2P.drawTiledPixmap(0, 0, 32, 192, lightingL)
-    img2P.drawTiledPixmap(224, 0, 32, 64 - 2, lightingR, 0, 2)
-    img2P.drawTiledPixmap(224, 64, 32, 96, lightingR)
+    img2P.setCompositionMode(img2P.CompositionMode_Source)
+    img2P.drawPixmap(32, 0, behindBanner)
     img2P.setCompositionMode(img2P.CompositionMode_SourceOver)
 
     # Last thing: text.
-    if sys.platform == 'win32':
-        # Windows limits font names to 31 characters, apparently
-        FONT_NAME = ('New Super Mario Font (Mario Par', 50)
-    else:
-        FONT_NAME = ('New Super Mario Font (Mario Party 9)', 50)
     FONT_OUTLINE = ((85, 85, 85), 18)
+    TEXT_SHADOW = 5
     def renderText(text, relativeSize, maxWidth=240):
-        w, h = 4000, 384
-        textBoard = QtGui.QPixmap(w, h)
-        textBoard.fill(Qt.transparent)
-        textBoardP = QtGui.QPainter(textBoard)
+        # The atlas hash already covers the font for text drawn from it,
+        # so the font is only hashed (which needs Qt) for other text
+        key = textcache.makeKey(
+            source=SOURCE_HASH,
+            text=text,
+            font=FONT_NAME,
+            fontHash=None if atlasCanDraw(resources['glyphAtlas'], text) else installedFontHash(),
+            outline=FONT_OUTLINE,
+            shadow=TEXT_SHADOW,
+            shadowBackend=SHADOW_BACKEND,
+            relativeSize=relativeSize,
+            maxWidth=maxWidth,
+            icons=textcache.iconHashes(text),
+            glyphAtlas=resources['glyphAtlas'].hash if resources['glyphAtlas'] else None,
+            )
+        with instrument.stage('text'):
+            return Pixmap.fromImage(textcache.cachedRender(
+                key, lambda: renderTextUncached(text, relativeSize, maxWidth)))
 
+    def renderTextUncached(text, relativeSize, maxWidth):
         # Split by special characters
-        textList = [[False, '']] # (isIcon, text), ...
-        for c in text:
-            if c == '[':
-                textList.append([True, ''])
-            elif c == ']':
-                textList.append([False, ''])
-            else:
-                textList[-1][1] += c
-
-        # Convert shorthand r'\w's and r'\r's to HTML markup Qt understands
-        es = '</span>'
-        cw, cr = '<span style="color:white;">', '<span style="color:#ff2828;">'
-        for i, (isIcon, text) in enumerate(textList):
-            if not isIcon:
-                textList[i][1] = (cw + text.replace(r'\w', es + cw
-                                                   ).replace(r'\r', es + cr)
-                                  + es)
-
-        # Draw the text (and *only* the text), but keep track of where the
-        # icons would go and leave room for them
-        f = QtGui.QFont(*FONT_NAME)
-        f.setStyleStrategy(f.NoAntialias)
-        textBoardP.setFont(f)
-        textBoardP.setPen(Qt.white)
+        textList = splitIcons(text) # (isIcon, text), ...
 
+        # Draw the text from the glyph atlas if possible, and otherwise
+        # with Qt
+        atlas = resources['glyphAtlas']
+        useAtlas = atlasCanDraw(atlas, text)
+
+        if useAtlas:
+            for i, (isIcon, text) in enumerate(textList):
+                if not isIcon:
+                    textList[i][1] = splitColors(text)
+        else:
+            startQt()
+
+            # Convert shorthand r'\w's and r'\r's to HTML markup Qt understands
+            es = '</span>'
+            cw, cr = '<span style="color:white;">', '<span style="color:#ff2828;">'
+            for i, (isIcon, text) in enumerate(textList):
+                if not isIcon:
+                    textList[i][1] = (cw + text.replace(r'\w', es + cw
+                                                       ).replace(r'\r', es + cr)
+                                      + es)
+
+            f = QtGui.QFont(*FONT_NAME)
+            f.setStyleStrategy(f.NoAntialias)
+
+        # Lay out the text and icons first, so that the board only has to
+        # be as big as they are (plus room for the outline and shadow).
+        # Everything after this point takes time proportional to its area.
         x = 32
         PAD = 12
+        textPlacement = []
         iconPlacement = []
+        right = bottom = 0
         for isIcon, text in textList:
             if isIcon:
-                icon = QtGui.QPixmap('characters/' + text + '.png')
+                icon = QtGui.QImage('characters/' + text + '.png').convertToFormat(
+                    QtGui.QImage.Format_ARGB32_Premultiplied)
                 iconPlacement.append((icon, x))
+                right = max(right, x + icon.width())
+                bottom = max(bottom, 68 + icon.height())
                 x += icon.width() + PAD
+            elif useAtlas:
+                laidOut, width = atlas.layout(text)
+                textPlacement.append((laidOut, x))
+                right = max(right, x + width)
+                bottom = max(bottom, 32 + atlas.height)
+                x += width + PAD
             else:
                 st = QtGui.QStaticText(text)
                 opt = st.textOption()
                 opt.setWrapMode(opt.NoWrap)
                 st.setTextOption(opt)
-                textBoardP.drawStaticText(x, 32, st)
+                st.prepare(QtGui.QTransform(), f)
+                textPlacement.append((st, x))
+                right = max(right, x + st.size().width())
+                bottom = max(bottom, 32 + st.size().height())
                 x += st.size().width() + PAD
 
+        MAX_W, MAX_H = 4000, 384
+        MARGIN = 96 # outline + shadow blur + shadow offset, with room to spare
+        w = min(MAX_W, math.ceil(right) + MARGIN)
+        h = min(MAX_H, math.ceil(bottom) + MARGIN)
+        textBoard = QtGui.QImage(w, h, QtGui.QImage.Format_ARGB32_Premultiplied)
+        textBoard.fill(Qt.transparent)
+        textBoardP = QtGui.QPainter(textBoard)
+
+        # Draw the text (and *only* the text), leaving room for the icons
+        if useAtlas:
+            # Lines start at whole pixels, like with drawStaticText()
+            for laidOut, x in textPlacement:
+                atlas.draw(textBoardP, int(x), 32, laidOut)
+        else:
+            textBoardP.setFont(f)
+            textBoardP.setPen(Qt.white)
+            for st, x in textPlacement:
+                textBoardP.drawStaticText(int(x), 32, st)
+
         # And now outline the text
         # https://en.wikipedia.org/wiki/Dilation_(morphology)
         textBoardP.setCompositionMode(textBoardP.CompositionMode_DestinationOver)
-        textBoardP.setPen(Qt.NoPen)
-        textBoardP.setBrush(QtGui.QColor.fromRgb(*FONT_OUTLINE[0]))
-        textBoardImg = textBoard.toImage()
-        outline = FONT_OUTLINE[1]
-        for y in range(h):
-            for x in range(w):
-                if textBoardImg.pixel(x, y) >> 24 > 0:
-                    textBoardP.drawEllipse(x - outline, y - outline,
-                                           2 * outline, 2 * outline)
-
-        # And draw all the icons in
+        outlineColor = QtGui.QColor.fromRgb(*FONT_OUTLINE[0])
+        with instrument.stage('outline'):
+            # Text from the atlas can be outlined one glyph at a time,
+            # from outlines that are only made once
+            mask = None
+            if useAtlas:
+                mask = atlas.outlineMask(
+                    imagebridge.alphaPlane(textBoard) > 0,
+                    [(int(x), 32, laidOut) for laidOut, x in textPlacement],
+                    FONT_OUTLINE[1])
+            if mask is not None:
+                textOutline = outline.maskToImage(mask, outlineColor)
+                instrument.count('outlines made from glyphs')
+            else:
+                textOutline = outline.makeOutline(textBoard, outlineColor, FONT_OUTLINE[1])
+                instrument.count('pixels dilated', textBoard.width() * textBoard.height())
+        textBoardP.drawImage(0, 0, textOutline)
+
+        # And draw all the icons in (behind the text and outline)
         for icon, x in iconPlacement:
-            textBoardP.drawPixmap(x, 68, icon)
+            textBoardP.drawImage(int(x), 68, icon)
 
         # Add shadow
         textBoardP.setCompositionMode(textBoardP.CompositionMode_DestinationOver)
-        p = makePixmapShadow(textBoard, 5)
+        p = makeImageShadow(textBoard, TEXT_SHADOW)
         textBoardP.setOpacity(0.8)
-        textBoardP.drawPixmap(0, 10, p)
+        textBoardP.drawImage(0, 10, p)
         textBoardP.setOpacity(1.0)
 
         del textBoardP
 
         # Now autocrop it
-        textBoard = textBoard.copy(*findAutocropSize(textBoard))
+        textBoard = textBoard.copy(*imagebridge.findAutocropSize(textBoard))
 
         # Now shrink it to the size requested
         if relativeSize * textBoard.width() < maxWidth:
             textBoard = textBoard.scaledToWidth(
-                relativeSize * textBoard.width(),
+                int(relativeSize * textBoard.width()),
                 Qt.SmoothTransformation)
         else:
             textBoard = textBoard.scaled(
                 maxWidth,
-                relativeSize * textBoard.height(),
+                int(relativeSize * textBoard.height()),
                 Qt.IgnoreAspectRatio,
                 Qt.SmoothTransformation)
 
@@ -498,27 +706,13 @@ def makeBottomScreenIntroGraphics(
     Create both intro graphics images for the bottom screen.
     """
 
-    # Make the main image
-    img1 = QtGui.QPixmap(256, 256)
-    img1.fill(Qt.transparent)
-    img1P = QtGui.QPainter(img1)
-    img1P.setPen(Qt.NoPen)
+    Pixmap, Painter = resources['Pixmap'], resources['Painter']
+    templates = getThemeTemplates(
+        resources, background1, background2, banner1, banner2)
 
-    # Draw the checkerboard background
-    img1P.setBrush(background1)
-    img1P.drawRect(0, 0, 256, 192)
-
-    # Make the checkerboard overlay and draw it
-    cboard = QtGui.QPixmap(256, 192)
-    cboard.fill(Qt.transparent)
-    cboardP = QtGui.QPainter(cboard)
-    cboardP.setPen(Qt.NoPen)
-    cboardP.setBrush(background2)
-    cboardP.drawRect(0, 0, 256, 192)
-    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
-    cboardP.drawTiledPixmap(0, 0, 256, 192, resources['fullCheckerboard'])
-    del cboardP
-    img1P.drawPixmap(0, 0, cboard)
+    # Make the main image, starting with the checkerboard background
+    img1 = templates['bottomMain'].copy()
+    img1P = Painter(img1)
 
     # Draw the icon
     iconX = 128 - icon.width() // 2
@@ -527,219 +721,329 @@ def makeBottomScreenIntroGraphics(
 
     del img1P
 
-    # Make the aux image
-    img2 = QtGui.QPixmap(256, 256)
-    img2.fill(Qt.transparent)
-    img2P = QtGui.QPainter(img2)
-    img2P.setPen(Qt.NoPen)
+    # The aux image is all teeth, so it's the same for the whole theme
+    img2 = templates['bottomAux']
 
-    # Make the teeth's black background
-    img2P.setBrush(Qt.black)
-    img2P.drawRect(0, 0, 32, 192)
-    img2P.drawRect(224, 0, 32, 192)
+    return img1, img2
 
-    # Make the teeth: for the left edge, right edge and behind the banner
-    # bottom edge
-    # - Checkerboard first layer
-    img2P.setBrush(background1)
-    img2P.drawRect(16, 0, 16, 192)
-    img2P.drawRect(224, 0, 16, 192)
-    # - Checkerboard second layer
-    cboard = QtGui.QPixmap(256, 256)
-    cboard.fill(Qt.transparent)
-    cboardP = QtGui.QPainter(cboard)
-    cboardP.setPen(Qt.NoPen)
-    cboardP.setBrush(background2)
-    cboardP.drawRect(0, 0, 32, 192)
-    cboardP.drawRect(224, 0, 32, 192)
-    cboardP.setCompositionMode(cboardP.CompositionMode_DestinationIn)
-    cboardP.drawTiledPixmap(0, 0, 32, 192, resources['fullCheckerboard'])
-    cboardP.drawTiledPixmap(224, 0, 32, 192, resources['fullCheckerboard'])
-    del cboardP
-    img2P.drawPixmap(0, 0, cboard)
 
-    # Hard lighting
-    img2P.setCompositionMode(img2P.CompositionMode_HardLight)
-    lightingL = resources['teethLighting']
-    lightingR = QtGui.QPixmap.fromImage(lightingL.toImage().mirrored(True, False))
-    img2P.drawTiledPixmap(0, 0, 32, 192, lightingL)
-    img2P.drawTiledPixmap(224, 0, 32, 192, lightingR)
-    img2P.setCompositionMode(img2P.CompositionMode_SourceOver)
+def compressLZ(data, level=LZ_LEVEL):
+    """
+    LZ10-compress some data at the requested compression level.
+    """
+    instrument.count('bytes compressed', len(data))
+    if level == 'greedy':
+        return ndspy.lz10.compress(data)
 
-    del img2P
+    compressed = lz77.LZ77_Compress(data, level=level)
+    if ndspy.lz10.decompress(compressed) != data:
+        raise ValueError(f'LZ10 data compressed at level {level!r} does not decompress correctly')
+    return compressed
 
-    return img1, img2
+
+def compressEnpg(data):
+    """
+    LZ10-compress an ENPG, or reuse the compressed copy of it from the
+    ROM given to --reuse-from (see romreuse.py), if there is one.
+    """
+    if renderer['romIndex']:
+        compressed = renderer['romIndex'].get(romreuse.enpgHash(data))
+        if compressed is not None:
+            instrument.count('ENPGs reused from the ROM')
+            return compressed
+    return compressLZ(data)
 
 
 def hex2QColor(hexColor):
     return QtGui.QColor.fromRgb(int(hexColor, 16))
 
 
-def qImageToPilImage(qimage):
+def saveImagePair(img1, img2, fn1, fn2, key):
     """
-    Convert a QImage to a PIL Image.
-    http://stackoverflow.com/a/1756587/4718769
+    Palette-reduce the two images to 256-colors (both with the same
+    palette), and convert them to ENPGs. The debug PNGs and ENPGs, and
+    the build cache entry for key, are written in the background.
+    Currently assumes both images are 256x256.
+    Returns the two LZ-compressed ENPGs.
     """
-    buffer = QtCore.QBuffer()
-    buffer.open(QtCore.QIODevice.ReadWrite)
-    qimage.save(buffer, 'PNG')
 
-    bio = io.BytesIO()
-    bio.write(buffer.data())
-    buffer.close()
-    bio.seek(0)
-    return PIL.Image.open(bio)
+    # QPixmaps can only be used on the main thread, so the background
+    # writer gets QImages
+    img1, img2 = map(imagebridge.toQImage, [img1, img2])
+
+    with instrument.stage('convert'):
+        # Convert both to PIL Images
+        pimg1, pimg2 = map(imagebridge.qImageToPilImage, [img1, img2])
+
+        # Combine
+        comb = PIL.Image.new('RGBA', (512, 256), (0, 0, 0, 0))
+        comb.paste(pimg1, (0, 0))
+        comb.paste(pimg2, (256, 0))
+
+    # Quantize
+    # combQ = comb.quantize(255, 3) # leave one color for transparent
+    with instrument.stage('quantize'):
+        combQ = quantize.quantize(comb, QUANTIZER, 255) # leave one color for transparent
+
+    # Create the ENPGs
+    with instrument.stage('enpg'):
+        enpg1, enpg2 = enpg.enpgsFromQuantized(comb, combQ)
+
+    # Compress them
+    with instrument.stage('compress'):
+        enpg1Compressed = compressEnpg(enpg1)
+        enpg2Compressed = compressEnpg(enpg2)
 
+    # Waiting here means the writer has fallen behind
+    with instrument.stage('write queue'):
+        renderer['writer'].submit(writeImagePair,
+            [(fn1, img1, enpg1, enpg1Compressed), (fn2, img2, enpg2, enpg2Compressed)], key)
 
-def enpgToImage(enpg):
+    return enpg1Compressed, enpg2Compressed
+
+
+def writeImagePair(images, key):
     """
-    Render an ENPG.
+    Save a pair of images from saveImagePair() to the output folders
+    (as (filename, image, ENPG, compressed ENPG) tuples), and then to the
+    build cache. This runs on the background writer thread.
     """
-    img = PIL.Image.new('RGBA', (256, 256), (0, 0, 0, 0))
-    colors = []
-    for i in range(256):
-        rgb555, = struct.unpack_from('<H', enpg, 256 * 256 + 2 * i)
-        b, g, r = (rgb555 >> 10) & 0x1F, (rgb555 >> 5) & 0x1F, rgb555 & 0x1F
-        r, g, b = int(r * 0xFF / 0x1F), int(g * 0xFF / 0x1F), int(b * 0xFF / 0x1F)
-        r, g, b = min(r, 255), min(g, 255), min(b, 255)
-        a = 0 if rgb555 >> 15 else 255
-        colors.append((r, g, b, a))
-    assert len(colors) == 256
-    for y in range(256):
-        for x in range(256):
-            img.putpixel((x, y), colors[enpg[y * 256 + x]])
-    return img
+    # runTask() times the rest of the pair under the main image's name
+    item = images[0][0]
+
+    for fn, img, enpgData, compressed in images:
+        with instrument.threadStage('debug PNGs', item):
+            img.save('out-png/' + fn + '.png')
+        with instrument.threadStage('write', item):
+            with open('out-enpg/' + fn + '.enpg', 'wb') as f:
+                f.write(enpgData)
+            with open('out-enpg-lz/' + fn + '.enpg', 'wb') as f:
+                f.write(compressed)
+
+        # Render them as PNGs and save them elsewhere (for quality inspection)
+        with instrument.threadStage('enpg render', item):
+            enpgPng = enpg.enpgToImage(enpgData)
+        with instrument.threadStage('debug PNGs', item):
+            enpgPng.save('out-enpg-png/' + fn + '.png')
+
+    with instrument.threadStage('build cache', item):
+        buildcache.save(key, [fn for fn, *_ in images])
 
 
-def saveImagePair(img1, img2, fn1, fn2, rom, firstFileID):
+def insertImagePair(rom, firstFileID, fn1, fn2, data1, data2):
     """
-    Palette-reduce the two images to 256-colors (both with the same
-    palette), save them as PNGs, and save them as ENPGs
-    Currently assumes both images are 256x256.
+    Put a pair of compressed ENPGs into the rom.
     """
+    folder = rom.filenames['zc_crsin']
+    rom.files[firstFileID] = data1
+    rom.files[firstFileID + 1] = data2
+    folder.files[firstFileID - folder.firstID] = f'{fn1}.enpg'
+    folder.files[firstFileID - folder.firstID + 1] = f'{fn2}.enpg'
 
-    # Temp
-    img1.save('out-png/' + fn1 + '.png')
-    img2.save('out-png/' + fn2 + '.png')
 
-    # Convert both to PIL Images
-    pimg1, pimg2 = map(qImageToPilImage, [img1, img2])
+# The resources each rendering process needs (see initRenderer())
+renderer = {}
 
-    # Combine
-    comb = PIL.Image.new('RGBA', (512, 256), (0, 0, 0, 0))
-    comb.paste(pimg1, (0, 0))
-    comb.paste(pimg2, (256, 0))
 
-    # Quantize
-    # combQ = comb.quantize(255, 3) # leave one color for transparent
-    attr = liq.Attr()
-    attr.max_colors = 255 # leave one color for transparent
-    comb_liq = libimagequant_integrations.PIL.to_liq(comb, attr)
-    combQ = libimagequant_integrations.PIL.from_liq(comb_liq.quantize(attr), comb_liq)
-
-    # Create the ENPG data arrays
-    ENPG_LEN = 256 * 256 + 256 * 2
-    enpg1, enpg2 = bytearray(ENPG_LEN), bytearray(ENPG_LEN)
-
-    # Convert the palette to RGB555 and put it in both the enpgs
-    pal888 = combQ.getpalette()[:255*3]
-    struct.pack_into('<H', enpg1, 256**2, 0x8000)
-    struct.pack_into('<H', enpg2, 256**2, 0x8000)
-    shrink = lambda c: min((c + 4) >> 3, 0x1F) & 0x1F
-    for i, (r, g, b) in enumerate(grouper(pal888, 3)):
-        rgb = shrink(b) << 10 | shrink(g) << 5 | shrink(r)
-        struct.pack_into('<H', enpg1, 256**2 + 2 * i + 2, rgb)
-        struct.pack_into('<H', enpg2, 256**2 + 2 * i + 2, rgb)
-
-    # Put the color indices in the enpgs
-    for y in range(256):
-        for x in range(256):
-            alpha = comb.getpixel((x, y))[3]
-            if alpha < 255:
-                col = 0
-            else:
-                col = combQ.getpixel((x, y)) + 1
-            enpg1[y * 256 + x] = col
-    for y in range(256):
-        for x in range(256):
-            alpha = comb.getpixel((x + 256, y))[3]
-            if alpha < 255:
-                col = 0
-            else:
-                col = combQ.getpixel((x + 256, y)) + 1
-            enpg2[y * 256 + x] = col
+def startQt():
+    """
+    Make sure that this process has a QGuiApplication, which Qt needs
+    for fonts and QPixmaps.
+    """
+    if 'app' not in renderer:
+        renderer['app'] = QtGui.QGuiApplication.instance() or QtGui.QGuiApplication([])
 
-    # Compress them
-    enpg1Compressed = ndspy.lz10.compress(enpg1)
-    enpg2Compressed = ndspy.lz10.compress(enpg2)
 
-    # Save them
-    with open('out-enpg/' + fn1 + '.enpg', 'wb') as f:
-        f.write(enpg1)
-    with open('out-enpg/' + fn2 + '.enpg', 'wb') as f:
-        f.write(enpg2)
-    with open('out-enpg-lz/' + fn1 + '.enpg', 'wb') as f:
-        f.write(enpg1Compressed)
-    with open('out-enpg-lz/' + fn2 + '.enpg', 'wb') as f:
-        f.write(enpg2Compressed)
+@functools.lru_cache()
+def installedFontHash():
+    """
+    Return buildcache.fontHash() for FONT_NAME, which tells apart the
+    font files Qt might really draw text with. Only worked out once per
+    process.
+    """
+    startQt()
+    return buildcache.fontHash(QtGui.QFont(*FONT_NAME))
+
+
+def initRenderer(instrumentSettings=None, romIndex=None, barrier=None):
+    """
+    Set up Qt and load resources, so that this process can render
+    images. This is run once in the main process, or once in each worker
+    process when building in parallel (where instrumentSettings turns on
+    the same instrumentation as in the main process, and barrier is for
+    finishWriting()). romIndex is the index of compressed ENPGs to reuse,
+    from romreuse.buildIndex(). With the array compositor, Qt is only
+    started once some text actually has to be rendered without the
+    glyph atlas.
+    """
+    if instrumentSettings is not None:
+        instrument.configure(*instrumentSettings)
+    if COMPOSITOR == 'qt':
+        startQt()
+    renderer['resources'] = loadResources()
+    renderer['romIndex'] = romIndex or {}
+    renderer['barrier'] = barrier
+
+    # Output files are written in the background (see saveImagePair()).
+    # Worker processes are told when to finish with finishWriting().
+    renderer['writer'] = backgroundwriter.BackgroundWriter()
+
+
+def renderTopPair(levelConfig, theme, mainFn, auxFn, key):
+    """
+    Render, convert and compress the top-screen images for a level.
+    """
+    with instrument.stage('render'):
+        main, aux = makeTopScreenIntroGraphics(
+            resources = renderer['resources'],
+            title = levelConfig.get('title'),
+            name = levelConfig.get('name'),
+            background1 = hex2QColor(theme['background1']),
+            background2 = hex2QColor(theme['background2']),
+            banner1 = hex2QColor(theme['banner1']),
+            banner2 = hex2QColor(theme['banner2']),
+            preview = renderer['resources']['Pixmap']('previews/' + levelConfig['preview']),
+            )
+
+    return saveImagePair(main, aux, mainFn, auxFn, key)
+
+
+def renderBottomPair(themeName, btm, theme, mainFn, auxFn, key, progress):
+    """
+    Render, convert and compress the bottom-screen images for a bottom
+    icon and theme.
+    """
+    print(f'Rendering bottom-screen graphics for {btm.split(".")[0]}'
+        f' with the "{themeName}" theme ({progress})...')
+    with instrument.stage('render'):
+        main, aux = makeBottomScreenIntroGraphics(
+            resources = renderer['resources'],
+            background1 = hex2QColor(theme['background1']),
+            background2 = hex2QColor(theme['background2']),
+            banner1 = hex2QColor(theme['banner1']),
+            banner2 = hex2QColor(theme['banner2']),
+            icon = renderer['resources']['Pixmap']('bottoms/' + btm),
+            )
+
+    return saveImagePair(main, aux, mainFn, auxFn, key)
+
+
+def runTask(task):
+    """
+    Run a (name, (function, args)) task from makeImages(). Return its
+    result, along with the instrumentation stats for it (if any).
+    """
+    name, (func, args) = task
+    with instrument.item(name):
+        result = func(*args)
+    return result, instrument.takeStats()
+
 
-    # Insert them into the rom
-    rom.files[firstFileID] = enpg1Compressed
-    rom.files[firstFileID + 1] = enpg2Compressed
-    rom.filenames['zc_crsin'].files[firstFileID - rom.filenames['zc_crsin'].firstID] = f'{fn1}.enpg'
-    rom.filenames['zc_crsin'].files[firstFileID - rom.filenames['zc_crsin'].firstID + 1] = f'{fn2}.enpg'
+def finishWriting(_):
+    """
+    Wait for this worker process's background writer to write everything
+    (re-raising any error it ran into), and return the instrumentation
+    stats for it. makeImages() runs this once per worker at the end: the
+    barrier makes sure that no worker gets two of them.
+    """
+    try:
+        renderer['writer'].close()
+        return instrument.takeStats()
+    finally:
+        renderer['barrier'].wait()
 
-    # Render them as PNGs and save them elsewhere (for quality inspection)
-    enpgPng1, enpgPng2 = map(enpgToImage, [enpg1, enpg2])
-    enpgPng1.save('out-enpg-png/' + fn1 + '.png')
-    enpgPng2.save('out-enpg-png/' + fn2 + '.png')
 
+def imapBounded(pool, func, tasks, window):
+    """
+    Like pool.imap(func, tasks), but with no more than window tasks
+    handed out whose results haven't been collected yet, so that results
+    can't pile up faster than they're used.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
 
-def makeImages():
 
-    resources = loadResources()
+def makeImages(jobs=1, rebuild=False, reuseFrom=None):
 
     with open('config.json', 'r', encoding='utf-8') as f:
         config = json.load(f, object_pairs_hook=collections.OrderedDict)
 
-    with open('Newer Super Mario Bros. DS Orig.nds', 'rb') as f:
-        rom = ndspy.rom.NintendoDSRom(f.read())
+    rom = rompatch.RomPatcher('Newer Super Mario Bros. DS Orig.nds')
 
-    for i in range(2128, 2488):
+    for i in range(FIRST_PAIR_ID, END_PAIR_ID):
         rom.filenames['zc_crsin'].files[i - rom.filenames['zc_crsin'].firstID] = f'{i} Dummy'
         rom.files[i] = b'DUMMY'
 
     fileIdMap = {}
 
     def fileIdGen():
-        fid = 2128
-        while True:
+        fid = FIRST_PAIR_ID
+        while fid + 2 <= END_PAIR_ID:
             yield fid
             fid += 2
+        raise ValueError(f'Out of file IDs for image pairs (only {FIRST_PAIR_ID}-{END_PAIR_ID - 1} can be used)')
     fileId = fileIdGen()
 
-    # Make the top-screen images
+    # Pairs with the same cache key come out exactly the same, so each
+    # one is only made (and put into the rom) once, and every level that
+    # uses it points to the same file IDs
+    idsByKey = {}
+
+    # Bring the glyph atlas up to date before anything loads it. An atlas
+    # that's already there and has every character is used as it is,
+    # without starting Qt to check it against the installed font.
+    atlas = None
+    if TEXT_RENDERER == 'atlas':
+        chars = ''.join((levelConfig.get('title') or '') + (levelConfig.get('name') or '')
+                        for levelConfig in config['levels'].values())
+        atlas = glyphatlas.GlyphAtlas.load()
+        if atlas is None or not atlas.isFor(FONT_NAME) or not atlas.hasChars(chars):
+            startQt()
+            atlas = glyphatlas.updateAtlas(QtGui.QFont(*FONT_NAME), chars)
+
+    # Everything that affects every image pair, for the build cache keys
+    settings = textcache.makeKey(
+        source=BUILD_SOURCE_HASH,
+        static=buildcache.dirHash('static'),
+        lzLevel=LZ_LEVEL,
+        shadowBackend=SHADOW_BACKEND,
+        quantizer=QUANTIZER,
+        )
+
+    # Plan out all of the images and give them file IDs up front, so
+    # that they can be made in any order (or all at once)
+    pairs = [] # (first file ID, main filename, aux filename, cache key, (function, args))
+
+    # The top-screen images
     bottomImagesToMake = []
-    topPairs = []
     for levelName, levelConfig in config['levels'].items():
         theme = config['themes'][levelConfig['theme']]
-        main, aux = makeTopScreenIntroGraphics(
-            resources = resources,
-            title = levelConfig.get('title'),
-            name = levelConfig.get('name'),
-            background1 = hex2QColor(theme['background1']),
-            background2 = hex2QColor(theme['background2']),
-            banner1 = hex2QColor(theme['banner1']),
-            banner2 = hex2QColor(theme['banner2']),
-            preview = QtGui.QPixmap('previews/' + levelConfig['preview']),
+        # Like in renderText(), the font only matters for text that
+        # can't be drawn from the atlas
+        text = (levelConfig.get('title') or '') + (levelConfig.get('name') or '')
+        key = textcache.makeKey(
+            settings=settings,
+            font=None if atlasCanDraw(atlas, text) else installedFontHash(),
+            glyphAtlas=atlas.hash if atlas else None,
+            title=levelConfig.get('title'),
+            name=levelConfig.get('name'),
+            icons=textcache.iconHashes(text),
+            theme=theme,
+            preview=textcache.fileHash('previews/' + levelConfig['preview']),
             )
-
-        topId = next(fileId)
-
-        mainFn = '%d_%s_main' % (topId, levelName)
-        auxFn = '%d_%s_aux' % (topId + 1, levelName)
-        saveImagePair(main, aux, mainFn, auxFn, rom, topId)
-        topPairs.append([mainFn, auxFn])
+        if key in idsByKey:
+            topId = idsByKey[key]
+        else:
+            topId = idsByKey[key] = next(fileId)
+            mainFn = '%d_%s_main' % (topId, levelName)
+            auxFn = '%d_%s_aux' % (topId + 1, levelName)
+            pairs.append((topId, mainFn, auxFn, key,
+                          (renderTopPair, (levelConfig, theme, mainFn, auxFn, key))))
 
         bottomImageId = (levelConfig['theme'], levelConfig['bottom'])
         if bottomImageId not in bottomImagesToMake:
@@ -748,25 +1052,21 @@ def makeImages():
         fileIdMap[(levelConfig['world'] - 1) * 24 + levelConfig['number']] = \
             (topId, bottomImagesToMake.index(bottomImageId))
 
-    # Make the bottom-screen images
+    # The bottom-screen images
     bottomFileIds = []
-    bottomPairs = []
     for i, (themeName, btm) in enumerate(bottomImagesToMake):
-        print(f'Rendering bottom-screen graphics for {btm.split(".")[0]}'
-            f' with the "{themeName}" theme ({i+1}/{len(bottomImagesToMake)})...')
         theme = config['themes'][themeName]
-        main, aux = makeBottomScreenIntroGraphics(
-            resources = resources,
-            background1 = hex2QColor(theme['background1']),
-            background2 = hex2QColor(theme['background2']),
-            banner1 = hex2QColor(theme['banner1']),
-            banner2 = hex2QColor(theme['banner2']),
-            icon = QtGui.QPixmap('bottoms/' + btm),
+        key = textcache.makeKey(
+            settings=settings,
+            theme=theme,
+            icon=textcache.fileHash('bottoms/' + btm),
             )
+        if key in idsByKey:
+            bottomFileIds.append(idsByKey[key])
+            continue
 
-        btmId = next(fileId)
+        btmId = idsByKey[key] = next(fileId)
         bottomFileIds.append(btmId)
-
         mainFn = '_'.join([str(btmId),
                            'btm',
                            btm.split('.')[0],
@@ -777,8 +1077,79 @@ def makeImages():
                           btm.split('.')[0],
                           themeName,
                           'aux'])
-        saveImagePair(main, aux, mainFn, auxFn, rom, btmId)
-        bottomPairs.append([mainFn, auxFn])
+        progress = f'{i+1}/{len(bottomImagesToMake)}'
+        pairs.append((btmId, mainFn, auxFn, key,
+                      (renderBottomPair, (themeName, btm, theme, mainFn, auxFn, key, progress))))
+
+    shared = len(config['levels']) + len(bottomImagesToMake) - len(pairs)
+    if shared:
+        print(f'{shared} image pairs are the same as others, and will be shared')
+
+    # Reuse whatever hasn't changed since it was last made
+    cached = {}
+    if not rebuild:
+        with instrument.stage('build cache'):
+            for firstFileID, mainFn, auxFn, key, task in pairs:
+                data = buildcache.load(key, [mainFn, auxFn])
+                if data is not None:
+                    cached[firstFileID] = data
+    print(f'Reusing {len(cached)} of {len(pairs)} image pairs from the build cache')
+    instrument.count('pairs from the build cache', len(cached))
+    tasks = [(mainFn, task) for firstFileID, mainFn, _, _, task in pairs if firstFileID not in cached]
+
+    # ENPGs that come out the same as ones in the ROM being reused from
+    # don't have to be compressed again
+    romIndex = {}
+    if reuseFrom is not None and tasks:
+        with instrument.stage('rom index'):
+            romIndex = romreuse.buildIndex(reuseFrom, range(FIRST_PAIR_ID, END_PAIR_ID))
+        print(f'Found {len(romIndex)} compressed ENPGs to reuse in "{reuseFrom}"')
+
+    # Make the rest, streaming them in order: each pair is rendered,
+    # converted and compressed, its output files are written in the
+    # background (see saveImagePair()), and only the compressed ENPGs
+    # come back here to be put into the rom
+    if jobs == 1 or len(tasks) <= 1:
+        pool = None
+        initRenderer(None, romIndex)
+        results = map(runTask, tasks)
+    else:
+        # Qt doesn't survive fork(), so the workers have to be spawned
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(jobs)
+        pool = context.Pool(jobs, initializer=initRenderer, initargs=(instrument.settings(), romIndex, barrier))
+        results = imapBounded(pool, runTask, tasks, 2 * jobs)
+
+    # And put everything into the rom in order
+    topPairs = []
+    bottomPairs = []
+    manifest = {}
+    for firstFileID, mainFn, auxFn, key, (func, args) in pairs:
+        if firstFileID in cached:
+            data1, data2 = cached[firstFileID]
+        else:
+            (data1, data2), taskStats = next(results)
+            instrument.mergeStats(taskStats)
+
+        insertImagePair(rom, firstFileID, mainFn, auxFn, data1, data2)
+        manifest[mainFn] = manifest[auxFn] = key
+        if func is renderTopPair:
+            topPairs.append([mainFn, auxFn])
+        else:
+            bottomPairs.append([mainFn, auxFn])
+
+    # Wait for all the output files (and build cache entries) to be
+    # written
+    with instrument.stage('write queue'):
+        if pool is not None:
+            for writerStats in pool.map(finishWriting, range(jobs), chunksize=1):
+                instrument.mergeStats(writerStats)
+            pool.close()
+            pool.join()
+        else:
+            renderer['writer'].close()
+
+    buildcache.saveManifest(manifest)
 
     print('Saving everything...')
 
@@ -789,7 +1160,7 @@ def makeImages():
         fileIdData[idx * 2 + 1] = bottomFileIds[btmIdx]
 
     fileIdBytes = struct.pack('<%dH' % len(fileIdData), *fileIdData)
-    fileIdBytesComp = ndspy.lz10.compress(fileIdBytes)
+    fileIdBytesComp = compressLZ(fileIdBytes)
     with open('fileIDs.nerds', 'wb') as f:
         f.write(fileIdBytes)
     with open('fileIDs.nerds.lz', 'wb') as f:
@@ -800,15 +1171,43 @@ def makeImages():
     with open('conversionInfo.json', 'w', encoding='utf-8') as f:
         json.dump({'top': topPairs, 'bottom': bottomPairs}, f)
 
-    with open('Newer Super Mario Bros. DS.nds', 'wb') as f:
-        f.write(rom.save())
+    with instrument.stage('rom'):
+        rom.save('Newer Super Mario Bros. DS.nds')
 
     print('Done! :D')
 
+    return {'jobs': jobs, 'pairs': len(pairs), 'cached': len(cached)}
 
-def main():
-    app = QtGui.QGuiApplication([])
-
-    makeImages()
 
-main()
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(
+        description='Newer DS Level Intro Graphics Compiler')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of levels to render at once (default: 1)')
+    parser.add_argument('--rebuild', action='store_true',
+        help="remake every image, even ones that haven't changed")
+    parser.add_argument('--reuse-from', metavar='ROM', nargs='?', const='Newer Super Mario Bros. DS Orig.nds',
+        help="reuse the compressed ENPGs in ROM (such as the last release; default: the input ROM)"
+             " for any that come out the same, instead of compressing them again")
+    parser.add_argument('--report', metavar='FILE',
+        help='time each stage of the build, print a summary, and save the details to FILE as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+        help='run the build (and every worker process) under cProfile, and save the profile to FILE')
+    args = parser.parse_args()
+
+    instrument.configure(args.report is not None, args.profile)
+    instrument.start()
+
+    # Qt is only started once something needs it (see startQt())
+    info = makeImages(max(args.jobs, 1), args.rebuild, args.reuse_from)
+
+    if instrument.enabled:
+        instrument.saveProfile()
+        report = instrument.report(**info)
+        instrument.printSummary(report)
+        if args.report is not None:
+            instrument.saveReport(args.report, report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# Newer DS image conversions between Qt, PIL and NumPy, shared by the
+# level preview and title screen compilers
+
+# Images used to be converted by saving them as PNGs and loading them
+# again. These functions copy the pixels across directly instead, with
+# the same results: non-premultiplied RGBA (or RGB, for images without
+# an alpha channel, just like Qt saves them). There are also a few
+# helpers that work on the pixels as arrays.
+
+import numpy
+import PIL.Image
+from PyQt5 import QtGui
+
+
+def qImageBits(img):
+    """
+    Return a QImage's pixel buffer as a 2D uint8 array of shape
+    (height, bytesPerLine), without copying it. The array is only valid
+    for as long as img is.
+    """
+    bits = img.constBits()
+    bits.setsize(img.byteCount())
+    return numpy.frombuffer(bits, numpy.uint8).reshape(img.height(), img.bytesPerLine())
+
+
+def toQImage(img):
+    """
+    Return img as a QImage, if it's a QPixmap (or anything else with a
+    toImage() method, like compositor.Pixmap).
+    """
+    if isinstance(img, QtGui.QImage):
+        return img
+    return img.toImage()
+
+
+def alphaPlane(img):
+    """
+    Return a QImage's alpha channel as a 2D uint8 array.
+    """
+    img = toQImage(img).convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+    pixels = qImageBits(img).view(numpy.uint32)
+    return (pixels[:, :img.width()] >> 24).astype(numpy.uint8)
+
+
+def argbArray(img):
+    """
+    Return a QImage's pixels as a 2D uint32 array of ARGB values, the
+    same as QImage.pixel() would return (so, premultiplied if the image
+    is).
+    """
+    img = toQImage(img)
+    if img.pixelFormat().premultiplied() == QtGui.QPixelFormat.Premultiplied:
+        img = img.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+    else:
+        img = img.convertToFormat(QtGui.QImage.Format_ARGB32)
+    return qImageBits(img).view(numpy.uint32)[:, :img.width()].copy()
+
+
+def argbArrayToQImage(pixels):
+    """
+    Convert a 2D uint32 array of non-premultiplied ARGB values to a
+    QImage.
+    """
+    pixels = numpy.ascontiguousarray(pixels, numpy.uint32)
+    h, w = pixels.shape
+    img = QtGui.QImage(pixels.tobytes(), w, h, 4 * w, QtGui.QImage.Format_ARGB32)
+    # QImage doesn't keep the buffer alive, so detach it
+    return img.copy()
+
+
+def findAutocropSize(img):
+    """
+    Return the x, y, w, h of the image if it were autocropped
+    (w and h are one less than the size of the non-transparent area,
+    which is what everything has been laid out with)
+    """
+    alpha = alphaPlane(img)
+    cols = numpy.flatnonzero(alpha.any(axis=0))
+    rows = numpy.flatnonzero(alpha.any(axis=1))
+    if not len(cols):
+        return 0, 0, 0, 0
+
+    minX, maxX = int(cols[0]), int(cols[-1])
+    minY, maxY = int(rows[0]), int(rows[-1])
+    return minX, minY, maxX - minX, maxY - minY
+
+
+def qImageToArray(img):
+    """
+    Convert a QImage or QPixmap to an RGBA uint8 array of shape
+    (height, width, 4).
+    """
+    img = toQImage(img).convertToFormat(QtGui.QImage.Format_RGBA8888)
+    return qImageBits(img)[:, :img.width() * 4].reshape(img.height(), img.width(), 4).copy()
+
+
+def qImageToPilImage(img):
+    """
+    Convert a QImage or QPixmap to a PIL Image ("RGBA", or "RGB" if it
+    has no alpha channel).
+    """
+    img = toQImage(img)
+    if img.hasAlphaChannel():
+        mode, fmt = 'RGBA', QtGui.QImage.Format_RGBA8888
+    else:
+        mode, fmt = 'RGB', QtGui.QImage.Format_RGB888
+    img = img.convertToFormat(fmt)
+
+    bits = img.constBits()
+    bits.setsize(img.byteCount())
+    return PIL.Image.frombytes(mode, (img.width(), img.height()), bits.asstring(),
+                               'raw', mode, img.bytesPerLine())
+
+
+def arrayToQImage(array):
+    """
+    Convert an RGBA uint8 array of shape (height, width, 4) to a QImage.
+    """
+    array = numpy.ascontiguousarray(array, numpy.uint8)
+    h, w, _ = array.shape
+    img = QtGui.QImage(array.tobytes(), w, h, 4 * w, QtGui.QImage.Format_RGBA8888)
+    # QImage doesn't keep the buffer alive, so detach it
+    return img.copy()
+
+
+def pilImageToQImage(img):
+    """
+    Convert a PIL Image to a QImage.
+    """
+    return arrayToQImage(numpy.asarray(img.convert('RGBA')))
@@ -0,0 +1,308 @@
+# Newer DS build instrumentation, shared by the level preview and title
+# screen compilers
+
+# Stages of the build are wrapped in "with instrument.stage(name):", and
+# things worth counting (pixels, bytes, processes...) are passed to
+# instrument.count(). Both do nothing unless configure() turned
+# instrumentation on, so they can stay in the code for good.
+
+# Each stage's time is kept both including and excluding the stages
+# nested inside it ("self" time), in total and per item (an image pair,
+# for the level preview compiler). Every process keeps its own totals:
+# worker processes hand theirs back with takeStats(), and the main
+# process adds them up with mergeStats().
+
+# Stages can also be timed on other threads, with threadStage(). Those
+# are kept apart (behind a lock) until takeStats() or report() adds them
+# in, since everything else here is only ever touched by one thread.
+
+# Optionally, the build can also be run under cProfile. Workers dump
+# their profiles next to the main one, and saveProfile() merges them.
+
+import cProfile
+import glob
+import json
+import os
+import pstats
+import threading
+import time
+
+
+enabled = False
+profileFn = None
+profiler = None
+profiling = False
+
+stats = None
+stack = []
+currentItem = None
+startTime = None
+
+threadLock = threading.Lock()
+threadStats = None
+
+
+def newStats():
+    return {'stages': {}, 'counters': {}, 'items': {}}
+
+
+class NullStage:
+    """
+    What stage() returns when instrumentation is off.
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """
+    Times a stage of the build (see stage()).
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0
+        stack.append(self)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+
+        calls, seconds, selfSeconds = stats['stages'].get(self.name, (0, 0, 0))
+        stats['stages'][self.name] = (calls + 1, seconds + elapsed,
+                                      selfSeconds + elapsed - self.children)
+        if currentItem is not None:
+            itemStages = stats['items'][currentItem]['stages']
+            itemStages[self.name] = itemStages.get(self.name, 0) + elapsed - self.children
+
+
+def configure(enable, profile=None):
+    """
+    Turn instrumentation on or off in this process, and optionally
+    profile it with cProfile into the file given.
+    """
+    global enabled, profileFn, profiler, stats, threadStats
+    enabled = enable or profile is not None
+    profileFn = profile
+    profiler = cProfile.Profile() if profile is not None else None
+    stats = newStats()
+    threadStats = newStats()
+
+
+def settings():
+    """
+    Return the arguments to pass to configure() in worker processes.
+    """
+    return enabled, profileFn
+
+
+def start():
+    """
+    Start timing (and profiling) the whole build, in the main process.
+    """
+    global startTime, profiling
+    if not enabled:
+        return
+    startTime = time.perf_counter()
+    if profiler is not None:
+        for fn in glob.glob(glob.escape(profileFn) + '.*'):
+            os.remove(fn)
+        profiler.enable()
+        profiling = True
+
+
+def stage(name):
+    """
+    Return a context manager that times a stage of the build.
+    """
+    if not enabled:
+        return NULL_STAGE
+    return Stage(name)
+
+
+class ThreadStage:
+    """
+    Times a stage of the build on another thread (see threadStage()).
+    """
+    def __init__(self, name, itemName):
+        self.name = name
+        self.itemName = itemName
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with threadLock:
+            calls, seconds, selfSeconds = threadStats['stages'].get(self.name, (0, 0, 0))
+            threadStats['stages'][self.name] = (calls + 1, seconds + elapsed, selfSeconds + elapsed)
+            if self.itemName is not None:
+                itemStats = threadStats['items'].setdefault(self.itemName, {'seconds': 0, 'stages': {}})
+                itemStats['stages'][self.name] = itemStats['stages'].get(self.name, 0) + elapsed
+
+
+def threadStage(name, itemName=None):
+    """
+    Like stage(), but for threads other than the main one. These stages
+    can't be nested, and aren't part of any item unless one is named.
+    """
+    if not enabled:
+        return NULL_STAGE
+    return ThreadStage(name, itemName)
+
+
+def collectThreadStats():
+    """
+    Add the stages timed with threadStage() so far to this process's
+    stats.
+    """
+    global threadStats
+    with threadLock:
+        addStats(stats, threadStats)
+        threadStats = newStats()
+
+
+def count(name, n=1):
+    """
+    Add n to a counter.
+    """
+    if enabled:
+        stats['counters'][name] = stats['counters'].get(name, 0) + n
+
+
+class Item:
+    """
+    Times everything done for one item (see item()).
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global currentItem
+        currentItem = self.name
+        stats['items'].setdefault(self.name, {'seconds': 0, 'stages': {}})
+        if profiler is not None and not profiling:
+            profiler.enable()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        global currentItem
+        stats['items'][self.name]['seconds'] += time.perf_counter() - self.start
+        currentItem = None
+        if profiler is not None and not profiling:
+            # This is a worker process, which might be stopped at any
+            # time once it's done, so save its profile right away
+            profiler.disable()
+            profiler.dump_stats(f'{profileFn}.{os.getpid()}')
+
+
+def item(name):
+    """
+    Return a context manager that attributes all stages inside it to
+    one item, such as an image pair.
+    """
+    if not enabled:
+        return NULL_STAGE
+    return Item(name)
+
+
+def takeStats():
+    """
+    Return this process's stats (or None, if instrumentation is off),
+    and start over.
+    """
+    global stats
+    if not enabled:
+        return None
+    collectThreadStats()
+    taken, stats = stats, newStats()
+    return taken
+
+
+def mergeStats(other):
+    """
+    Add stats from takeStats() (in another process) to this process's.
+    """
+    if not enabled or other is None:
+        return
+    addStats(stats, other)
+
+
+def addStats(stats, other):
+    """
+    Add one set of stats to another.
+    """
+    for name, (calls, seconds, selfSeconds) in other['stages'].items():
+        old = stats['stages'].get(name, (0, 0, 0))
+        stats['stages'][name] = (old[0] + calls, old[1] + seconds, old[2] + selfSeconds)
+    for name, n in other['counters'].items():
+        stats['counters'][name] = stats['counters'].get(name, 0) + n
+    for name, itemStats in other['items'].items():
+        mine = stats['items'].setdefault(name, {'seconds': 0, 'stages': {}})
+        mine['seconds'] += itemStats['seconds']
+        for stageName, seconds in itemStats['stages'].items():
+            mine['stages'][stageName] = mine['stages'].get(stageName, 0) + seconds
+
+
+def saveProfile():
+    """
+    Stop profiling, and save this process's profile merged with the
+    workers' ones.
+    """
+    global profiling
+    if profiler is None:
+        return
+    profiler.disable()
+    profiling = False
+    combined = pstats.Stats(profiler)
+    for fn in glob.glob(glob.escape(profileFn) + '.*'):
+        combined.add(fn)
+        os.remove(fn)
+    combined.dump_stats(profileFn)
+
+
+def report(**extra):
+    """
+    Return everything measured as a JSON-serializable dict, with any
+    extra information given.
+    """
+    collectThreadStats()
+    return {
+        'seconds': time.perf_counter() - startTime,
+        **extra,
+        'stages': {name: {'calls': calls, 'seconds': seconds, 'self': selfSeconds}
+                   for name, (calls, seconds, selfSeconds) in stats['stages'].items()},
+        'counters': stats['counters'],
+        'items': stats['items'],
+        }
+
+
+def saveReport(fn, data):
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+
+
+def printSummary(data, slowest=5):
+    """
+    Print a short summary of a report().
+    """
+    print(f'Build took {data["seconds"]:.2f}s')
+    if data['stages']:
+        print(f'    {"Stage":<24}{"Calls":>8}{"Total":>10}{"Self":>10}')
+        for name, stage in sorted(data['stages'].items(), key=lambda s: -s[1]['self']):
+            print(f'    {name:<24}{stage["calls"]:>8}{stage["seconds"]:>9.2f}s{stage["self"]:>9.2f}s')
+    for name, n in sorted(data['counters'].items()):
+        print(f'    {name}: {n:,}')
+    items = sorted(data['items'].items(), key=lambda i: -i[1]['seconds'])[:slowest]
+    if items:
+        print('    Slowest: ' + ', '.join(f'{name} ({i["seconds"]:.2f}s)' for name, i in items))
@@ -0,0 +1,55 @@
+# Newer DS LZ77 Compressor Benchmark
+# Compares LZ77_Compress against the original brute-force search on the
+# ENPGs from the last graphics-compiler.py run.
+
+import argparse
+import glob
+import time
+
+import lz77
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark lz77.LZ77_Compress against the reference compressor.')
+    parser.add_argument('files', nargs='*',
+        help='files to compress (default: out-enpg/*.enpg)')
+    parser.add_argument('--limit', type=int, default=None,
+        help='only use the first N files (the reference compressor is slow)')
+    args = parser.parse_args()
+
+    fns = args.files or sorted(glob.glob('out-enpg/*.enpg'))
+    fns = fns[:args.limit]
+    if not fns:
+        print('No input files! Run graphics-compiler.py first, or pass some filenames.')
+        return
+
+    totalNew = totalRef = 0
+    totalIn = totalOut = 0
+    for fn in fns:
+        with open(fn, 'rb') as f:
+            data = f.read()
+
+        start = time.perf_counter()
+        new = lz77.LZ77_Compress(data)
+        timeNew = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ref = lz77.LZ77_Compress_Reference(data)
+        timeRef = time.perf_counter() - start
+
+        if new != ref:
+            raise ValueError(f'Output mismatch for {fn}!')
+
+        print(f'{fn}: {len(data)} -> {len(new)} bytes,'
+              f' {timeRef:.2f}s -> {timeNew:.2f}s ({timeRef / timeNew:.1f}x)')
+        totalNew += timeNew
+        totalRef += timeRef
+        totalIn += len(data)
+        totalOut += len(new)
+
+    print(f'Total ({len(fns)} files): {totalIn} -> {totalOut} bytes,'
+          f' {totalRef:.2f}s -> {totalNew:.2f}s ({totalRef / totalNew:.1f}x)')
+
+
+main()
@@ -15,12 +15,22 @@
 # along with NSMB Editor 5.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import bisect
 import struct
 
 
+MAX_MATCH_DIFF = 4096
+MAX_MATCH_LEN = 18
+MIN_MATCH_LEN = 3
+
+
 def LZ77_Compress_Search(data, pos):
-    maxMatchDiff = 4096
-    maxMatchLen = 18
+    """
+    Brute-force longest-match search. This is the original
+    implementation; it's kept as a reference for LZ77_MatchFinder.
+    """
+    maxMatchDiff = MAX_MATCH_DIFF
+    maxMatchLen = MAX_MATCH_LEN
     match = length = 0
 
     start = pos - maxMatchDiff
@@ -44,7 +54,82 @@ def LZ77_Compress_Search(data, pos):
 
     return match, length
 
-def LZ77_Compress(data, header=False):
+
+class LZ77_MatchFinder:
+    """
+    Hash-chain match finder. Every position is filed under the 3 bytes
+    that start there, so a search only has to look at window positions
+    that can produce a usable match, instead of all 4096 of them.
+
+    search() returns the same match as LZ77_Compress_Search whenever
+    that one is long enough to be encoded (3+ bytes): the earliest
+    position in the window with the longest match, never overlapping
+    the search position. Shorter matches are reported as (0, 0).
+    """
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.chains = {}
+        self.indexed = 0
+
+    def search(self, pos):
+        data = self.data
+        chains = self.chains
+
+        # File all positions before this one under their 3-byte prefix.
+        # Chains are appended to in order, so they stay sorted.
+        end = min(pos, len(data) - MIN_MATCH_LEN + 1)
+        for p in range(self.indexed, end):
+            key = data[p:p + MIN_MATCH_LEN]
+            chain = chains.get(key)
+            if chain is None:
+                chains[key] = [p]
+            else:
+                chain.append(p)
+        self.indexed = max(self.indexed, end)
+
+        maxLen = min(MAX_MATCH_LEN, len(data) - pos)
+        if maxLen < MIN_MATCH_LEN:
+            return 0, 0
+        chain = chains.get(data[pos:pos + MIN_MATCH_LEN])
+        if chain is None:
+            return 0, 0
+
+        match = length = 0
+        # Skip everything that has already left the window
+        for i in range(bisect.bisect_left(chain, pos - MAX_MATCH_DIFF), len(chain)):
+            thisMatch = chain[i]
+            # Matches can't run into the current position, and positions
+            # only get closer to it from here on
+            limit = min(maxLen, pos - thisMatch)
+            if limit < MIN_MATCH_LEN:
+                break
+            if limit <= length:
+                continue
+            # Anything longer than the current best has to match here
+            if data[thisMatch + length] != data[pos + length]:
+                continue
+
+            thisLength = MIN_MATCH_LEN
+            while (thisLength < limit
+                   and data[pos + thisLength] == data[thisMatch + thisLength]):
+                thisLength += 1
+
+            if thisLength > length:
+                match = thisMatch
+                length = thisLength
+
+                if length == maxLen:
+                    break
+
+        return match, length
+
+
+def LZ77_Encode(data, search, header=False):
+    """
+    LZ77 (LZ10) compression, using search(pos) -> (match, length) to
+    decide what to encode at each position. Lengths below 3 mean a
+    literal byte.
+    """
     res = bytearray()
     if header:
         res.extend(b'LZ77')
@@ -66,7 +151,7 @@ def LZ77_Compress(data, header=False):
                 tempBufferCursor += 1
                 continue
 
-            searchPos, searchLen = LZ77_Compress_Search(data, current)
+            searchPos, searchLen = search(current)
             searchDisp = current - searchPos - 1
             if searchLen > 2: # We found a big match, let's write a compressed block.
                 blockFlags |= 1 << (7 - i)
@@ -80,4 +165,114 @@ def LZ77_Compress(data, header=False):
 
         res.extend(bytes([blockFlags]) + tempBuffer[:tempBufferCursor])
 
-    return bytes(res)
\ No newline at end of file
+    return bytes(res)
+
+
+def LZ77_Compress_Optimal(data, header=False):
+    """
+    Minimum-size LZ77 compression. Rather than always taking the longest
+    match, this picks the combination of matches and literals that
+    produces the smallest output.
+    """
+    n = len(data)
+    finder = LZ77_MatchFinder(data)
+    matches = [finder.search(pos) for pos in range(n)]
+
+    # Every block of 8 tokens has a flag byte, and literals (and the
+    # padding at the end) take 1 byte each and matches 2, which makes
+    # the output size 9 * ceil(tokens / 8) + matches + the 4-byte size
+    # header. cost[pos][r] is the fewest bytes needed for data[pos:],
+    # given that r tokens of the current block have been used already.
+    cost = [None] * (n + 1)
+    cost[n] = (0,) * 8
+    for pos in range(n - 1, -1, -1):
+        # Rotate so that index r holds the cost after one more token
+        nxt = cost[pos + 1]
+        best = nxt[1:] + nxt[:1]
+        length = matches[pos][1]
+        if length >= MIN_MATCH_LEN:
+            afterMatch = tuple(map(min, zip(*cost[pos + MIN_MATCH_LEN:pos + length + 1])))
+            afterMatch = afterMatch[1:] + afterMatch[:1]
+            best = tuple(min(lit, match + 1) for lit, match in zip(best, afterMatch))
+        cost[pos] = (best[0] + 9,) + best[1:]
+
+    # Walk forward through the table to recover the choices
+    plan = {}
+    pos = r = 0
+    while pos < n:
+        target = cost[pos][r] - (9 if r == 0 else 0)
+        r = (r + 1) % 8
+        match, length = matches[pos]
+        while length >= MIN_MATCH_LEN and cost[pos + length][r] + 1 != target:
+            length -= 1
+        if length >= MIN_MATCH_LEN:
+            plan[pos] = match, length
+            pos += length
+        else:
+            plan[pos] = 0, 0
+            pos += 1
+
+    return LZ77_Encode(data, plan.__getitem__, header)
+
+
+def LZ77_Compress(data, header=False, level='greedy'):
+    """
+    LZ77 (LZ10) compression. level can be 'greedy' (always take the
+    longest match: fast) or 'optimal' (find the smallest output: slow).
+    """
+    if level == 'greedy':
+        return LZ77_Encode(data, LZ77_MatchFinder(data).search, header)
+    elif level == 'optimal':
+        return LZ77_Compress_Optimal(data, header)
+    raise ValueError(f'Unknown compression level: {level!r}')
+
+
+def LZ77_Compress_Reference(data, header=False):
+    """
+    LZ77_Compress, but with the original brute-force search. Very slow;
+    only useful for checking and benchmarking LZ77_Compress.
+    """
+    return LZ77_Encode(data, lambda pos: LZ77_Compress_Search(data, pos), header)
+
+
+def LZ77_Decompress(data):
+    """
+    Decompress LZ77 (LZ10) data, with or without the "LZ77" header.
+    """
+    pos = 4 if data[:4] == b'LZ77' else 0
+    if data[pos] != 0x10:
+        raise ValueError('Not LZ77-compressed data')
+
+    size = struct.unpack_from('<I', data, pos)[0] >> 8
+    pos += 4
+
+    res = bytearray()
+    while len(res) < size:
+        blockFlags = data[pos]
+        pos += 1
+        if not blockFlags:
+            # Eight literal bytes in a row
+            res += data[pos:pos + 8]
+            pos += 8
+            continue
+        for i in range(8):
+            if len(res) >= size:
+                break
+            if blockFlags & (1 << (7 - i)):
+                length = (data[pos] >> 4) + 3
+                disp = ((data[pos] & 0xF) << 8 | data[pos + 1]) + 1
+                pos += 2
+                start = len(res) - disp
+                if start < 0:
+                    raise ValueError('LZ77 match points before the start of the data')
+                if disp >= length:
+                    res += res[start:start + length]
+                else:
+                    # The match overlaps the bytes it's writing, so it
+                    # repeats the last disp bytes
+                    res += (res[start:] * (length // disp + 1))[:length]
+            else:
+                res.append(data[pos])
+                pos += 1
+
+    return bytes(res[:size])
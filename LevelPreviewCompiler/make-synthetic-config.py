@@ -0,0 +1,137 @@
+# Newer DS Synthetic Config Generator
+# Makes a config.json with any number of levels and themes, and random
+# preview images for the levels, so that graphics-compiler.py can be
+# benchmarked on projects bigger (or smaller) than the real one. See
+# benchmark.py, which uses this to measure how the build scales.
+
+import argparse
+import collections
+import json
+import os
+import random
+
+import PIL.Image
+import PIL.ImageDraw
+
+
+# Same as the real previews
+PREVIEW_SIZE = (156, 112)
+
+# Level numbers go from 1 to this in each world (fileIDs.nerds has room
+# for 24 per world, and 0 is unused)
+LEVELS_PER_WORLD = 23
+
+# Each level and each bottom-screen image takes one of the 180 image
+# pairs that fit in the ROM (see FIRST_PAIR_ID and END_PAIR_ID in
+# graphics-compiler.py)
+MAX_PAIRS = 180
+
+WORDS = [
+    'Acorn', 'Bramble', 'Cavern', 'Cliffs', 'Crystal', 'Desert', 'Dune',
+    'Falls', 'Forest', 'Fortress', 'Frost', 'Glade', 'Grove', 'Hollow',
+    'Jungle', 'Lagoon', 'Lava', 'Meadow', 'Mine', 'Peak', 'Reef',
+    'Ruins', 'Shore', 'Sky', 'Spire', 'Swamp', 'Tower', 'Valley',
+    ]
+
+
+def randomColor(rng):
+    return '%06x' % rng.randrange(0x1000000)
+
+
+def makePreview(rng):
+    """
+    Make a random preview image: a background with some rectangles and
+    ellipses on it, so that it quantizes and compresses about as well as
+    a real one.
+    """
+    img = PIL.Image.new('RGB', PREVIEW_SIZE, '#' + randomColor(rng))
+    draw = PIL.ImageDraw.Draw(img)
+    for _ in range(rng.randint(10, 40)):
+        x1, x2 = sorted(rng.randrange(PREVIEW_SIZE[0]) for _ in range(2))
+        y1, y2 = sorted(rng.randrange(PREVIEW_SIZE[1]) for _ in range(2))
+        shape = draw.rectangle if rng.random() < 0.5 else draw.ellipse
+        shape((x1, y1, x2, y2), fill='#' + randomColor(rng))
+    return img
+
+
+def makeConfig(levels, themes, outDir, seed=0, iconDir='characters', bottomDir='bottoms'):
+    """
+    Write a config.json with the given numbers of levels and themes to
+    outDir, with a "previews" folder of random preview images next to
+    it. Icons and bottom-screen images are picked from the ones in
+    iconDir and bottomDir.
+    """
+    rng = random.Random(seed)
+    icons = sorted(fn[:-len('.png')] for fn in os.listdir(iconDir) if fn.endswith('.png'))
+    bottoms = sorted(fn for fn in os.listdir(bottomDir) if fn.endswith('.png'))
+
+    config = collections.OrderedDict()
+    config['themes'] = collections.OrderedDict()
+    for i in range(themes):
+        config['themes'][f'theme{i + 1}'] = collections.OrderedDict(
+            (part, randomColor(rng)) for part in ['background1', 'background2', 'banner1', 'banner2'])
+    themeNames = list(config['themes'])
+
+    config['levels'] = collections.OrderedDict()
+    previews = {}
+    bottomImages = set()
+    for i in range(levels):
+        world, number = i // LEVELS_PER_WORLD + 1, i % LEVELS_PER_WORLD + 1
+        levelName = f'{world}-{number}'
+
+        # Like the real levels: mostly plain titles, but some with red
+        # text or icons in them
+        title = f'World {levelName}'
+        if icons and rng.random() < 0.125:
+            title = f'World {world}-[{rng.choice(icons)}]'
+        if rng.random() < 0.25:
+            title = title.replace('World ', 'World \\r')
+        name = ' '.join(rng.sample(WORDS, rng.randint(1, 3)))
+
+        preview = f'{levelName}.png'
+        previews[preview] = makePreview(rng)
+
+        theme = rng.choice(themeNames)
+        bottom = bottoms[(world - 1) % len(bottoms)]
+        bottomImages.add((theme, bottom))
+        config['levels'][levelName] = collections.OrderedDict([
+            ('theme', theme),
+            ('world', world),
+            ('number', number),
+            ('title', title),
+            ('name', name),
+            ('preview', preview),
+            ('bottom', bottom),
+            ])
+
+    if levels + len(bottomImages) > MAX_PAIRS:
+        raise ValueError(f'{levels} levels and {len(bottomImages)} bottom-screen images need more'
+                         f' than the {MAX_PAIRS} image pairs that fit in the ROM')
+
+    os.makedirs(os.path.join(outDir, 'previews'), exist_ok=True)
+    for fn, img in previews.items():
+        img.save(os.path.join(outDir, 'previews', fn))
+
+    with open(os.path.join(outDir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=4)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Make a config.json with random levels, for benchmarking.')
+    parser.add_argument('levels', type=int,
+        help='number of levels')
+    parser.add_argument('--themes', type=int, default=4,
+        help='number of themes (default: 4)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed (default: 0)')
+    parser.add_argument('--out', default='synthetic',
+        help='folder to write config.json and the previews to (default: synthetic)')
+    args = parser.parse_args()
+
+    makeConfig(args.levels, args.themes, args.out, args.seed)
+    print(f'Wrote {args.levels} levels with {args.themes} themes to "{args.out}"')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Newer DS text outlining, shared by the level preview and title screen
+# compilers
+
+# Text is outlined by dilating its alpha channel with a disk
+# (https://en.wikipedia.org/wiki/Dilation_(morphology)). The disk is
+# exactly the shape Qt rasterizes for the outline ellipse, so the result
+# is the same as painting one ellipse per opaque pixel.
+
+import functools
+
+import numpy
+from PyQt5 import QtCore, QtGui; Qt = QtCore.Qt
+
+from imagebridge import alphaPlane
+
+
+@functools.lru_cache()
+def ellipseFootprint(radius):
+    """
+    Return the pixels QPainter.drawEllipse(x - radius, y - radius,
+    2 * radius, 2 * radius) covers, relative to (x, y), as a list of
+    horizontal runs: (dy, dxStart, dxEnd), inclusive.
+    """
+    size = 4 * radius + 4
+    center = size // 2
+
+    img = QtGui.QImage(size, size, QtGui.QImage.Format_ARGB32_Premultiplied)
+    img.fill(Qt.transparent)
+    p = QtGui.QPainter(img)
+    p.setPen(Qt.NoPen)
+    p.setBrush(Qt.black)
+    p.drawEllipse(center - radius, center - radius, 2 * radius, 2 * radius)
+    del p
+
+    covered = alphaPlane(img) > 0
+    runs = []
+    for y in range(size):
+        row = covered[y]
+        # Find where each run of covered pixels starts and ends
+        edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], row.view(numpy.int8), [0]))))
+        for start, end in zip(edges[::2], edges[1::2]):
+            runs.append((y - center, start - center, end - 1 - center))
+    return runs
+
+
+def dilate(mask, footprint):
+    """
+    Dilate a 2D boolean array with a footprint from ellipseFootprint().
+    """
+    h, w = mask.shape
+
+    # Prefix sums along each row, so "is anything set between x1 and x2"
+    # is one subtraction
+    sums = numpy.zeros((h, w + 1), numpy.int32)
+    numpy.cumsum(mask, axis=1, out=sums[:, 1:])
+    xs = numpy.arange(w)
+
+    # Rows of the footprint that have the same run only need their
+    # horizontal pass done once
+    rowsForRun = {}
+    for dy, dx1, dx2 in footprint:
+        rowsForRun.setdefault((dx1, dx2), []).append(dy)
+
+    result = numpy.zeros_like(mask, dtype=bool)
+    for (dx1, dx2), dys in rowsForRun.items():
+        # The pixel at x is covered if anything in [x - dx2, x - dx1] is set
+        left = numpy.clip(xs - dx2, 0, w)
+        right = numpy.clip(xs - dx1 + 1, 0, w)
+        spread = (sums[:, right] - sums[:, left]) > 0
+
+        for dy in dys:
+            if abs(dy) >= h:
+                continue
+            if dy >= 0:
+                result[dy:] |= spread[:h - dy]
+            else:
+                result[:dy] |= spread[-dy:]
+
+    return result
+
+
+def makeOutline(img, color, radius):
+    """
+    Return a QImage the same size as img, filled with color everywhere
+    within an ellipse of the given radius from an opaque pixel in img.
+    Paint it with CompositionMode_DestinationOver to outline img.
+    """
+    return maskToImage(dilate(alphaPlane(img) > 0, ellipseFootprint(radius)), color)
+
+
+def maskToImage(mask, color):
+    """
+    Return a QImage filled with color wherever a 2D boolean array is
+    set, and transparent everywhere else.
+    """
+    pixels = numpy.where(mask, numpy.uint32(color.rgba()), numpy.uint32(0))
+    h, w = mask.shape
+    outline = QtGui.QImage(pixels.tobytes(), w, h, 4 * w, QtGui.QImage.Format_ARGB32)
+    # QImage doesn't keep the buffer alive, so detach it
+    return outline.copy()
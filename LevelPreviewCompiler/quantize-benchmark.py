@@ -0,0 +1,74 @@
+# Newer DS Quantizer Benchmark
+# Converts the image pairs from the last graphics-compiler.py run to
+# ENPGs with every quantizer in quantize.py, and prints how long each
+# one took and how far the ENPG colors end up from the original ones.
+
+import argparse
+import collections
+import glob
+import time
+
+import numpy
+import PIL.Image
+
+import enpg
+import quantize
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ENPG quantizers against each other.')
+    parser.add_argument('files', nargs='*',
+        help='"main" images to convert, along with their "aux" images (default: out-png/*_main.png)')
+    parser.add_argument('--limit', type=int, default=None,
+        help='only use the first N image pairs')
+    args = parser.parse_args()
+
+    fns = args.files or sorted(glob.glob('out-png/*_main.png'))
+    fns = fns[:args.limit]
+    if not fns:
+        print('No input files! Run graphics-compiler.py first, or pass some filenames.')
+        return
+
+    times = collections.defaultdict(float)
+    errors = collections.defaultdict(float)
+    for fn in fns:
+        # The aux image is the next file ID, with the same level name
+        fileID, name = fn[:-len('_main.png')].rsplit('/', 1)[-1].split('_', 1)
+        auxFn, = glob.glob(f'{fn.rsplit("/", 1)[0]}/{int(fileID) + 1}_{name}_aux.png')
+
+        # Combine them the same way graphics-compiler.py does
+        comb = PIL.Image.new('RGBA', (512, 256), (0, 0, 0, 0))
+        comb.paste(PIL.Image.open(fn).convert('RGBA'), (0, 0))
+        comb.paste(PIL.Image.open(auxFn).convert('RGBA'), (256, 0))
+        original = numpy.asarray(comb).astype(numpy.float64)
+        opaque = original[..., 3] == 255
+
+        line = []
+        for backend in quantize.QUANTIZERS:
+            start = time.perf_counter()
+            combQ = quantize.quantize(comb, backend, 255)
+            elapsed = time.perf_counter() - start
+
+            enpgs = enpg.enpgsFromQuantized(comb, combQ)
+            rendered = numpy.concatenate(
+                [numpy.asarray(enpg.enpgToImage(e)) for e in enpgs], axis=1)
+
+            # Mean distance between the original and ENPG colors, over
+            # the pixels that stay opaque
+            diff = rendered[..., :3][opaque] - original[..., :3][opaque]
+            error = numpy.sqrt((diff * diff).sum(axis=1)).mean() if opaque.any() else 0
+
+            times[backend] += elapsed
+            errors[backend] += error
+            line.append(f'{backend} {elapsed:.3f}s, error {error:.2f}')
+
+        print(f'{name}: ' + '; '.join(line))
+
+    print(f'Total ({len(fns)} pairs):')
+    for backend in quantize.QUANTIZERS:
+        print(f'    {backend}: {times[backend]:.2f}s,'
+              f' mean error {errors[backend] / len(fns):.2f}')
+
+
+main()
@@ -0,0 +1,156 @@
+# Newer DS palette quantizers, shared by the level preview and title
+# screen compilers
+
+# Every ENPG palette ends up as RGB555 (see enpg.packPalette()), so there
+# are two ways to pick one: 'liq' runs libimagequant on the full RGBA
+# image, and 'rgb555' first sorts the opaque pixels into a histogram of
+# the 32768 colors they can actually end up as, and then runs median cut
+# (refined with a few rounds of k-means) on the distinct colors in it.
+
+import libimagequant as liq  # pip install libimagequant
+import libimagequant_integrations.PIL  # pip install libimagequant-integrations
+import numpy
+import PIL.Image
+
+
+KMEANS_ITERATIONS = 4
+
+
+def quantizeLiq(img, maxColors):
+    attr = liq.Attr()
+    attr.max_colors = maxColors
+    img_liq = libimagequant_integrations.PIL.to_liq(img, attr)
+    return libimagequant_integrations.PIL.from_liq(img_liq.quantize(attr), img_liq)
+
+
+def rgb555Keys(rgb):
+    """
+    Return the RGB555 color (as packed by enpg.packPalette()) of each
+    pixel in an RGB uint8 array of shape (..., 3).
+    """
+    c = numpy.minimum((rgb.astype(numpy.uint16) + 4) >> 3, 0x1F)
+    return c[..., 0] | c[..., 1] << 5 | c[..., 2] << 10
+
+
+def nearest(colors, palette):
+    """
+    Return the index of the nearest palette entry to each color.
+    """
+    # |c - p|^2 = |c|^2 - 2 c.p + |p|^2, and |c|^2 doesn't affect which p
+    # is nearest
+    # (float32 is plenty for 5-bit colors, and much faster)
+    colors = colors.astype(numpy.float32)
+    palette = palette.astype(numpy.float32)
+    distances = (palette * palette).sum(axis=1) - 2 * colors @ palette.T
+    return distances.argmin(axis=1)
+
+
+def nearestLookup(palette):
+    """
+    Return a table of the nearest entry in an RGB555 palette (an array
+    of shape (n, 3), 5 bits per channel) to every RGB555 color, indexed
+    like rgb555Keys().
+    """
+    keys = numpy.arange(0x8000)
+    colors = numpy.stack([keys & 0x1F, (keys >> 5) & 0x1F, keys >> 10], axis=1)
+    return nearest(colors, numpy.asarray(palette)).astype(numpy.uint8)
+
+
+def medianCut(colors, weights, maxColors):
+    """
+    Split a weighted set of colors into at most maxColors boxes by
+    median cut, always splitting the box with the largest total squared
+    error next. Return the weighted mean color of each box.
+    """
+    def stats(box):
+        # Total weight, weighted sum of colors, and weighted sum of
+        # squared color lengths: enough to get the mean and error of a
+        # box and of everything split off from it
+        w = weights[box]
+        wc = colors[box] * w[:, None]
+        return w.sum(), wc.sum(axis=0), (wc * colors[box]).sum()
+
+    def error(s0, s1, s2):
+        return s2 - (s1 * s1).sum() / s0
+
+    boxes = [(numpy.arange(len(colors)), stats(numpy.arange(len(colors))))]
+    errors = [error(*boxes[0][1])]
+    while len(boxes) < maxColors:
+        i = int(numpy.argmax(errors))
+        if errors[i] <= 1e-6:
+            break
+        box, (s0, s1, s2) = boxes.pop(i)
+        errors.pop(i)
+
+        # Split along the channel with the widest spread, at the
+        # weighted median
+        spread = colors[box].max(axis=0) - colors[box].min(axis=0)
+        axis = int(numpy.argmax(spread))
+        box = box[numpy.argsort(colors[box, axis], kind='stable')]
+        w = weights[box]
+        cumulative = numpy.cumsum(w)
+        split = int(numpy.searchsorted(cumulative, cumulative[-1] / 2))
+        split = min(max(split, 1), len(box) - 1)
+
+        # The second half's stats are whatever the first half doesn't have
+        left = stats(box[:split])
+        right = (s0 - left[0], s1 - left[1], s2 - left[2])
+        for half, halfStats in [(box[:split], left), (box[split:], right)]:
+            boxes.append((half, halfStats))
+            errors.append(error(*halfStats))
+
+    return numpy.array([s1 / s0 for _, (s0, s1, _) in boxes])
+
+
+def quantizeRgb555(img, maxColors):
+    rgba = numpy.asarray(img.convert('RGBA'))
+    keys = rgb555Keys(rgba[..., :3])
+
+    # Only opaque pixels get a palette entry (see enpg.enpgsFromQuantized())
+    histogram = numpy.bincount(keys[rgba[..., 3] == 255], minlength=0x8000)
+    binKeys = numpy.flatnonzero(histogram)
+    weights = histogram[binKeys].astype(numpy.float64)
+    colors = numpy.stack([binKeys & 0x1F, (binKeys >> 5) & 0x1F, binKeys >> 10],
+                         axis=1).astype(numpy.float64)
+
+    if len(binKeys) <= maxColors:
+        palette = colors
+    else:
+        palette = medianCut(colors, weights, maxColors)
+
+        # Move each palette entry to the middle of the colors nearest to it
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = nearest(colors, palette)
+            counts = numpy.bincount(assignment, weights, len(palette))
+            totals = numpy.stack([numpy.bincount(assignment, colors[:, i] * weights, len(palette))
+                                  for i in range(3)], axis=1)
+            used = counts > 0
+            palette[used] = totals[used] / counts[used, None]
+
+        palette = numpy.clip(numpy.rint(palette), 0, 0x1F)
+
+    # Map every RGB555 color to its palette entry, and then every pixel
+    lut = numpy.zeros(0x8000, numpy.uint8)
+    if len(binKeys):
+        lut[binKeys] = nearest(colors, palette)
+    indices = lut[keys]
+
+    out = PIL.Image.frombytes('P', img.size, indices.tobytes())
+    # 8-bit values that enpg.packPalette() rounds back to the same RGB555
+    # colors
+    out.putpalette((palette.astype(numpy.uint8) * 8).flatten().tolist() or [0, 0, 0])
+    return out
+
+
+QUANTIZERS = {
+    'liq': quantizeLiq,
+    'rgb555': quantizeRgb555,
+    }
+
+
+def quantize(img, backend='liq', maxColors=256):
+    """
+    Reduce an RGBA PIL Image to a "P" image with at most maxColors
+    colors, with the quantizer named.
+    """
+    return QUANTIZERS[backend](img, maxColors)
@@ -0,0 +1,167 @@
+# Newer DS ROM Inspector
+# Extracts every level intro ENPG from a ROM and renders them as PNGs:
+# one per file, one per level (top-screen pair above the bottom-screen
+# pair, as listed in fileIDs.nerds), and a contact sheet of every level.
+# Also writes a JSON index of all of it, so that a built or shipped ROM
+# can be checked without running graphics-compiler.py again.
+
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+
+import PIL.Image
+
+import enpg
+import lz77
+import rompatch
+import romreuse
+
+
+# Same as in graphics-compiler.py
+FILE_IDS_FILE_ID = 2127
+FIRST_PAIR_ID = 2128
+END_PAIR_ID = 2488
+LEVELS_PER_WORLD = 24
+
+# zlib level for the per-level PNGs, which have too many colors to be
+# paletted: saving them at the default level takes longer than
+# everything else put together
+PNG_COMPRESS_LEVEL = 1
+
+# Size of each level in the contact sheet (levels are 512x512)
+THUMBNAIL_SIZE = 128
+
+
+def loadLevels(rom):
+    """
+    Parse fileIDs.nerds. Return a {(world, number): (top file ID,
+    bottom file ID)} dict of every level that has intro graphics.
+    """
+    data = lz77.LZ77_Decompress(rom.files[FILE_IDS_FILE_ID])
+    ids = struct.unpack(f'<{len(data) // 2}H', data)
+    levels = {}
+    for idx in range(len(ids) // 2):
+        top, bottom = ids[idx * 2:idx * 2 + 2]
+        if top or bottom:
+            levels[(idx // LEVELS_PER_WORLD + 1, idx % LEVELS_PER_WORLD)] = (top, bottom)
+    return levels
+
+
+def enpgToPaletteImage(data):
+    """
+    Like enpg.enpgToImage(), but returns a paletted image, which is much
+    quicker to save as a PNG.
+    """
+    colors = struct.unpack_from('<256H', data, enpg.ENPG_SIZE * enpg.ENPG_SIZE)
+    img = PIL.Image.frombytes('P', (enpg.ENPG_SIZE, enpg.ENPG_SIZE), data[:enpg.ENPG_SIZE * enpg.ENPG_SIZE])
+    img.putpalette([enpg.EXPAND_5_BIT[(c >> shift) & 0x1F] for c in colors for shift in (0, 5, 10)])
+    img.info['transparency'] = bytes(0 if c >> 15 else 255 for c in colors)
+    return img
+
+
+def extractFile(task):
+    """
+    Decompress one file from the ROM and save it as a PNG, if it's an
+    ENPG. Return (its index entry, the ENPG or None). This runs in the
+    worker processes.
+    """
+    fileID, name, data, outDir = task
+    entry = {'name': name, 'compressedSize': len(data), 'image': None}
+
+    try:
+        enpgData = lz77.LZ77_Decompress(data)
+    except (ValueError, IndexError):
+        enpgData = None
+    if enpgData is None or len(enpgData) != enpg.ENPG_LEN:
+        return entry, None
+
+    entry['sha256'] = romreuse.enpgHash(enpgData).hex()
+    entry['image'] = f'files/{os.path.splitext(name)[0]}.png'
+    enpgToPaletteImage(enpgData).save(os.path.join(outDir, entry['image']))
+    return entry, enpgData
+
+
+def makeLevelImage(enpgs, topID, bottomID):
+    """
+    Put a level's two image pairs together: top screen above, bottom
+    screen below, main images on the left and aux images on the right.
+    """
+    img = PIL.Image.new('RGBA', (enpg.ENPG_SIZE * 2, enpg.ENPG_SIZE * 2), (0, 0, 0, 0))
+    for y, firstID in enumerate([topID, bottomID]):
+        for x, fileID in enumerate([firstID, firstID + 1]):
+            if enpgs.get(fileID) is not None:
+                img.paste(enpg.enpgToImage(enpgs[fileID]), (x * enpg.ENPG_SIZE, y * enpg.ENPG_SIZE))
+    return img
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract and render the level intro graphics in a Newer DS ROM.')
+    parser.add_argument('rom', nargs='?', default='Newer Super Mario Bros. DS.nds',
+        help='ROM to inspect (default: the output of graphics-compiler.py)')
+    parser.add_argument('--out', default='out-inspect',
+        help='folder to write the images and index.json to (default: out-inspect)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+        help='number of files to decompress at once (default: one per CPU)')
+    parser.add_argument('--no-contact-sheet', action='store_true',
+        help="don't make contact-sheet.png")
+    args = parser.parse_args()
+
+    for folder in ['files', 'levels']:
+        os.makedirs(os.path.join(args.out, folder), exist_ok=True)
+
+    rom = rompatch.RomPatcher(args.rom)
+    folder = rom.filenames['zc_crsin']
+    fileIDs = range(FIRST_PAIR_ID, min(END_PAIR_ID, len(rom.files)))
+    tasks = [(fileID, folder.files[fileID - folder.firstID], rom.files[fileID], args.out)
+             for fileID in fileIDs]
+    levels = loadLevels(rom)
+    rom.close()
+
+    # Decompressing is the slow part, so that's done in parallel
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = pool.map(extractFile, tasks, chunksize=8)
+    else:
+        results = list(map(extractFile, tasks))
+
+    files = {}
+    enpgs = {}
+    for fileID, (entry, enpgData) in zip(fileIDs, results):
+        files[fileID] = entry
+        enpgs[fileID] = enpgData
+
+    index = {'rom': os.path.abspath(args.rom), 'levels': [], 'files': files}
+    sheet = None
+    if not args.no_contact_sheet and levels:
+        worlds = max(world for world, number in levels)
+        sheet = PIL.Image.new('RGBA', (LEVELS_PER_WORLD * THUMBNAIL_SIZE, worlds * THUMBNAIL_SIZE), (0, 0, 0, 0))
+
+    for (world, number), (topID, bottomID) in sorted(levels.items()):
+        image = f'levels/{world}-{number}.png'
+        img = makeLevelImage(enpgs, topID, bottomID)
+        img.save(os.path.join(args.out, image), compress_level=PNG_COMPRESS_LEVEL)
+        index['levels'].append({
+            'world': world,
+            'number': number,
+            'top': [topID, topID + 1],
+            'bottom': [bottomID, bottomID + 1],
+            'image': image,
+            })
+        if sheet is not None:
+            sheet.paste(img.reduce(img.width // THUMBNAIL_SIZE),
+                        (number * THUMBNAIL_SIZE, (world - 1) * THUMBNAIL_SIZE))
+
+    if sheet is not None:
+        sheet.save(os.path.join(args.out, 'contact-sheet.png'))
+    with open(os.path.join(args.out, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=4)
+
+    found = sum(entry['image'] is not None for entry in files.values())
+    print(f'Extracted {found} ENPGs (of {len(files)} files) for {len(levels)} levels to "{args.out}"')
+
+
+if __name__ == '__main__':
+    main()
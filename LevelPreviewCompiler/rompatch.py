@@ -0,0 +1,251 @@
+# Newer DS in-place ROM patcher, shared by the level preview and title
+# screen compilers
+
+# ndspy.rom.NintendoDSRom reads the whole ROM into memory and lays every
+# part of it out again when it's saved. The compilers only ever replace
+# existing files (and rename some), so this only reads the header, FAT
+# and FNT, and on save(), copies the ROM and memory-maps the copy. Each
+# new file is then written over the old one if it fits in the space
+# before whatever comes next in the ROM, or added to the end if not; the
+# FNT is handled the same way if any filenames changed.
+
+# The copy is made next to the output file under a temporary name and
+# renamed over it at the end, so an interrupted run never leaves a
+# half-written ROM behind. Where the filesystem supports it, the copy
+# shares the original's blocks instead of duplicating them, so only the
+# parts that changed are ever written.
+
+import bisect
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+import ndspy.fnt
+
+
+TEMP_PREFIX = '.tmp'
+
+ALIGNMENT = 0x200
+RSA_SIGNATURE_ALIGNMENT = 0x20
+RSA_SIGNATURE_LEN = 0x88
+
+# Header fields for the other things in the ROM: (offset, length) pairs
+# for the ARM9 and ARM7 code, their overlay tables and the debug ROM
+HEADER_REGIONS = [(0x20, 0x2C), (0x30, 0x3C), (0x50, 0x54), (0x58, 0x5C), (0x160, 0x164)]
+FNT_FIELD = 0x40
+FAT_FIELD = 0x48
+ICON_BANNER_FIELD = 0x68
+ROM_SIZE_FIELD = 0x80
+RSA_SIGNATURE_POINTER = 0x1000
+DEVICE_CAPACITY_FIELD = 0x14
+HEADER_CRC_FIELD = 0x15E
+
+ICON_BANNER_LENGTHS = {0x0001: 0x840, 0x0002: 0x940, 0x0003: 0xA40, 0x0103: 0x23C0}
+
+
+def crc16(data):
+    """
+    The CRC-16 used in the ROM header.
+    """
+    crc = 0xFFFF
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def copyFile(src, dst):
+    """
+    Copy a file, sharing its blocks instead of copying the data where
+    the filesystem supports that (e.g. btrfs or XFS).
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if not n:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            pass
+    if copied != size:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
+class RomFiles:
+    """
+    The files in a RomPatcher, indexed by file ID like
+    NintendoDSRom.files.
+    """
+    def __init__(self, patcher):
+        self.patcher = patcher
+
+    def __len__(self):
+        return len(self.patcher.fat)
+
+    def __getitem__(self, fileID):
+        if fileID in self.patcher.pending:
+            return self.patcher.pending[fileID]
+        start, end = self.patcher.fat[fileID]
+        return bytes(self.patcher.map[start:end])
+
+    def __setitem__(self, fileID, data):
+        if not 0 <= fileID < len(self.patcher.fat):
+            raise IndexError(f'File ID {fileID} is out of range; files can only be replaced')
+        self.patcher.pending[fileID] = bytes(data)
+
+
+class RomPatcher:
+    """
+    A ROM whose files and filenames can be changed like a
+    NintendoDSRom's (.files and .filenames), and then saved without
+    rebuilding the whole thing.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fatOffset, fatLen = struct.unpack_from('<II', self.map, FAT_FIELD)
+        self.fat = [list(entry) for entry in struct.iter_unpack('<II', self.map[fatOffset:fatOffset + fatLen])]
+
+        fntOffset, fntLen = struct.unpack_from('<II', self.map, FNT_FIELD)
+        self.fntData = bytes(self.map[fntOffset:fntOffset + fntLen])
+        self.filenames = ndspy.fnt.load(self.fntData)
+
+        self.files = RomFiles(self)
+        self.pending = {}
+
+    def close(self):
+        self.map.close()
+
+    def regions(self, header):
+        """
+        Return every (start, end) range in the ROM that something other
+        than a file's data is in, besides the RSA signature (which is
+        always moved to the end).
+        """
+        regions = [(0, 0x200)]
+        for field, lenField in HEADER_REGIONS + [(FNT_FIELD, FNT_FIELD + 4), (FAT_FIELD, FAT_FIELD + 4)]:
+            regions.append(struct.unpack_from('<I', header, field) + struct.unpack_from('<I', header, lenField))
+
+        iconBanner, = struct.unpack_from('<I', header, ICON_BANNER_FIELD)
+        if iconBanner:
+            version, = struct.unpack_from('<H', self.map, iconBanner)
+            regions.append((iconBanner, ICON_BANNER_LENGTHS.get(version, ICON_BANNER_LENGTHS[1])))
+
+        return [(start, start + length) for start, length in regions if length]
+
+    def save(self, fn):
+        """
+        Write the ROM, with all the changes, to a file (which can be the
+        one it was loaded from).
+        """
+        outDir = os.path.dirname(os.path.abspath(fn))
+        fd, tempFn = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix='.nds', dir=outDir)
+        os.close(fd)
+        try:
+            copyFile(self.fn, tempFn)
+            with open(tempFn, 'r+b') as f:
+                out = mmap.mmap(f.fileno(), 0)
+                try:
+                    self.patch(out)
+                    out.flush()
+                finally:
+                    out.close()
+            self.close()
+            os.replace(tempFn, fn)
+        except BaseException:
+            os.remove(tempFn)
+            raise
+
+    def patch(self, out):
+        """
+        Apply all the changes to a memory-mapped copy of the ROM.
+        """
+        header = bytearray(out[:0x200])
+        romSize, = struct.unpack_from('<I', header, ROM_SIZE_FIELD)
+        signature = bytes(out[romSize:romSize + RSA_SIGNATURE_LEN])
+
+        # Where everything that can't be overwritten starts, so that
+        # each file can be given the space up to the next one
+        fat = [list(entry) for entry in self.fat]
+        starts = sorted([start for start, end in self.regions(header)]
+                        + [start for start, end in fat if end > start])
+        tail = max([end for start, end in self.regions(header)]
+                   + [end for start, end in fat])
+
+        def write(offset, data):
+            nonlocal tail
+            if offset + len(data) > len(out):
+                out.resize(offset + len(data))
+            out[offset:offset + len(data)] = data
+            tail = max(tail, offset + len(data))
+
+        def room(start, end):
+            """
+            How much data fits at start, in place of what's there now.
+            """
+            i = bisect.bisect_right(starts, start)
+            if end <= start or (i >= 2 and starts[i - 2] == start):
+                # Empty, or sharing its data with something else
+                return 0
+            return starts[i] - start if i < len(starts) else float('inf')
+
+        def place(start, end, data):
+            """
+            Write data over whatever is at start..end, or at the end of
+            the ROM if it doesn't fit, and return where it went.
+            """
+            if len(data) <= room(start, end):
+                write(start, data)
+                return start
+            if end > start:
+                starts.remove(start)
+            newStart = align(tail)
+            write(newStart, data)
+            if data:
+                bisect.insort(starts, newStart)
+            return newStart
+
+        for fileID, data in sorted(self.pending.items()):
+            start, end = fat[fileID]
+            start = place(start, end, data)
+            fat[fileID] = [start, start + len(data)]
+
+        # Filenames
+        fntOffset, fntLen = struct.unpack_from('<II', header, FNT_FIELD)
+        fntData = ndspy.fnt.save(self.filenames)
+        if fntData != self.fntData:
+            fntOffset = place(fntOffset, fntOffset + fntLen, fntData)
+            struct.pack_into('<II', header, FNT_FIELD, fntOffset, len(fntData))
+
+        fatOffset, _ = struct.unpack_from('<II', header, FAT_FIELD)
+        for fileID in self.pending:
+            struct.pack_into('<II', out, fatOffset + 8 * fileID, *fat[fileID])
+
+        # The RSA signature (if any) goes at the very end, where the
+        # header says the ROM ends
+        if tail > romSize:
+            oldRomSize, romSize = romSize, align(tail, RSA_SIGNATURE_ALIGNMENT)
+            write(romSize, signature)
+            if struct.unpack_from('<I', out, RSA_SIGNATURE_POINTER)[0] == oldRomSize:
+                struct.pack_into('<I', out, RSA_SIGNATURE_POINTER, romSize)
+            struct.pack_into('<I', header, ROM_SIZE_FIELD, romSize)
+            out.resize(romSize + len(signature))
+
+            while 0x20000 << header[DEVICE_CAPACITY_FIELD] < len(out):
+                header[DEVICE_CAPACITY_FIELD] += 1
+
+        struct.pack_into('<H', header, HEADER_CRC_FIELD, crc16(header[:HEADER_CRC_FIELD]))
+        out[:0x200] = header
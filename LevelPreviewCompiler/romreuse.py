@@ -0,0 +1,56 @@
+# Newer DS compressed ENPG reuse for the level preview compiler
+
+# Compressing ENPGs is the slowest part of making an image pair, and most
+# of the time, the ENPGs that come out are the same as the ones already
+# in the last released ROM. So the compressed ENPGs in that ROM can be
+# indexed by a hash of what they decompress to, and any new ENPG with a
+# matching hash can reuse them instead of being compressed again. Unlike
+# the build cache, this doesn't need anything from earlier runs on this
+# machine, just the ROM.
+
+# Decompressing every file to index it isn't free either, so only files
+# whose LZ10 header says they decompress to the size of an ENPG are
+# looked at.
+
+import hashlib
+import struct
+
+import enpg
+import lz77
+import rompatch
+
+
+LZ10_MAGIC = 0x10
+
+
+def enpgHash(data):
+    return hashlib.sha256(data).digest()
+
+
+def buildIndex(fn, fileIDs):
+    """
+    Return a {hash: compressed data} dict of the LZ10-compressed ENPGs
+    with the given file IDs in a ROM.
+    """
+    rom = rompatch.RomPatcher(fn)
+    index = {}
+    try:
+        for fileID in fileIDs:
+            if fileID >= len(rom.files):
+                break
+            data = rom.files[fileID]
+            if len(data) < 4:
+                continue
+            header, = struct.unpack_from('<I', data)
+            if header & 0xFF != LZ10_MAGIC or header >> 8 != enpg.ENPG_LEN:
+                continue
+
+            try:
+                decompressed = lz77.LZ77_Decompress(data)
+            except (ValueError, IndexError):
+                continue
+            if len(decompressed) == enpg.ENPG_LEN:
+                index[enpgHash(decompressed)] = data
+    finally:
+        rom.close()
+    return index
@@ -0,0 +1,40 @@
+# Newer DS Text Shadow Comparison
+# Makes text shadows for some images with both the built-in shadow
+# backend and ImageMagick, and reports how much they differ.
+
+import argparse
+
+import numpy
+from PyQt5 import QtGui
+
+from imagebridge import alphaPlane
+import shadow
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the built-in text shadows against ImageMagick.')
+    parser.add_argument('images', nargs='+',
+        help='images to make shadows of (for example, rendered text)')
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication([])
+
+    shadows = {
+        'level preview (-morphology Convolve Blur:0x5,90)':
+            lambda img, backend: shadow.directionalBlurShadow(img, 5, backend),
+        'title screen (-blur 24x8)':
+            lambda img, backend: shadow.blurShadow(img, 24, 8, backend),
+        }
+
+    for fn in args.images:
+        img = QtGui.QImage(fn)
+        for name, makeShadow in shadows.items():
+            builtin = alphaPlane(makeShadow(img, 'builtin')).astype(int)
+            reference = alphaPlane(makeShadow(img, 'imagemagick')).astype(int)
+            diff = numpy.abs(builtin - reference)
+            print(f'{fn}, {name}: {numpy.count_nonzero(diff)} pixels differ,'
+                  f' max difference {diff.max()}')
+
+
+main()
@@ -0,0 +1,214 @@
+# Newer DS text shadows, shared by the level preview and title screen
+# compilers
+
+# A shadow is the image turned black and blurred. This used to be done
+# by ImageMagick, so the built-in backend follows ImageMagick 6 (Q16)
+# closely: the same kernels, edge handling and rounding. The ImageMagick
+# backend is still available as a reference: shadow-diff.py compares the
+# two on any ImageMagick 6 Q16 install.
+
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy
+from PyQt5 import QtGui
+
+import instrument
+from imagebridge import alphaPlane
+
+
+QUANTUM_RANGE = 65535
+KERNEL_RANK = 3
+
+
+def optimalKernelWidth(radius, sigma):
+    """
+    The kernel width ImageMagick picks for a blur radius and sigma
+    (GetOptimalKernelWidth1D()): with no radius, the kernel grows until
+    its edges are imperceptible.
+    """
+    if radius > 0:
+        return 2 * math.ceil(radius) + 1
+
+    alpha = 1 / (2 * sigma * sigma)
+    beta = 1 / (math.sqrt(2 * math.pi) * sigma)
+    width = 5
+    while True:
+        j = (width - 1) // 2
+        normalize = sum(math.exp(-i * i * alpha) * beta for i in range(-j, j + 1))
+        value = math.exp(-j * j * alpha) * beta / normalize
+        if value < 1 / QUANTUM_RANGE:
+            return width - 2
+        width += 2
+
+
+def morphologyBlurKernel(radius, sigma):
+    """
+    ImageMagick's "Blur:{radius}x{sigma}" morphology kernel: a 1D
+    Gaussian, supersampled KERNEL_RANK times per element.
+    """
+    if radius >= 1:
+        width = int(radius) * 2 + 1
+    else:
+        width = optimalKernelWidth(radius, sigma)
+
+    kernel = [0.0] * width
+    v = (width * KERNEL_RANK - 1) // 2
+    sigma *= KERNEL_RANK
+    alpha = 1 / (2 * sigma * sigma)
+    beta = 1 / (math.sqrt(2 * math.pi) * sigma)
+    for u in range(-v, v + 1):
+        kernel[(u + v) // KERNEL_RANK] += math.exp(-u * u * alpha) * beta
+
+    kernel = numpy.array(kernel)
+    return kernel / kernel.sum()
+
+
+def blurKernel(radius, sigma):
+    """
+    The 1D Gaussian kernel ImageMagick's "-blur {radius}x{sigma}" uses
+    (GetBlurKernel()).
+    """
+    j = (optimalKernelWidth(radius, sigma) - 1) // 2
+    k = numpy.arange(-j, j + 1, dtype=numpy.float64)
+    kernel = numpy.exp(-k * k / (2 * sigma * sigma)) / (math.sqrt(2 * math.pi) * sigma)
+    return kernel / kernel.sum()
+
+
+def convolve(plane, kernel, axis):
+    """
+    Convolve a 2D float array with a 1D kernel along one axis. Pixels
+    past the edges repeat the edge pixels, like ImageMagick's default
+    virtual pixel method.
+    """
+    r = len(kernel) // 2
+    padding = [(0, 0), (0, 0)]
+    padding[axis] = (r, r)
+    padded = numpy.pad(plane, padding, mode='edge')
+
+    n = plane.shape[axis]
+    result = numpy.zeros_like(plane)
+    for i, weight in enumerate(kernel):
+        if axis == 0:
+            result += weight * padded[i:i + n]
+        else:
+            result += weight * padded[:, i:i + n]
+    return result
+
+
+def toQuantum(values):
+    """
+    Round to ImageMagick quantum values (ClampToQuantum()).
+    """
+    return numpy.clip(numpy.floor(values + 0.5), 0, QUANTUM_RANGE)
+
+
+def quantumToChar(values):
+    """
+    Scale quantum values down to 8 bits (ScaleQuantumToChar()).
+    """
+    values = values.astype(numpy.int64) + 128
+    return ((values - (values >> 8)) >> 8).astype(numpy.uint8)
+
+
+def shadowImage(alpha):
+    """
+    Turn an alpha plane into a black QImage.
+    """
+    h, w = alpha.shape
+    pixels = alpha.astype(numpy.uint32) << 24
+    img = QtGui.QImage(pixels.tobytes(), w, h, 4 * w, QtGui.QImage.Format_ARGB32)
+    # QImage doesn't keep the buffer alive, so detach it
+    return img.copy()
+
+
+def directionalBlurShadow(img, sigma, backend='builtin'):
+    """
+    Return a shadow of the QImage, blurred vertically only.
+    Same as "-channel RGB -black-threshold 101% -channel RGBA
+    -morphology Convolve Blur:0x{sigma},90" in ImageMagick.
+    """
+    if backend == 'imagemagick':
+        return runImageMagick(img,
+            '-channel', 'RGB', # Only looking at the RGB channels...
+            '-black-threshold', '101%', # set them all to black
+            '-channel', 'RGBA', # Looking at all the channels again...
+            '-morphology', 'Convolve', f'Blur:0x{sigma},90', # http://im.snibgo.com/selblur.htm#blrxy
+            )
+
+    # ImageMagick 6 works with opacity rather than alpha
+    opacity = QUANTUM_RANGE - alphaPlane(img).astype(numpy.float64) * 257
+    opacity = toQuantum(convolve(opacity, morphologyBlurKernel(0, sigma), 0))
+    return shadowImage(quantumToChar(QUANTUM_RANGE - opacity))
+
+
+def blurShadow(img, radius, sigma, backend='builtin'):
+    """
+    Return a shadow of the QImage, blurred in both directions.
+    Same as "-channel RGB -black-threshold 101% -channel RGBA
+    -blur {radius}x{sigma}" in ImageMagick.
+    """
+    if backend == 'imagemagick':
+        return runImageMagick(img,
+            '-channel', 'RGB', # Only looking at the RGB channels...
+            '-black-threshold', '101%', # set them all to black
+            '-channel', 'RGBA', # Looking at all the channels again...
+            '-blur', f'{radius}x{sigma}',
+            )
+
+    # ImageMagick blurs the rows first, then the columns, rounding to
+    # quantum values after each pass
+    kernel = blurKernel(radius, sigma)
+    opacity = QUANTUM_RANGE - alphaPlane(img).astype(numpy.float64) * 257
+    opacity = toQuantum(convolve(opacity, kernel, 1))
+    opacity = toQuantum(convolve(opacity, kernel, 0))
+    return shadowImage(quantumToChar(QUANTUM_RANGE - opacity))
+
+
+def runImageMagick(*command):
+    """
+    Run ImageMagick with the command given. Commands are a list of
+    arguments, not unlike sys.argv. Where filenames are expected, just
+    put a QImage instance. Don't add anything where the output filename
+    would normally go. The resulting QImage will be returned.
+    """
+
+    OUTPUT_FN = 'output.png'
+
+    command = list(command)
+
+    imgs = {}
+    for i, part in enumerate(command):
+        if isinstance(part, QtGui.QImage):
+            fn = f'img{i}.png'
+            imgs[fn] = part
+
+    def fnFor(img):
+        return [fn for fn, img2 in imgs.items() if img2 is img][0]
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        def addDir(fn): return os.path.join(tmpdirname, fn)
+
+        imgs = {addDir(fn): img for fn, img in imgs.items()}
+
+        for fn, img in imgs.items():
+            img.save(fn)
+
+        command2 = ['convert']
+        for part in command:
+            if isinstance(part, QtGui.QImage):
+                command2.append(fnFor(part))
+            else:
+                command2.append(part)
+        command2.append(addDir(OUTPUT_FN))
+
+        instrument.count('ImageMagick processes')
+        if sys.platform == 'win32':
+            subprocess.run(command2, shell=True)
+        else:
+            subprocess.run(command2)
+
+        return QtGui.QImage(addDir(OUTPUT_FN))
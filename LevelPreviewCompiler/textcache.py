@@ -0,0 +1,168 @@
+# Newer DS rendered text cache, shared by the level preview and title
+# screen compilers
+
+# Rendering outlined, shadowed text is by far the most expensive part of
+# making an image, and lots of levels share the same titles. So rendered
+# text is kept on disk, keyed by everything that goes into it, and
+# reused across runs. The least recently used entries are deleted once
+# the cache grows past MAX_SIZE.
+
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from PyQt5 import QtGui
+
+import instrument
+from imagebridge import toQImage
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'text')
+MAX_SIZE = 64 * 1024 * 1024
+
+TEMP_PREFIX = '.tmp'
+HEADER = struct.Struct('<4s4I')
+# Changed whenever what goes into the keys changes, so that entries made
+# by older versions are never used
+MAGIC = b'TXC2'
+
+
+def fileHash(fn, ignore=None):
+    """
+    Return the SHA-256 hash of a file's contents, as a hex string. If
+    ignore is a regex, lines that match it are left out.
+    """
+    with open(fn, 'rb') as f:
+        data = f.read()
+    if ignore is not None:
+        data = re.sub(ignore.encode('utf-8'), b'', data, flags=re.MULTILINE)
+    return hashlib.sha256(data).hexdigest()
+
+
+def sourceHash(*fns):
+    """
+    Return a hash of some source files, to tell renders made by
+    different versions of the code apart.
+    """
+    return makeKey(sources=[fileHash(fn) for fn in fns])
+
+
+def iconHashes(text, iconDir='characters'):
+    """
+    Return a dict of hashes of the icon files referenced in the text
+    ("[bowser]" -> characters/bowser.png). Icons that don't exist (which
+    are drawn as nothing) get None.
+    """
+    hashes = {}
+    for name in re.findall(r'\[([^\]]*)\]', text):
+        try:
+            hashes[name] = fileHash(os.path.join(iconDir, name + '.png'))
+        except FileNotFoundError:
+            hashes[name] = None
+    return hashes
+
+
+def makeKey(**parts):
+    """
+    Turn everything that affects a text render into a cache key. All
+    values have to be JSON-serializable.
+    """
+    data = json.dumps(parts, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def load(key):
+    """
+    Return the cached QImage for this key, or None.
+    """
+    fn = os.path.join(CACHE_DIR, key)
+    try:
+        with open(fn, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    # Anything truncated or corrupt is treated as a miss
+    try:
+        magic, width, height, bytesPerLine, fmt = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return None
+        bits = zlib.decompress(data[HEADER.size:])
+    except (struct.error, zlib.error):
+        return None
+    if len(bits) < bytesPerLine * height:
+        return None
+    img = QtGui.QImage(bits, width, height, bytesPerLine, QtGui.QImage.Format(fmt))
+
+    # Mark it as recently used
+    os.utime(fn)
+
+    # QImage doesn't keep the buffer alive, so detach it
+    return img.copy()
+
+
+def save(key, img):
+    """
+    Put a QImage in the cache.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    bits = img.constBits()
+    bits.setsize(img.byteCount())
+    data = HEADER.pack(MAGIC, img.width(), img.height(), img.bytesPerLine(), int(img.format()))
+    data += zlib.compress(bytes(bits))
+
+    # Write to a temp file first so that nothing ever sees a partial entry
+    fd, tempFn = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tempFn, os.path.join(CACHE_DIR, key))
+
+    evict()
+
+
+def evict(maxSize=MAX_SIZE):
+    """
+    Delete the least recently used entries until the cache is no bigger
+    than maxSize bytes.
+    """
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith(TEMP_PREFIX):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxSize:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def cachedRender(key, render):
+    """
+    Return the cached render for this key as a QImage, or call render()
+    to make it (a QImage or QPixmap) and cache the result. Loading from
+    the cache doesn't need a QGuiApplication.
+    """
+    img = load(key)
+    if img is not None:
+        instrument.count('text cache hits')
+        return img
+
+    instrument.count('text renders')
+    img = toQImage(render())
+    save(key, img)
+    return img
@@ -1,13 +1,17 @@
 # 5/12/17
 # ughh
 
-import io
 import math
+import os, os.path
+import sys
 
 import imageio
-import PIL.ImageQt
+import numpy
 from PyQt5 import QtCore, QtGui, QtWidgets
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'LevelPreviewCompiler'))
+import imagebridge
+
 # Each frame is 102 px wide: we can fit two and a half horizontally
 # Each frame is 23px tall: we can fit 11 vertically
 # So that's 11 + 11 + 5 = 27 frames total.
@@ -30,31 +34,6 @@ XLPct = 116 / 173
 HighPct = 96 / 173
 LowPct = HighPct * 0.95
 
-def qImageToPilImage(qimage):
-    """
-    Convert a QImage to a PIL Image.
-    http://stackoverflow.com/a/1756587/4718769
-    """
-    buffer = QtCore.QBuffer()
-    buffer.open(QtCore.QIODevice.ReadWrite)
-    qimage.save(buffer, 'PNG')
-
-    bio = io.BytesIO()
-    bio.write(buffer.data())
-    buffer.close()
-    bio.seek(0)
-    return PIL.Image.open(bio)
-
-def qImageToImageio(qimage):
-    """
-    Convert a QImage to an imageio image.
-    """
-    buffer = QtCore.QBuffer()
-    buffer.open(QtCore.QIODevice.ReadWrite)
-    qimage.save(buffer, 'PNG')
-
-    return imageio.imread(bytes(buffer.data()))
-
 def iterFrameParameters():
     EndPct = (LowPct + HighPct) / 2
     for i in range(INTRO_FRAMES):
@@ -101,12 +80,12 @@ def makeGifFrames():
     def double(img):
         return img.scaledToWidth(img.width() * 2)
     empty = [emptyFrame()]
-    allFrames = list(map(qImageToPilImage, map(double, empty + list(iterFrames()))))
+    allFrames = list(map(imagebridge.qImageToPilImage, map(double, empty + list(iterFrames()))))
     return allFrames[:1], allFrames[:1+INTRO_FRAMES], allFrames[1+INTRO_FRAMES:]
 
 def imagesToGif(frames):
     # http://stackoverflow.com/a/35943809/4718769
-    images = list(map(qImageToImageio, frames))
+    images = list(map(numpy.asarray, frames))
     imageio.mimsave('/tmp/movie.gif', images, duration=1/30)
     with open('/tmp/movie.gif', 'rb') as f:
         return f.read()
@@ -1,114 +1,94 @@
 # 12/14/16, RoadrunnerWMC
 
+import argparse
 import collections
-import io
-import itertools
+import functools
 import json
+import math
 import os, os.path
-import struct
-import subprocess
 import sys
-import tempfile
 
-import libimagequant as liq  # pip install libimagequant
-import libimagequant_integrations.PIL  # pip install libimagequant-integrations
+import numpy
 import PIL.Image
 from PyQt5 import QtCore, QtGui; Qt = QtCore.Qt
 
 import ndspy.lz10
-import ndspy.rom
+
+# Shared modules live in the level preview compiler's folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'LevelPreviewCompiler'))
+import buildcache
+import enpg
+import imagebridge
+import instrument
+import lz77
+import outline
+import quantize
+import rompatch
+import shadow
+import textcache
+
+import palettecache
 
 VERSION = 'Ver. 1.15'
 
+# LZ10 compression level for the files inserted into the ROM: 'greedy'
+# is fast, 'optimal' makes the files as small as possible but is much
+# slower.
+LZ_LEVEL = 'greedy'
 
+# How text shadows are made: 'builtin' (in-process, following
+# ImageMagick 6 Q16) or 'imagemagick' (runs ImageMagick's "convert",
+# which has to be installed; the original implementation, kept as a
+# reference; see shadow-diff.py)
+SHADOW_BACKEND = 'builtin'
 
-def grouper(iterable, n, fillvalue=None):
-    """
-    Collect data into fixed-length chunks or blocks
-    https://docs.python.org/3/library/itertools.html#itertools-recipes
-    """
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
+# How the images are reduced to 255 colors for the ENPGs: 'liq'
+# (libimagequant) or 'rgb555' (see LevelPreviewCompiler/quantize.py)
+QUANTIZER = 'liq'
 
+# Rendered text is cached across runs (see textcache.py); this makes
+# sure that changes to the rendering code invalidate it
+SOURCE_HASH = textcache.sourceHash(
+    __file__, imagebridge.__file__, outline.__file__, shadow.__file__)
+
+# Same for the saved palette and ENPGs (see palettecache.py). This file
+# is included without its VERSION line, since the palette is kept when
+# only the version number changes.
+PALETTE_SOURCE_HASH = textcache.makeKey(
+    script=textcache.fileHash(__file__, ignore=r'^VERSION = .*$'),
+    shared=textcache.sourceHash(
+        enpg.__file__, lz77.__file__, palettecache.__file__, quantize.__file__),
+    )
 
-def findAutocropSize(img):
-    """
-    Return the x, y, w, h of the image if it were autocropped
-    """
-    if not isinstance(img, QtGui.QImage):
-        img = img.toImage()
-    minX, minY, maxX, maxY = 0, 0, img.width() - 1, img.height() - 1
-    alphaAt = lambda x, y: img.pixel(x, y) >> 24
-    rowClear = lambda y: all(alphaAt(x, y) == 0 for x in range(img.width()))
-    colClear = lambda x: all(alphaAt(x, y) == 0 for y in range(img.height()))
-    while colClear(minX): minX += 1
-    while rowClear(minY): minY += 1
-    while colClear(maxX): maxX -= 1
-    while rowClear(maxY): maxY -= 1
-    return minX, minY, maxX - minX, maxY - minY
 
 
 def antiantialias(image):
     """
     Return a copy of the image that has antialiasing removed.
     """
-    image = QtGui.QPixmap.toImage(image)
-    new = QtGui.QPixmap(image.size())
-    new.fill(Qt.transparent)
-
-    p = QtGui.QPainter(new)
-    p.setPen(Qt.NoPen)
-
-    for y in range(image.height()):
-        for x in range(image.width()):
-            argb = image.pixel(x, y)
-            a = argb >> 24
-            if a < 127: continue
-            p.setBrush(QtGui.QColor.fromRgb((argb >> 16) & 255, (argb >> 8) & 255, argb & 255))
-            p.drawRect(x, y, 1, 1)
-    del p
+    # Pixels that are at least half opaque become fully opaque, and the
+    # rest disappear
+    pixels = imagebridge.argbArray(image)
+    pixels = numpy.where(pixels >> 24 >= 127, pixels | 0xFF000000, 0).astype(numpy.uint32)
+    return QtGui.QPixmap.fromImage(imagebridge.argbArrayToQImage(pixels))
 
-    return new
 
-
-def hex2QColor(hexColor):
-    return QtGui.QColor.fromRgb(int(hexColor, 16))
-
-
-def qImageToPilImage(qimage):
+def compressLZ(data, level=LZ_LEVEL):
     """
-    Convert a QImage to a PIL Image.
-    http://stackoverflow.com/a/1756587/4718769
+    LZ10-compress some data at the requested compression level.
     """
-    buffer = QtCore.QBuffer()
-    buffer.open(QtCore.QIODevice.ReadWrite)
-    qimage.save(buffer, 'PNG')
+    instrument.count('bytes compressed', len(data))
+    if level == 'greedy':
+        return ndspy.lz10.compress(data)
 
-    bio = io.BytesIO()
-    bio.write(buffer.data())
-    buffer.close()
-    bio.seek(0)
-    return PIL.Image.open(bio)
+    compressed = lz77.LZ77_Compress(data, level=level)
+    if ndspy.lz10.decompress(compressed) != data:
+        raise ValueError(f'LZ10 data compressed at level {level!r} does not decompress correctly')
+    return compressed
 
 
-def enpgToImage(enpg):
-    """
-    Render an ENPG.
-    """
-    img = PIL.Image.new('RGBA', (256, 256), (0, 0, 0, 0))
-    colors = []
-    for i in range(256):
-        rgb555, = struct.unpack_from('<H', enpg, 256 * 256 + 2 * i)
-        b, g, r = (rgb555 >> 10) & 0x1F, (rgb555 >> 5) & 0x1F, rgb555 & 0x1F
-        r, g, b = int(r * 0xFF / 0x1F), int(g * 0xFF / 0x1F), int(b * 0xFF / 0x1F)
-        r, g, b = min(r, 255), min(g, 255), min(b, 255)
-        a = 0 if rgb555 >> 15 else 255
-        colors.append((r, g, b, a))
-    assert len(colors) == 256
-    for y in range(256):
-        for x in range(256):
-            img.putpixel((x, y), colors[enpg[y * 256 + x]])
-    return img
+def hex2QColor(hexColor):
+    return QtGui.QColor.fromRgb(int(hexColor, 16))
 
 
 def convertAllToEnpg(imgs):
@@ -122,51 +102,49 @@ def convertAllToEnpg(imgs):
     # Combine into one PIL image
     comb = PIL.Image.new('RGBA', (256 * n, 256), (0, 0, 0, 0))
     for i, img in enumerate(imgs):
-        comb.paste(qImageToPilImage(img), (256 * i, 0))
+        comb.paste(imagebridge.qImageToPilImage(img), (256 * i, 0))
 
     # Quantize
     # combQ = comb.quantize(255, 3) # leave one color for transparent
-    attr = liq.Attr()
-    attr.max_colors = 255 # leave one color for transparent
-    comb_liq = libimagequant_integrations.PIL.to_liq(comb, attr)
-    combQ = libimagequant_integrations.PIL.from_liq(comb_liq.quantize(attr), comb_liq)
-
-    # Create the ENPG data arrays
-    ENPG_LEN = 256 * 256 + 256 * 2
-    enpgs = [bytearray(ENPG_LEN) for i in range(n)]
-
-    # Convert the palette to RGB555 and put it in both the enpgs
-    pal888 = combQ.getpalette()[:255*3]
-    for enpg in enpgs:
-        struct.pack_into('<H', enpg, 256**2, 0x8000)
-    shrink = lambda c: min((c + 4) >> 3, 0x1F) & 0x1F
-    for i, (r, g, b) in enumerate(grouper(pal888, 3)):
-        rgb = shrink(b) << 10 | shrink(g) << 5 | shrink(r)
-        for enpg in enpgs:
-            struct.pack_into('<H', enpg, 256**2 + 2 * i + 2, rgb)
-
-    # Put the color indices in the enpgs
-    for i, enpg in enumerate(enpgs):
-        for y in range(256):
-            for x in range(256):
-                alpha = comb.getpixel((256 * i + x, y))[3]
-                if alpha < 255:
-                    col = 0
-                else:
-                    col = combQ.getpixel((256 * i + x, y)) + 1
-                enpg[y * 256 + x] = col
-
-    return enpgs
+    with instrument.stage('quantize'):
+        combQ = quantize.quantize(comb, QUANTIZER, 255) # leave one color for transparent
+
+    # Create the ENPGs
+    with instrument.stage('enpg'):
+        return enpg.enpgsFromQuantized(comb, combQ)
 
 
 FONT_NAME = ('New Super Mario Font (Mario Party 9)', 50)
 FONT_OUTLINE = ((0, 0, 0), 18)
-def renderText(text, relativeSize, maxWidth=240):
-    w, h = 2500, 384
-    textBoard = QtGui.QPixmap(w, h)
-    textBoard.fill(Qt.transparent)
-    textBoardP = QtGui.QPainter(textBoard)
+TEXT_SHADOW = 8
+@functools.lru_cache()
+def installedFontHash():
+    """
+    Return buildcache.fontHash() for FONT_NAME, which tells apart the
+    font files Qt might really draw text with. Only worked out once.
+    """
+    return buildcache.fontHash(QtGui.QFont(*FONT_NAME))
+
 
+def renderText(text, relativeSize, maxWidth=240):
+    key = textcache.makeKey(
+        source=SOURCE_HASH,
+        text=text,
+        font=FONT_NAME,
+        fontHash=installedFontHash(),
+        outline=FONT_OUTLINE,
+        shadow=TEXT_SHADOW,
+        shadowBackend=SHADOW_BACKEND,
+        relativeSize=relativeSize,
+        maxWidth=maxWidth,
+        icons=textcache.iconHashes(text),
+        )
+    with instrument.stage('text'):
+        return QtGui.QPixmap.fromImage(textcache.cachedRender(
+            key, lambda: renderTextUncached(text, relativeSize, maxWidth)))
+
+
+def renderTextUncached(text, relativeSize, maxWidth):
     # Split by special characters
     textList = [[False, '']] # (isIcon, text), ...
     for c in text:
@@ -186,47 +164,74 @@ def renderText(text, relativeSize, maxWidth=240):
                                                ).replace(r'\r', es + cr)
                               + es)
 
-    # Draw the text (and *only* the text), but keep track of where the
-    # icons would go and leave room for them
     f = QtGui.QFont(*FONT_NAME)
     f.setStyleStrategy(f.NoAntialias)
-    textBoardP.setFont(f)
-    textBoardP.setPen(Qt.white)
 
+    # Lay out the text and icons first, so that the board only has to be
+    # as big as they are (plus room for the outline and shadow).
+    # Everything after this point takes time proportional to its area.
+    MAX_W, MAX_H = 2500, 384
     x = 32
     PAD = 12
+    textPlacement = []
     iconPlacement = []
+    right = bottom = 0
     for isIcon, text in textList:
         if isIcon:
             icon = QtGui.QPixmap('characters/' + text + '.png')
             iconPlacement.append((icon, x))
+            right = max(right, x + icon.width())
+            bottom = max(bottom, 68 + icon.height())
             x += icon.width() + PAD
         else:
             st = QtGui.QStaticText(text)
-            st.setTextWidth(w)
-            textBoardP.drawStaticText(x, 32, st)
+            st.setTextWidth(MAX_W)
+            st.prepare(QtGui.QTransform(), f)
+            textPlacement.append((st, x))
+
+            # The layout is always MAX_W wide, but the text itself only
+            # takes up its natural width
+            natural = QtGui.QStaticText(text)
+            opt = natural.textOption()
+            opt.setWrapMode(opt.NoWrap)
+            natural.setTextOption(opt)
+            natural.prepare(QtGui.QTransform(), f)
+
+            right = max(right, x + natural.size().width())
+            bottom = max(bottom, 32 + st.size().height())
             x += st.size().width() + PAD
 
+    MARGIN = 96 # outline + shadow blur + shadow offset, with room to spare
+    w = min(MAX_W, math.ceil(right) + MARGIN)
+    h = min(MAX_H, math.ceil(bottom) + MARGIN)
+    textBoard = QtGui.QPixmap(w, h)
+    textBoard.fill(Qt.transparent)
+    textBoardP = QtGui.QPainter(textBoard)
+
+    # Draw the text (and *only* the text), leaving room for the icons
+    textBoardP.setFont(f)
+    textBoardP.setPen(Qt.white)
+    for st, x in textPlacement:
+        textBoardP.drawStaticText(int(x), 32, st)
+
     # And now outline the text
     # https://en.wikipedia.org/wiki/Dilation_(morphology)
     textBoardP.setCompositionMode(textBoardP.CompositionMode_DestinationOver)
-    textBoardP.setPen(Qt.NoPen)
-    textBoardP.setBrush(QtGui.QColor.fromRgb(*FONT_OUTLINE[0]))
-    textBoardImg = textBoard.toImage()
-    outline = FONT_OUTLINE[1]
-    for y in range(h):
-        for x in range(w):
-            if textBoardImg.pixel(x, y) >> 24 > 0:
-                textBoardP.drawEllipse(x - outline, y - outline,
-                                       2 * outline, 2 * outline)
+    with instrument.stage('outline'):
+        textOutline = outline.makeOutline(
+            textBoard.toImage(),
+            QtGui.QColor.fromRgb(*FONT_OUTLINE[0]),
+            FONT_OUTLINE[1])
+    instrument.count('pixels dilated', textBoard.width() * textBoard.height())
+    textBoardP.drawImage(0, 0, textOutline)
 
     # And draw all the icons in
     for icon, x in iconPlacement:
-        textBoardP.drawPixmap(x, 68, icon)
+        textBoardP.drawPixmap(int(x), 68, icon)
 
     # Add shadow
     textBoardP.setCompositionMode(textBoardP.CompositionMode_DestinationOver)
-    p = makePixmapShadow(textBoard, 8)
+    p = makePixmapShadow(textBoard, TEXT_SHADOW)
     textBoardP.setOpacity(0.8)
     textBoardP.drawPixmap(0, 3, p)
     textBoardP.setOpacity(1.0)
@@ -234,17 +239,17 @@ def renderText(text, relativeSize, maxWidth=240):
     del textBoardP
 
     # Now autocrop it
-    textBoard = textBoard.copy(*findAutocropSize(textBoard))
+    textBoard = textBoard.copy(*imagebridge.findAutocropSize(textBoard))
 
     # Now shrink it to the size requested
     if relativeSize * textBoard.width() < maxWidth:
         textBoard = textBoard.scaledToWidth(
-            relativeSize * textBoard.width(),
+            int(relativeSize * textBoard.width()),
             Qt.SmoothTransformation)
     else:
         textBoard = textBoard.scaled(
-            relativeSize * textBoard.width(),
-            relativeSize * textBoard.height(),
+            int(relativeSize * textBoard.width()),
+            int(relativeSize * textBoard.height()),
             Qt.IgnoreAspectRatio,
             Qt.SmoothTransformation)
 
@@ -252,61 +257,9 @@ def renderText(text, relativeSize, maxWidth=240):
 
 
 def makePixmapShadow(pix, amount):
-    # http://im.snibgo.com/selblur.htm#blrxy
-    blurCommand = f'Blur:0x{amount},90'
-
-    commands = ['-channel', 'RGB', # Only looking at the RGB channels...
-                '-black-threshold', '101%', # set them all to black
-                '-channel', 'RGBA', # Looking at all the channels again...
-                #'-morphology', 'Convolve', blurCommand,
-                '-blur', f'{amount*3}x{amount}',
-                ]
-    return QtGui.QPixmap.fromImage(runImageMagick(pix.toImage(), *commands))
-
-
-def runImageMagick(*command):
-    """
-    Run ImageMagick with the command given. Commands are a list of
-    arguments, not unlike sys.argv. Where filenames are expected, just
-    put a QImage instance. Don't add anything where the output filename
-    would normally go. The resulting QImage will be returned.
-    """
-
-    OUTPUT_FN = 'output.png'
-
-    command = list(command)
-
-    imgs = {}
-    for i, part in enumerate(command):
-        if isinstance(part, QtGui.QImage):
-            fn = f'img{i}.png'
-            imgs[fn] = part
-
-    def fnFor(img):
-        return [fn for fn, img2 in imgs.items() if img2 is img][0]
-
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        def addDir(fn): return os.path.join(tmpdirname, fn)
-
-        imgs = {addDir(fn): img for fn, img in imgs.items()}
-
-        for fn, img in imgs.items():
-            img.save(fn)
-
-        command2 = ['convert']
-        for part in command:
-            if isinstance(part, QtGui.QImage):
-                command2.append(fnFor(part))
-            else:
-                command2.append(part)
-        command2.append(addDir(OUTPUT_FN))
-
-        if sys.platform == 'win32':
-            subprocess.run(command2, shell=True)
-        else:
-            subprocess.run(command2)
-
-        return QtGui.QImage(addDir(OUTPUT_FN))
+    with instrument.stage('shadow'):
+        return QtGui.QPixmap.fromImage(
+            shadow.blurShadow(pix.toImage(), amount * 3, amount, SHADOW_BACKEND))
 
 
 def addVersionNumber(base):
@@ -318,7 +271,26 @@ def addVersionNumber(base):
     return base
 
 
-def makeImages():
+def writeEnpg(gamefn, enpgData):
+    """
+    Save an ENPG (and its compressed version and PNG render) to the
+    output folders, and return the compressed version.
+    """
+    with instrument.stage('compress'):
+        compressed = compressLZ(enpgData)
+    with instrument.stage('write'):
+        with open(f'out-enpg/{gamefn}', 'wb') as f:
+            f.write(enpgData)
+        with open(f'out-enpg-lz/{gamefn}', 'wb') as f:
+            f.write(compressed)
+    with instrument.stage('enpg render'):
+        enpgPng = enpg.enpgToImage(enpgData)
+    with instrument.stage('debug PNGs'):
+        enpgPng.save(f'out-enpg-png/{gamefn}.png')
+    return compressed
+
+
+def makeImages(requantize=False):
     imgFNs = [
         ('ts-0', '3089 BASE.enpg'),
         ('ts-1', '3090 WORLD1.enpg'),
@@ -331,33 +303,72 @@ def makeImages():
         ('ts-8', '3097 WORLD8.enpg'),
         ]
     FIRST_FILE_ID = 3089
+    gameFns = [gamefn for _, gamefn in imgFNs]
 
     imgs = []
     for fn, _ in imgFNs:
         imgs.append(QtGui.QImage(f'{fn}.png'))
 
+    # Everything but the version number, which can be remapped to the
+    # saved palette if it changes
+    key = textcache.makeKey(
+        source=PALETTE_SOURCE_HASH,
+        images={fn: textcache.fileHash(f'{fn}.png') for fn, _ in imgFNs},
+        lzLevel=LZ_LEVEL,
+        quantizer=QUANTIZER,
+        )
+
     imgs[0] = addVersionNumber(imgs[0])
+    versioned = imagebridge.qImageToPilImage(imgs[0])
+
+    remapped = None
+    if not requantize and palettecache.matches(key):
+        with instrument.stage('remap'):
+            remapped = palettecache.remap(versioned, gameFns[0])
 
-    converted = convertAllToEnpg(imgs)
+    if remapped is not None:
+        print('Remapping ts-0 to the saved palette')
+        compressed = [writeEnpg(gameFns[0], remapped)] + palettecache.restore(gameFns[1:])
+    else:
+        converted = convertAllToEnpg(imgs)
+        compressed = [writeEnpg(gamefn, enpgData) for gamefn, enpgData in zip(gameFns, converted)]
 
-    with open('Newer Super Mario Bros. DS.nds', 'rb') as f:
-        rom = ndspy.rom.NintendoDSRom(f.read())
+    with instrument.stage('palette cache'):
+        palettecache.save(key, versioned, gameFns)
 
-    for i, ((fn, gamefn), enpg) in enumerate(zip(imgFNs, converted)):
-        compressed = ndspy.lz10.compress(enpg)
-        with open(f'out-enpg/{gamefn}', 'wb') as f:
-            f.write(enpg)
-        with open(f'out-enpg-lz/{gamefn}', 'wb') as f:
-            f.write(compressed)
-        rom.files[FIRST_FILE_ID + i] = compressed
-        enpgToImage(enpg).save(f'out-enpg-png/{gamefn}.png')
+    with instrument.stage('rom'):
+        rom = rompatch.RomPatcher('Newer Super Mario Bros. DS.nds')
 
-    with open('Newer Super Mario Bros. DS.nds', 'wb') as f:
-        f.write(rom.save())
+        for i, data in enumerate(compressed):
+            rom.files[FIRST_FILE_ID + i] = data
+
+        rom.save('Newer Super Mario Bros. DS.nds')
+
+    return {'remapped': remapped is not None}
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Newer DS Title Screen Graphics Compiler')
+    parser.add_argument('--requantize', action='store_true',
+        help='quantize all nine images again, even if only the version number changed')
+    parser.add_argument('--report', metavar='FILE',
+        help='time each stage of the build, print a summary, and save the details to FILE as JSON')
+    parser.add_argument('--profile', metavar='FILE',
+        help='run the build under cProfile, and save the profile to FILE')
+    args = parser.parse_args()
+
+    instrument.configure(args.report is not None, args.profile)
+    instrument.start()
+
     app = QtGui.QGuiApplication([])
 
-    makeImages()
+    info = makeImages(args.requantize)
+
+    if instrument.enabled:
+        instrument.saveProfile()
+        report = instrument.report(**info)
+        instrument.printSummary(report)
+        if args.report is not None:
+            instrument.saveReport(args.report, report)
 
 main()
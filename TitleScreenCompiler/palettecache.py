@@ -0,0 +1,131 @@
+# Newer DS palette cache for the title screen compiler
+
+# Between releases, the only thing that changes is the version number
+# drawn onto ts-0. So after every build, the nine ENPGs (which share one
+# palette) are saved here, along with the versioned ts-0 they were made
+# from. If the next build has the same base images and settings, every
+# pixel of ts-0 that didn't change keeps its old palette index, and the
+# ones that did are mapped to the nearest color in the saved palette.
+# Only that one ENPG then has to be compressed again; the other eight
+# are copied back out as they are. If the new pixels aren't close enough
+# to any palette color, all nine images are quantized again instead.
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy
+import PIL.Image
+
+import enpg
+import quantize
+
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'palette')
+STATE_FN = 'state.json'
+VERSIONED_FN = 'versioned.png'
+
+TEMP_PREFIX = '.tmp'
+
+# Output folder -> file extension, for every file made for each image
+OUTPUT_DIRS = {
+    'out-enpg': '',
+    'out-enpg-lz': '',
+    'out-enpg-png': '.png',
+    }
+COMPRESSED_DIR = 'out-enpg-lz'
+
+# Largest mean distance (in 8-bit RGB) allowed between the pixels that
+# changed and the palette colors they're mapped to
+REMAP_MAX_ERROR = 16
+
+
+def matches(key):
+    """
+    Check whether the saved ENPGs were made from the same base images
+    and settings as the given key.
+    """
+    try:
+        with open(os.path.join(CACHE_DIR, STATE_FN), 'r', encoding='utf-8') as f:
+            return json.load(f)['key'] == key
+    except (FileNotFoundError, ValueError, KeyError):
+        return False
+
+
+def remap(img, fn):
+    """
+    Make an ENPG for a new version of the image saved as fn (a PIL
+    Image), using the saved palette. Return it, or None if the pixels
+    that changed can't be mapped closely enough.
+    """
+    with open(os.path.join(CACHE_DIR, 'out-enpg', fn), 'rb') as f:
+        old = f.read()
+    plane = enpg.ENPG_SIZE * enpg.ENPG_SIZE
+    indices = numpy.frombuffer(old, numpy.uint8, plane).reshape(enpg.ENPG_SIZE, enpg.ENPG_SIZE).copy()
+    palette = numpy.frombuffer(old, '<u2', 256, plane)
+
+    oldPixels = numpy.asarray(PIL.Image.open(os.path.join(CACHE_DIR, VERSIONED_FN)).convert('RGBA'))
+    pixels = numpy.asarray(img.convert('RGBA'))
+    changed = (pixels != oldPixels).any(axis=2)
+    opaque = changed & (pixels[..., 3] == 255)
+
+    # Color 0 is transparent, so look for the nearest one of the rest
+    colors = numpy.stack([palette & 0x1F, (palette >> 5) & 0x1F, (palette >> 10) & 0x1F], axis=1)
+    lut = quantize.nearestLookup(colors[1:]) + 1
+
+    # Pixels that aren't fully opaque become transparent, like in
+    # enpg.enpgsFromQuantized()
+    indices[changed] = 0
+    indices[opaque] = lut[quantize.rgb555Keys(pixels[opaque][:, :3])]
+
+    if opaque.any():
+        expand = numpy.array(enpg.EXPAND_5_BIT, numpy.float64)
+        diff = expand[colors[indices[opaque]]] - pixels[opaque][:, :3]
+        if numpy.sqrt((diff * diff).sum(axis=1)).mean() > REMAP_MAX_ERROR:
+            return None
+
+    return bytearray(indices.tobytes() + old[plane:])
+
+
+def restore(fns):
+    """
+    Copy the saved output files with the given names into the output
+    folders, and return the compressed ENPGs.
+    """
+    for folder, ext in OUTPUT_DIRS.items():
+        for fn in fns:
+            shutil.copyfile(os.path.join(CACHE_DIR, folder, fn + ext),
+                            os.path.join(folder, fn + ext))
+
+    compressed = []
+    for fn in fns:
+        with open(os.path.join(COMPRESSED_DIR, fn + OUTPUT_DIRS[COMPRESSED_DIR]), 'rb') as f:
+            compressed.append(f.read())
+    return compressed
+
+
+def save(key, img, fns):
+    """
+    Save the output files with the given names (one per image, all
+    sharing a palette), along with the versioned first image they were
+    made from (a PIL Image), replacing whatever was saved before.
+    """
+    os.makedirs(os.path.dirname(CACHE_DIR), exist_ok=True)
+
+    # Fill a temp folder first so that nothing ever sees a partial cache
+    tempDir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=os.path.dirname(CACHE_DIR))
+    for folder, ext in OUTPUT_DIRS.items():
+        os.mkdir(os.path.join(tempDir, folder))
+        for fn in fns:
+            shutil.copyfile(os.path.join(folder, fn + ext),
+                            os.path.join(tempDir, folder, fn + ext))
+    img.save(os.path.join(tempDir, VERSIONED_FN))
+    with open(os.path.join(tempDir, STATE_FN), 'w', encoding='utf-8') as f:
+        json.dump({'key': key}, f, indent=4)
+
+    if os.path.isdir(CACHE_DIR):
+        oldDir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=os.path.dirname(CACHE_DIR))
+        os.rename(CACHE_DIR, os.path.join(oldDir, 'old'))
+        shutil.rmtree(oldDir, ignore_errors=True)
+    os.rename(tempDir, CACHE_DIR)